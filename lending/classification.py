@@ -0,0 +1,136 @@
+"""Loan classification ranges compiled for lookups by days past due.
+
+The Loan Classification Ranges of a company are compiled once into sorted boundaries,
+separately for written off and other loans, and kept in Redis for a few hours or till the
+Company is saved again. A lookup is a bisect on the boundaries, `classify_days_past_due` classifies a
+whole list of days past due in one call. Batches get the compiled ranges through the
+settings snapshot, so they are read from Redis once per company and batch."""
+
+from bisect import bisect_right
+from dataclasses import dataclass, field
+
+import frappe
+from frappe.utils import cint
+
+CLASSIFICATION_RANGES_CACHE_KEY = "lending_classification_ranges"
+# Bounds how long ranges cached from a stale read outlive the Company save
+CLASSIFICATION_RANGES_CACHE_TTL = 6 * 60 * 60
+UNCLASSIFIED = ("", "")
+
+
+@dataclass
+class ClassificationLookup:
+	"""Classification of the days past due from `starts[i]` up to the next start"""
+
+	starts: list = field(default_factory=list)
+	classifications: list = field(default_factory=list)
+
+	@classmethod
+	def compile(cls, ranges):
+		"""Splits the ranges into disjoint segments. Where ranges overlap a segment takes
+		the range with the lowest minimum, the one a linear scan would match first."""
+		boundaries = sorted(
+			{cint(d.min_dpd_range) for d in ranges} | {cint(d.max_dpd_range) + 1 for d in ranges}
+		)
+
+		lookup = cls()
+		for start in boundaries:
+			classification = next(
+				(
+					(d.classification_code, d.classification_name)
+					for d in ranges
+					if cint(d.min_dpd_range) <= start <= cint(d.max_dpd_range)
+				),
+				UNCLASSIFIED,
+			)
+
+			if lookup.classifications and lookup.classifications[-1] == classification:
+				continue
+
+			lookup.starts.append(start)
+			lookup.classifications.append(classification)
+
+		return lookup
+
+	def classify(self, days_past_due):
+		idx = bisect_right(self.starts, cint(days_past_due)) - 1
+		return self.classifications[idx] if idx >= 0 else UNCLASSIFIED
+
+
+@dataclass
+class ClassificationRanges:
+	regular: ClassificationLookup
+	written_off: ClassificationLookup
+
+	@classmethod
+	def compile(cls, ranges):
+		ranges = sorted(ranges, key=lambda d: cint(d.min_dpd_range))
+		return cls(
+			regular=ClassificationLookup.compile([d for d in ranges if not cint(d.is_written_off)]),
+			written_off=ClassificationLookup.compile([d for d in ranges if cint(d.is_written_off)]),
+		)
+
+	def get_lookup(self, is_written_off=0):
+		return self.written_off if cint(is_written_off) else self.regular
+
+	def classify(self, days_past_due, is_written_off=0):
+		"""(classification_code, classification_name) of the days past due"""
+		return self.get_lookup(is_written_off).classify(days_past_due)
+
+	def classify_many(self, days_past_due, is_written_off=0):
+		lookup = self.get_lookup(is_written_off)
+		return [lookup.classify(value) for value in days_past_due]
+
+
+def get_classification_ranges(company):
+	"""Compiled classification ranges of the company, from Redis when cached"""
+	cache_key = get_classification_ranges_cache_key(company)
+	classification_ranges = frappe.cache.get_value(cache_key)
+
+	if classification_ranges is None:
+		classification_ranges = ClassificationRanges.compile(
+			frappe.get_all(
+				"Loan Classification Range",
+				fields=[
+					"is_written_off",
+					"min_dpd_range",
+					"max_dpd_range",
+					"classification_code",
+					"classification_name",
+				],
+				filters={"parent": company},
+				order_by="min_dpd_range",
+			)
+		)
+		frappe.cache.set_value(
+			cache_key, classification_ranges, expires_in_sec=CLASSIFICATION_RANGES_CACHE_TTL
+		)
+
+	return classification_ranges
+
+
+def classify_days_past_due(company, days_past_due, is_written_off=0):
+	"""Classifies a list of days past due at once, as a list of
+	(classification_code, classification_name)"""
+	from lending.settings import get_lending_settings
+
+	return get_lending_settings().get_company(company).classification.classify_many(
+		days_past_due, is_written_off=is_written_off
+	)
+
+
+def get_classification_ranges_cache_key(company):
+	return f"{CLASSIFICATION_RANGES_CACHE_KEY}::{company}"
+
+
+def clear_classification_ranges_cache(doc, method=None):
+	"""Drops the cached ranges of the company now and again once the save is committed, a
+	batch reading the ranges before the commit would cache the old ones again"""
+	cache_key = get_classification_ranges_cache_key(doc.name)
+
+	frappe.cache.delete_value(cache_key)
+	frappe.db.after_commit.add(lambda: frappe.cache.delete_value(cache_key))
+
+
+def clear_all_classification_ranges_cache():
+	frappe.cache.delete_keys(CLASSIFICATION_RANGES_CACHE_KEY)
@@ -0,0 +1,36 @@
+import click
+import frappe
+from frappe.commands import get_site, pass_context
+
+
+@click.command("lending-explain-queries")
+@click.option("--loan", help="Loan to build the queries for, defaults to the latest demanded loan")
+@pass_context
+def explain_queries(context, loan=None):
+	"""EXPLAIN the lending hot queries and flag full table scans"""
+	from lending.diagnostics import explain_hot_queries, format_plan_row, get_missing_indexes
+
+	frappe.init(site=get_site(context))
+	frappe.connect()
+	try:
+		for doctype, index_name in get_missing_indexes():
+			click.echo(f"Missing index {index_name} on {doctype}, run bench migrate to create it")
+
+		results = explain_hot_queries(loan=loan)
+		if not results:
+			click.echo("No submitted Loan Demand to build the queries for")
+
+		for result in results:
+			status = "FULL SCAN " + ", ".join(result.full_scans) if result.full_scans else "ok"
+			click.echo(f"{result.name:<32} {status}")
+
+			for row in result.plan:
+				click.echo(f"\t{format_plan_row(row)}")
+	finally:
+		frappe.destroy()
+
+	if any(result.full_scans for result in results):
+		raise SystemExit(1)
+
+
+commands = [explain_queries]
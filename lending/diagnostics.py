@@ -0,0 +1,127 @@
+"""Query plan audit of the lending hot paths.
+
+EXPLAINs the demand and accrual lookups the repayment, demand and accrual jobs run for
+every loan against the current database and flags the ones that scan the whole table::
+
+	bench --site site_name lending-explain-queries
+
+The queries are built for the loan of the latest submitted demand, a site without
+demands has nothing to audit. Nothing is written."""
+
+import frappe
+from frappe.utils import getdate
+
+from lending.install import LENDING_INDEXES
+from lending.settings import get_lending_settings
+
+
+def explain_hot_queries(loan=None):
+	"""Returns the plan of every hot query with the tables it scans in full, nothing if there
+	is no submitted demand to build the queries for"""
+	sample = get_sample_demand(loan)
+	if not sample:
+		return []
+
+	results = []
+	for name, query in get_hot_queries(sample).items():
+		plan = frappe.db.sql(f"EXPLAIN {query}", as_dict=1)
+		results.append(
+			frappe._dict(name=name, query=query, plan=plan, full_scans=get_full_scans(plan))
+		)
+
+	return results
+
+
+def get_sample_demand(loan=None):
+	filters = {"docstatus": 1}
+	if loan:
+		filters["loan"] = loan
+
+	return frappe.db.get_value(
+		"Loan Demand",
+		filters,
+		["loan", "loan_disbursement", "repayment_schedule_detail", "demand_date"],
+		as_dict=1,
+		order_by="creation desc",
+	)
+
+
+def get_hot_queries(sample):
+	"""SQL of the hot lookups, same filters as the code paths they are named after"""
+	from lending.lending.doctype.loan_repayment.loan_repayment import (
+		get_demand_query,
+		get_unpaid_demand_condition,
+	)
+
+	loan_demand = frappe.qb.DocType("Loan Demand")
+	posting_date = getdate()
+	precision = get_lending_settings().precision
+
+	unpaid_demands = get_demand_query().where(
+		(loan_demand.loan == sample.loan)
+		& (loan_demand.docstatus == 1)
+		& (loan_demand.demand_date <= posting_date)
+		& get_unpaid_demand_condition(loan_demand, precision)
+	)
+
+	return {
+		"get_unpaid_demands": unpaid_demands.get_sql(),
+		"get_principal_outstanding_map": frappe.db.get_all(
+			"Loan Demand",
+			filters={
+				"loan": sample.loan,
+				"repayment_schedule_detail": sample.repayment_schedule_detail or "",
+				"demand_type": "EMI",
+				"demand_subtype": "Principal",
+			},
+			fields=["repayment_schedule_detail", "outstanding_amount"],
+			run=0,
+		),
+		"get_disbursement_demands": frappe.db.get_all(
+			"Loan Demand",
+			filters={
+				"loan": sample.loan,
+				"loan_disbursement": sample.loan_disbursement or "",
+				"demand_type": "EMI",
+			},
+			fields=["name", "outstanding_amount"],
+			run=0,
+		),
+		"get_last_accrual_date": frappe.db.get_all(
+			"Loan Interest Accrual",
+			filters={
+				"loan": sample.loan,
+				"interest_type": "Normal Interest",
+				"docstatus": 1,
+				"posting_date": ("<=", posting_date),
+			},
+			fields=["MAX(posting_date) as last_accrual_date"],
+			run=0,
+		),
+	}
+
+
+def get_full_scans(plan):
+	"""Tables read without an index, `type` ALL on MariaDB and Seq Scan on Postgres"""
+	if frappe.db.db_type == "postgres":
+		return [row["QUERY PLAN"] for row in plan if "Seq Scan" in row.get("QUERY PLAN", "")]
+
+	return [row.table for row in plan if row.get("type") == "ALL"]
+
+
+def get_missing_indexes():
+	"""Indexes of `LENDING_INDEXES` not created on the current database"""
+	missing = []
+	for doctype, indexes in LENDING_INDEXES.items():
+		for index_name in indexes:
+			if not frappe.db.has_index(f"tab{doctype}", index_name):
+				missing.append((doctype, index_name))
+
+	return missing
+
+
+def format_plan_row(row):
+	if frappe.db.db_type == "postgres":
+		return row["QUERY PLAN"]
+
+	return f"{row.table:<24} type={row.type} key={row.key} rows={row.rows}"
@@ -0,0 +1,118 @@
+"""Buffered GL posting for the lending batch jobs.
+
+Lending vouchers post their GL map through `make_lending_gl_entries`. Outside of a
+buffer that is the same as calling ERPNext `make_gl_entries` for the voucher. Inside
+`gl_buffer_scope` the GL maps are collected instead and posted when the batch flushes
+the buffer with `flush_gl_entries` before it commits a chunk.
+
+Vouchers of the same type, company and posting date are posted with one
+`make_gl_entries` call. The accounting period, frozen account, disabled account and
+cost center checks then run once per group and once per distinct account, instead of
+once per voucher. ERPNext merges similar entries per voucher and handles a negative
+amount per entry, so grouping does not change the entries. The round off entry is an
+exception because it is computed for the whole GL map. Vouchers that need one, and
+vouchers too small to be posted by ERPNext, are posted on their own."""
+
+from contextlib import contextmanager
+
+import frappe
+from frappe.model.meta import get_field_precision
+from frappe.utils import flt
+
+from erpnext.accounts.general_ledger import make_gl_entries
+
+
+class LendingGLBuffer:
+	def __init__(self):
+		self.vouchers = []
+
+	def add(self, gl_map, merge_entries=True, adv_adj=0):
+		self.vouchers.append((gl_map, merge_entries, adv_adj))
+
+	def flush(self):
+		vouchers, self.vouchers = self.vouchers, []
+		groups = {}
+
+		for gl_map, merge_entries, adv_adj in vouchers:
+			if len(gl_map) < 2 or get_debit_credit_difference(gl_map):
+				make_gl_entries(gl_map, merge_entries=merge_entries, adv_adj=adv_adj)
+				continue
+
+			key = (
+				gl_map[0].get("voucher_type"),
+				gl_map[0].get("company"),
+				str(gl_map[0].get("posting_date")),
+				merge_entries,
+				adv_adj,
+			)
+			groups.setdefault(key, []).extend(gl_map)
+
+		for (_voucher_type, _company, _posting_date, merge_entries, adv_adj), gl_map in groups.items():
+			make_gl_entries(gl_map, merge_entries=merge_entries, adv_adj=adv_adj)
+
+	def discard(self):
+		self.vouchers = []
+
+
+def make_lending_gl_entries(gl_map, cancel=0, adv_adj=0, merge_entries=True):
+	"""`make_gl_entries` for lending vouchers, buffered inside `gl_buffer_scope`"""
+	buffer = get_gl_buffer()
+
+	if not buffer:
+		make_gl_entries(gl_map, cancel=cancel, adv_adj=adv_adj, merge_entries=merge_entries)
+		return
+
+	if cancel:
+		# the entries being cancelled may still be in the buffer
+		buffer.flush()
+		make_gl_entries(gl_map, cancel=cancel, adv_adj=adv_adj, merge_entries=merge_entries)
+		return
+
+	buffer.add(gl_map, merge_entries=merge_entries, adv_adj=adv_adj)
+
+
+def get_gl_buffer():
+	return getattr(frappe.local, "lending_gl_buffer", None)
+
+
+@contextmanager
+def gl_buffer_scope():
+	"""Buffers the GL entries of the lending vouchers made inside the block. The buffer
+	is flushed when the block exits, nested scopes reuse the outer buffer."""
+	if get_gl_buffer():
+		yield frappe.local.lending_gl_buffer
+		return
+
+	frappe.local.lending_gl_buffer = LendingGLBuffer()
+	try:
+		yield frappe.local.lending_gl_buffer
+		frappe.local.lending_gl_buffer.flush()
+	finally:
+		frappe.local.lending_gl_buffer = None
+
+
+def flush_gl_entries():
+	"""Posts the buffered GL entries, to be called before the batch commits"""
+	if buffer := get_gl_buffer():
+		buffer.flush()
+
+
+def discard_gl_entries():
+	"""Drops the buffered GL entries, to be called when the batch rolls back"""
+	if buffer := get_gl_buffer():
+		buffer.discard()
+
+
+def get_debit_credit_difference(gl_map):
+	"""Same as the difference ERPNext posts a round off entry for, without rounding the
+	entries in place"""
+	precision = get_field_precision(
+		frappe.get_meta("GL Entry").get_field("debit"),
+		currency=frappe.get_cached_value("Company", gl_map[0].get("company"), "default_currency"),
+	)
+
+	difference = sum(
+		flt(entry.get("debit"), precision) - flt(entry.get("credit"), precision) for entry in gl_map
+	)
+
+	return flt(difference, precision)
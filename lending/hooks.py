@@ -137,6 +137,10 @@ before_uninstall = "lending.install.before_uninstall"
 doc_events = {
 	"Company": {
 		"validate": "lending.overrides.company.validate_loan_tables",
+		"on_update": [
+			"lending.classification.clear_classification_ranges_cache",
+			"lending.settings.invalidate_lending_settings",
+		],
 	},
 	"Sales Invoice": {
 		"on_submit": [
@@ -144,6 +148,7 @@ doc_events = {
 			"lending.overrides.sales_invoice.update_waived_amount_in_demand",
 			"lending.overrides.sales_invoice.make_partner_charge_gl_entries",
 			"lending.overrides.sales_invoice.make_suspense_gl_entry_for_charges",
+			"lending.lending.doctype.loan_balance_snapshot.loan_balance_snapshot.update_loan_balance_snapshot",
 		],
 		"on_cancel": "lending.overrides.sales_invoice.cancel_demand",
 		"validate": "lending.overrides.sales_invoice.validate",
@@ -151,6 +156,53 @@ doc_events = {
 	"Custom Field": {
 		"before_insert": "lending.overrides.custom_field.update_dimensions",
 	},
+	"Loan": {
+		"on_update_after_submit": "lending.lending.doctype.loan_balance_snapshot.loan_balance_snapshot.update_loan_balance_snapshot",
+	},
+	"Loan Demand": {
+		"on_submit": "lending.lending.doctype.loan_balance_snapshot.loan_balance_snapshot.update_loan_balance_snapshot",
+		"on_cancel": "lending.lending.doctype.loan_balance_snapshot.loan_balance_snapshot.update_loan_balance_snapshot",
+	},
+	"Loan Interest Accrual": {
+		"on_submit": "lending.lending.doctype.loan_balance_snapshot.loan_balance_snapshot.update_loan_balance_snapshot",
+		"on_cancel": "lending.lending.doctype.loan_balance_snapshot.loan_balance_snapshot.update_loan_balance_snapshot",
+	},
+	"Loan Repayment": {
+		"on_submit": "lending.lending.doctype.loan_balance_snapshot.loan_balance_snapshot.update_loan_balance_snapshot",
+		"on_cancel": "lending.lending.doctype.loan_balance_snapshot.loan_balance_snapshot.update_loan_balance_snapshot",
+	},
+	"Loan Disbursement": {
+		"on_submit": "lending.lending.doctype.loan_balance_snapshot.loan_balance_snapshot.update_loan_balance_snapshot",
+		"on_cancel": "lending.lending.doctype.loan_balance_snapshot.loan_balance_snapshot.update_loan_balance_snapshot",
+	},
+	"Loan Adjustment": {
+		"on_submit": "lending.lending.doctype.loan_balance_snapshot.loan_balance_snapshot.update_loan_balance_snapshot",
+		"on_cancel": "lending.lending.doctype.loan_balance_snapshot.loan_balance_snapshot.update_loan_balance_snapshot",
+	},
+	"Loan Balance Adjustment": {
+		"on_submit": "lending.lending.doctype.loan_balance_snapshot.loan_balance_snapshot.update_loan_balance_snapshot",
+		"on_cancel": "lending.lending.doctype.loan_balance_snapshot.loan_balance_snapshot.update_loan_balance_snapshot",
+	},
+	"Loan Write Off": {
+		"on_submit": "lending.lending.doctype.loan_balance_snapshot.loan_balance_snapshot.update_loan_balance_snapshot",
+		"on_cancel": "lending.lending.doctype.loan_balance_snapshot.loan_balance_snapshot.update_loan_balance_snapshot",
+	},
+	"Loan Refund": {
+		"on_submit": "lending.lending.doctype.loan_balance_snapshot.loan_balance_snapshot.update_loan_balance_snapshot",
+		"on_cancel": "lending.lending.doctype.loan_balance_snapshot.loan_balance_snapshot.update_loan_balance_snapshot",
+	},
+	"Loan Repayment Repost": {
+		"on_submit": "lending.lending.doctype.loan_balance_snapshot.loan_balance_snapshot.update_loan_balance_snapshot",
+	},
+	"Loan Security Deposit": {
+		"on_update": "lending.lending.doctype.loan_balance_snapshot.loan_balance_snapshot.update_loan_balance_snapshot",
+	},
+	# restructures write the loan totals and the security deposit without saving them
+	"Loan Restructure": {
+		"on_submit": "lending.lending.doctype.loan_balance_snapshot.loan_balance_snapshot.update_loan_balance_snapshot",
+		"on_update_after_submit": "lending.lending.doctype.loan_balance_snapshot.loan_balance_snapshot.update_loan_balance_snapshot",
+		"on_cancel": "lending.lending.doctype.loan_balance_snapshot.loan_balance_snapshot.update_loan_balance_snapshot",
+	},
 }
 
 accounting_dimension_doctypes = [
@@ -168,6 +220,9 @@ repost_allowed_doctypes = [
 	"Loan Repayment",
 	"Loan Disbursement",
 ]
+
+clear_cache = "lending.classification.clear_all_classification_ranges_cache"
+
 # Scheduled Tasks
 # ---------------
 
@@ -179,6 +234,15 @@ scheduler_events = {
 		"lending.lending.doctype.process_loan_classification.process_loan_classification.create_process_loan_classification",
 		"lending.lending.doctype.loan.loan.auto_close_loc_loans",
 	],
+	"hourly_long": [
+		"lending.lending.doctype.process_loan_interest_accrual.process_loan_interest_accrual.requeue_stale_accrual_shards",
+		"lending.lending.doctype.loan_repayment_request.loan_repayment_request.process_loan_repayment_requests",
+		"lending.lending.doctype.loan_repost_request.loan_repost_request.process_loan_repost_requests",
+	],
+	"weekly_long": [
+		"lending.lending.doctype.loan_repayment.loan_repayment.rebuild_installment_counts",
+		"lending.lending.doctype.loan_balance_snapshot.loan_balance_snapshot.rebuild_loan_balance_snapshots",
+	],
 	"monthly_long": [
 		"lending.lending.doctype.process_loan_restructure_limit.process_loan_restructure_limit.calculate_monthly_restructure_limit",
 	],
@@ -110,6 +110,14 @@ LOAN_CUSTOM_FIELDS = {
             "insert_after": "days_past_due_threshold",
             "non_negative": 1,
         },
+        {
+            "fieldname": "store_days_past_due_as_intervals",
+            "label": "Store Days Past Due History as Intervals",
+            "fieldtype": "Check",
+            "insert_after": "days_past_due_threshold_for_auto_write_off",
+            "description": "Backdated reposts keep the days past due history of a loan as "
+            "Days Past Due Intervals instead of a Days Past Due Log per day",
+        },
         {
             "fieldname": "collection_offset_sequence_for_sub_standard_asset",
             "label": "Collection Offset Sequence for Sub Standard Asset",
@@ -260,6 +268,32 @@ LOAN_CUSTOM_FIELDS = {
     ],
 }
 
+# Composite indexes for the filters of the demand, repayment and accrual hot paths,
+# `lending.diagnostics.explain_hot_queries` checks that the queries use them
+LENDING_INDEXES = {
+    "Loan Demand": {
+        "loan_unpaid_demand_index": ["loan", "docstatus", "demand_date", "outstanding_amount"],
+        "loan_schedule_demand_index": [
+            "loan",
+            "repayment_schedule_detail",
+            "demand_type",
+            "demand_subtype",
+        ],
+        "loan_disbursement_demand_index": ["loan", "loan_disbursement", "demand_type"],
+    },
+    "Loan Interest Accrual": {
+        "loan_accrual_index": ["loan", "interest_type", "docstatus", "posting_date"],
+    },
+}
+
+# Keys the bulk upserts rely on, `days_past_due_log.upsert_days_past_due_logs` replaces
+# the log of a loan disbursement on a date through this one
+LENDING_UNIQUE_KEYS = {
+    "Days Past Due Log": {
+        "unique_loan_disbursement_posting_date": ["loan", "loan_disbursement", "posting_date"],
+    },
+}
+
 
 def fix_column_break_32_position():
     """
@@ -326,6 +360,22 @@ def after_install():
     create_custom_fields(LOAN_CUSTOM_FIELDS, ignore_validate=True)
     make_property_setter_for_journal_entry()
     fix_column_break_32_position()
+    create_lending_indexes()
+
+
+def create_lending_indexes():
+    """
+    Create the composite indexes behind the loan demand and accrual lookups and the
+    unique keys of the bulk upserts.
+    Runs on install and on every migrate, indexes that already exist are skipped.
+    """
+    for doctype, indexes in LENDING_INDEXES.items():
+        for index_name, fields in indexes.items():
+            frappe.db.add_index(doctype, fields, index_name=index_name)
+
+    for doctype, keys in LENDING_UNIQUE_KEYS.items():
+        for constraint_name, fields in keys.items():
+            frappe.db.add_unique(doctype, fields, constraint_name=constraint_name)
 
 
 @frappe.whitelist()
@@ -0,0 +1,263 @@
+# Copyright (c) 2026, Frappe Technologies Pvt. Ltd. and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+from frappe.query_builder.functions import Max
+from frappe.utils import add_days, date_diff, flt, getdate
+
+from lending.utils import bulk_insert_documents
+
+# Payment columns that pay the EMI demands of each subtype
+PAID_AMOUNT_FIELDS = {
+	"Interest": "total_interest_paid",
+	"Principal": "total_principal_paid",
+}
+
+
+class DaysPastDueInterval(Document):
+	# begin: auto-generated types
+	# This code is auto-generated. Do not modify anything in this block.
+
+	from typing import TYPE_CHECKING
+
+	if TYPE_CHECKING:
+		from frappe.types import DF
+
+		days_past_due: DF.Int
+		from_date: DF.Date
+		loan: DF.Link
+		loan_disbursement: DF.Link | None
+		process_loan_classification: DF.Link | None
+		to_date: DF.Date
+	# end: auto-generated types
+
+	pass
+
+
+def get_days_past_due_spans(demands, payments, from_date, to_date, precision):
+	"""Days past due history between `from_date` and `to_date` as spans.
+
+	`demands` are the EMI demands summed per date and subtype in date order, `payments`
+	the repayments summed per value date in date order. Payments settle the oldest demands
+	of each subtype first. Each payment holds till the day before the next one and the last
+	one till `to_date`, days before the first payment are not covered.
+
+	A span is (from_date, to_date, days_past_due) with the days past due on its first day,
+	a span with days past due counts up by a day every day. Demands and payments are
+	swept once, every span is worked out from the oldest unpaid demand at the time."""
+	queues = {}
+	for demand in demands:
+		queues.setdefault(demand.demand_subtype, []).append(
+			[getdate(demand.demand_date), flt(demand.demand_amount)]
+		)
+	heads = dict.fromkeys(queues, 0)
+
+	from_date, to_date = getdate(from_date), getdate(to_date)
+	spans = []
+
+	for idx, payment in enumerate(payments):
+		value_date = getdate(payment.value_date)
+
+		for subtype, paid_field in PAID_AMOUNT_FIELDS.items():
+			queue = queues.get(subtype, [])
+			amount = flt(payment.get(paid_field), precision)
+			head = heads.get(subtype, 0)
+
+			while amount > 0 and head < len(queue) and queue[head][0] <= value_date:
+				paid = min(amount, flt(queue[head][1], precision))
+				queue[head][1] -= paid
+				amount = flt(amount - paid, precision)
+
+				if flt(queue[head][1], precision) <= 0:
+					head += 1
+
+			if subtype in heads:
+				heads[subtype] = head
+
+		span_start = max(value_date, from_date)
+		span_end = (
+			add_days(getdate(payments[idx + 1].value_date), -1) if idx + 1 < len(payments) else to_date
+		)
+		if span_start > span_end:
+			continue
+
+		oldest_unpaid = get_oldest_unpaid_demand_date(queues, heads, precision)
+
+		if not oldest_unpaid or oldest_unpaid > span_end:
+			add_span(spans, span_start, span_end, 0)
+		elif oldest_unpaid <= span_start:
+			add_span(spans, span_start, span_end, date_diff(span_start, oldest_unpaid) + 1)
+		else:
+			add_span(spans, span_start, add_days(oldest_unpaid, -1), 0)
+			add_span(spans, oldest_unpaid, span_end, 1)
+
+	return spans
+
+
+def get_oldest_unpaid_demand_date(queues, heads, precision):
+	oldest = None
+	for subtype, queue in queues.items():
+		head = heads[subtype]
+		# demands of nil amount are paid to begin with
+		while head < len(queue) and flt(queue[head][1], precision) <= 0:
+			head += 1
+		heads[subtype] = head
+
+		if head < len(queue) and (not oldest or queue[head][0] < oldest):
+			oldest = queue[head][0]
+
+	return oldest
+
+
+def add_span(spans, from_date, to_date, days_past_due):
+	"""Appends the span, extending the last one when the days past due carry on from it"""
+	if spans:
+		last = spans[-1]
+		carried_on = (
+			last.days_past_due + date_diff(from_date, last.from_date) if last.days_past_due else 0
+		)
+		if add_days(last.to_date, 1) == from_date and carried_on == days_past_due:
+			last.to_date = to_date
+			return
+
+	spans.append(frappe._dict(from_date=from_date, to_date=to_date, days_past_due=days_past_due))
+
+
+def get_days_past_due_on(span, posting_date):
+	if not span.days_past_due:
+		return 0
+
+	return span.days_past_due + date_diff(posting_date, span.from_date)
+
+
+def expand_days_past_due_spans(spans):
+	"""(posting_date, days_past_due) for every day of the spans"""
+	for span in spans:
+		for offset in range(date_diff(span.to_date, span.from_date) + 1):
+			posting_date = add_days(span.from_date, offset)
+			yield posting_date, get_days_past_due_on(span, posting_date)
+
+
+def replace_days_past_due_intervals(
+	loan, loan_disbursement, from_date, spans, process_loan_classification=None
+):
+	"""Rewrites the history of a loan disbursement from `from_date` onwards with `spans`.
+
+	The daily logs of the range are dropped so that a date is kept in only one of the two.
+	The last interval runs till the last date of `spans`, the nightly days past due logs of
+	dates it covers are not written (see `drop_dates_covered_by_intervals`)."""
+	days_past_due_log = frappe.qb.DocType("Days Past Due Log")
+	from_date = getdate(from_date)
+
+	truncate_days_past_due_intervals(loan, loan_disbursement, from_date)
+
+	for_disbursement(
+		frappe.qb.from_(days_past_due_log)
+		.delete()
+		.where(days_past_due_log.loan == loan)
+		.where(days_past_due_log.posting_date >= from_date),
+		days_past_due_log,
+		loan_disbursement,
+	).run()
+
+	intervals = []
+	for span in spans:
+		doc = frappe.new_doc("Days Past Due Interval")
+		doc.update(
+			{
+				"name": frappe.generate_hash(length=10),
+				"loan": loan,
+				"loan_disbursement": loan_disbursement,
+				"from_date": span.from_date,
+				"to_date": span.to_date,
+				"days_past_due": span.days_past_due,
+				"process_loan_classification": process_loan_classification,
+			}
+		)
+		intervals.append(doc)
+
+	bulk_insert_documents(intervals)
+
+
+def truncate_days_past_due_intervals(loan, loan_disbursement, from_date):
+	"""Drops the intervals of a loan disbursement from `from_date` onwards"""
+	interval = frappe.qb.DocType("Days Past Due Interval")
+	from_date = getdate(from_date)
+
+	for_disbursement(
+		frappe.qb.from_(interval)
+		.delete()
+		.where(interval.loan == loan)
+		.where(interval.from_date >= from_date),
+		interval,
+		loan_disbursement,
+	).run()
+
+	# an interval running into the range is cut short
+	for_disbursement(
+		frappe.qb.update(interval)
+		.set(interval.to_date, add_days(from_date, -1))
+		.where(interval.loan == loan)
+		.where(interval.to_date >= from_date),
+		interval,
+		loan_disbursement,
+	).run()
+
+
+def for_disbursement(query, doctype, loan_disbursement):
+	if loan_disbursement:
+		return query.where(doctype.loan_disbursement == loan_disbursement)
+
+	return query.where(doctype.loan_disbursement.isnull())
+
+
+def drop_dates_covered_by_intervals(rows):
+	"""Days past due log rows (loan, loan_disbursement, posting_date, ...) whose date is not
+	already covered by a Days Past Due Interval of the same loan disbursement"""
+	if not rows:
+		return rows
+
+	interval = frappe.qb.DocType("Days Past Due Interval")
+	dates = [getdate(row[2]) for row in rows]
+
+	intervals = (
+		frappe.qb.from_(interval)
+		.select(interval.loan, interval.loan_disbursement, interval.from_date, interval.to_date)
+		.where(interval.loan.isin(list({row[0] for row in rows})))
+		.where(interval.to_date >= min(dates))
+		.where(interval.from_date <= max(dates))
+		.run(as_dict=1)
+	)
+	if not intervals:
+		return rows
+
+	covered = {}
+	for d in intervals:
+		covered.setdefault((d.loan, d.loan_disbursement or None), []).append(
+			(getdate(d.from_date), getdate(d.to_date))
+		)
+
+	def is_covered(row):
+		posting_date = getdate(row[2])
+		return any(
+			from_date <= posting_date <= to_date
+			for from_date, to_date in covered.get((row[0], row[1] or None), [])
+		)
+
+	return [row for row in rows if not is_covered(row)]
+
+
+def get_last_days_past_due_date(loan):
+	"""Latest date of the days past due history of a loan, logs and intervals alike"""
+	interval = frappe.qb.DocType("Days Past Due Interval")
+
+	last_log_date = frappe.db.get_value(
+		"Days Past Due Log", {"loan": loan}, [{"MAX": "posting_date"}]
+	)
+	last_interval_date = (
+		frappe.qb.from_(interval).select(Max(interval.to_date)).where(interval.loan == loan).run()
+	)[0][0]
+
+	dates = [getdate(d) for d in (last_log_date, last_interval_date) if d]
+	return max(dates) if dates else None
@@ -0,0 +1,41 @@
+# Copyright (c) 2026, Frappe Technologies Pvt. Ltd. and Contributors
+# See license.txt
+
+import frappe
+from frappe.tests import IntegrationTestCase
+from frappe.utils import getdate
+
+from lending.lending.doctype.days_past_due_interval.days_past_due_interval import (
+	expand_days_past_due_spans,
+	get_days_past_due_spans,
+)
+
+
+class TestDaysPastDueInterval(IntegrationTestCase):
+	def test_days_past_due_spans(self):
+		demands = [
+			frappe._dict(demand_date="2024-04-05", demand_subtype="Interest", demand_amount=100),
+			frappe._dict(demand_date="2024-04-05", demand_subtype="Principal", demand_amount=1000),
+			frappe._dict(demand_date="2024-05-05", demand_subtype="Interest", demand_amount=90),
+			frappe._dict(demand_date="2024-05-05", demand_subtype="Principal", demand_amount=1010),
+		]
+		payments = [
+			frappe._dict(value_date="2024-04-10", total_interest_paid=100, total_principal_paid=500),
+			frappe._dict(value_date="2024-04-20", total_interest_paid=0, total_principal_paid=500),
+		]
+
+		spans = get_days_past_due_spans(demands, payments, "2024-04-01", "2024-05-10", 2)
+
+		self.assertEqual(
+			[(str(span.from_date), str(span.to_date), span.days_past_due) for span in spans],
+			[
+				("2024-04-10", "2024-04-19", 6),
+				("2024-04-20", "2024-05-04", 0),
+				("2024-05-05", "2024-05-10", 1),
+			],
+		)
+
+		days_past_due = dict(expand_days_past_due_spans(spans))
+		self.assertEqual(len(days_past_due), 31)
+		self.assertEqual(days_past_due[getdate("2024-04-19")], 15)
+		self.assertEqual(days_past_due[getdate("2024-05-10")], 6)
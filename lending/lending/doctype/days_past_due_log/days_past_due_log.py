@@ -1,8 +1,16 @@
 # Copyright (c) 2023, Frappe Technologies Pvt. Ltd. and contributors
 # For license information, please see license.txt
 
-# import frappe
+import frappe
 from frappe.model.document import Document
+from frappe.utils import getdate, now_datetime
+
+from lending.lending.doctype.days_past_due_interval.days_past_due_interval import (
+	drop_dates_covered_by_intervals,
+	truncate_days_past_due_intervals,
+)
+
+DAYS_PAST_DUE_LOG_CHUNK_SIZE = 1000
 
 
 class DaysPastDueLog(Document):
@@ -22,3 +30,142 @@ class DaysPastDueLog(Document):
 	# end: auto-generated types
 
 	pass
+
+
+class DaysPastDueLogWriter:
+	"""Collects Days Past Due Log rows and writes them with multi row upserts on the
+	unique (loan, loan_disbursement, posting_date) key. The last row added for a key wins."""
+
+	def __init__(self):
+		self.rows = {}
+
+	def add(
+		self, loan, loan_disbursement, posting_date, days_past_due, process_loan_classification=None
+	):
+		self.rows[(loan, loan_disbursement or None, getdate(posting_date))] = (
+			days_past_due,
+			process_loan_classification,
+		)
+
+	def flush(self):
+		rows, self.rows = self.rows, {}
+		upsert_days_past_due_logs(
+			[(*key, days_past_due, process) for key, (days_past_due, process) in rows.items()]
+		)
+
+
+def upsert_days_past_due_logs(rows):
+	"""Writes (loan, loan_disbursement, posting_date, days_past_due, process_loan_classification)
+	rows, replacing the logs already written for the same key. Dates a Days Past Due
+	Interval already covers are skipped."""
+	if not rows:
+		return
+
+	# a date written twice within the rows keeps the last row
+	rows = list({(row[0], row[1] or None, getdate(row[2])): row for row in rows}.values())
+	rows = drop_dates_covered_by_intervals(rows)
+	if not rows:
+		return
+
+	# NULLs are distinct in a unique key, logs without a disbursement are replaced by hand
+	delete_days_past_due_logs_without_disbursement([row for row in rows if not row[1]])
+
+	now = now_datetime()
+	user = frappe.session.user
+	columns = (
+		"name",
+		"creation",
+		"modified",
+		"owner",
+		"modified_by",
+		"docstatus",
+		"loan",
+		"loan_disbursement",
+		"posting_date",
+		"days_past_due",
+		"process_loan_classification",
+	)
+
+	if frappe.db.db_type == "postgres":
+		on_duplicate = (
+			"ON CONFLICT (loan, loan_disbursement, posting_date) DO UPDATE SET "
+			"days_past_due = EXCLUDED.days_past_due, "
+			"process_loan_classification = EXCLUDED.process_loan_classification, "
+			"modified = EXCLUDED.modified, modified_by = EXCLUDED.modified_by"
+		)
+		column_list = ", ".join(f'"{column}"' for column in columns)
+		table = '"tabDays Past Due Log"'
+	else:
+		on_duplicate = (
+			"ON DUPLICATE KEY UPDATE days_past_due = VALUES(days_past_due), "
+			"process_loan_classification = VALUES(process_loan_classification), "
+			"modified = VALUES(modified), modified_by = VALUES(modified_by)"
+		)
+		column_list = ", ".join(f"`{column}`" for column in columns)
+		table = "`tabDays Past Due Log`"
+
+	placeholders = "({})".format(", ".join(["%s"] * len(columns)))
+
+	for i in range(0, len(rows), DAYS_PAST_DUE_LOG_CHUNK_SIZE):
+		chunk = rows[i : i + DAYS_PAST_DUE_LOG_CHUNK_SIZE]
+
+		values = []
+		for loan, loan_disbursement, posting_date, days_past_due, process in chunk:
+			values.extend(
+				(
+					frappe.generate_hash(length=10),
+					now,
+					now,
+					user,
+					user,
+					0,
+					loan,
+					loan_disbursement or None,
+					getdate(posting_date),
+					days_past_due,
+					process,
+				)
+			)
+
+		frappe.db.sql(
+			f"INSERT INTO {table} ({column_list}) VALUES "
+			f"{', '.join([placeholders] * len(chunk))} {on_duplicate}",
+			values,
+		)
+
+
+def delete_days_past_due_logs_without_disbursement(rows):
+	dates_by_loan = {}
+	for loan, _loan_disbursement, posting_date, *_rest in rows:
+		dates_by_loan.setdefault(loan, set()).add(getdate(posting_date))
+
+	days_past_due_log = frappe.qb.DocType("Days Past Due Log")
+	for loan, dates in dates_by_loan.items():
+		frappe.qb.from_(days_past_due_log).delete().where(
+			(days_past_due_log.loan == loan)
+			& days_past_due_log.loan_disbursement.isnull()
+			& days_past_due_log.posting_date.isin(list(dates))
+		).run()
+
+
+def replace_days_past_due_logs(loan, loan_disbursement, from_date, to_date, rows):
+	"""Rewrites the logs of a loan disbursement between `from_date` and `to_date` with one
+	range delete and a bulk insert of `rows`. Intervals from `from_date` onwards are dropped
+	so that a date is kept in only one of the two."""
+	days_past_due_log = frappe.qb.DocType("Days Past Due Log")
+
+	query = (
+		frappe.qb.from_(days_past_due_log)
+		.delete()
+		.where(days_past_due_log.loan == loan)
+		.where(days_past_due_log.posting_date[getdate(from_date) : getdate(to_date)])
+	)
+
+	if loan_disbursement:
+		query = query.where(days_past_due_log.loan_disbursement == loan_disbursement)
+	else:
+		query = query.where(days_past_due_log.loan_disbursement.isnull())
+
+	query.run()
+	truncate_days_past_due_intervals(loan, loan_disbursement, from_date)
+	upsert_days_past_due_logs(rows)
@@ -1,9 +1,50 @@
 # Copyright (c) 2023, Frappe Technologies Pvt. Ltd. and Contributors
 # See license.txt
 
-# import frappe
+import frappe
 from frappe.tests.utils import FrappeTestCase
 
+from lending.lending.doctype.days_past_due_log.days_past_due_log import (
+	DaysPastDueLogWriter,
+	replace_days_past_due_logs,
+)
+
 
 class TestDaysPastDueLog(FrappeTestCase):
-	pass
+	def test_days_past_due_log_upsert(self):
+		writer = DaysPastDueLogWriter()
+		writer.add("_Test DPD Loan", "_Test DPD Disbursement", "2024-04-10", 5)
+		writer.add("_Test DPD Loan", None, "2024-04-10", 5)
+		writer.flush()
+
+		writer.add("_Test DPD Loan", "_Test DPD Disbursement", "2024-04-10", 6)
+		writer.add("_Test DPD Loan", None, "2024-04-10", 6)
+		writer.flush()
+
+		logs = frappe.get_all(
+			"Days Past Due Log", filters={"loan": "_Test DPD Loan"}, pluck="days_past_due"
+		)
+		self.assertEqual(sorted(logs), [6, 6])
+
+	def test_replace_days_past_due_logs(self):
+		writer = DaysPastDueLogWriter()
+		for day in range(1, 11):
+			writer.add("_Test DPD Loan", "_Test DPD Disbursement", f"2024-04-{day:02d}", day)
+		writer.flush()
+
+		replace_days_past_due_logs(
+			"_Test DPD Loan",
+			"_Test DPD Disbursement",
+			"2024-04-05",
+			"2024-04-10",
+			[("_Test DPD Loan", "_Test DPD Disbursement", "2024-04-05", 0, None)],
+		)
+
+		logs = frappe.get_all(
+			"Days Past Due Log",
+			filters={"loan": "_Test DPD Loan"},
+			fields=["posting_date", "days_past_due"],
+			order_by="posting_date",
+		)
+		self.assertEqual(len(logs), 5)
+		self.assertEqual(logs[-1].days_past_due, 0)
@@ -29,7 +29,7 @@ from lending.lending.doctype.loan_limit_change_log.loan_limit_change_log import
 from lending.lending.doctype.loan_security_release.loan_security_release import (
 	get_pledged_security_qty,
 )
-from lending.utils import daterange
+from lending.settings import get_lending_settings
 
 
 # nosemgrep
@@ -892,8 +892,7 @@ def update_days_past_due_in_loans(
 
 			return
 
-		threshold_map = get_dpd_threshold_map()
-		threshold_write_off_map = get_dpd_threshold_write_off_map()
+		settings = get_lending_settings()
 
 		loan_details = frappe.db.get_value(
 			"Loan", loan_name, ["applicant_type", "applicant", "freeze_date", "company"], as_dict=1
@@ -916,7 +915,9 @@ def update_days_past_due_in_loans(
 			if days_past_due < 0:
 				days_past_due = 0
 
-			threshold = threshold_map.get(demand.loan_product, 0)
+			threshold = settings.get_loan_product(
+				demand.loan_product
+			).days_past_due_threshold_for_npa
 
 			if days_past_due and threshold and days_past_due > threshold:
 				is_npa = 1
@@ -944,13 +945,15 @@ def update_days_past_due_in_loans(
 				demand.loan, disbursement, posting_date, days_past_due, process_loan_classification
 			)
 
-			write_off_threshold = threshold_write_off_map.get(demand.company, 0)
+			write_off_threshold = settings.get_company(
+				demand.company
+			).days_past_due_threshold_for_auto_write_off
 
 			if write_off_threshold and days_past_due > write_off_threshold:
 				create_loan_write_off(demand.loan, posting_date)
 		else:
 			# if no demand found, set DPD as 0
-			threshold = threshold_map.get(loan_product, 0)
+			threshold = settings.get_loan_product(loan_product).days_past_due_threshold_for_npa
 
 			update_loan_and_customer_status(
 				loan_name,
@@ -970,107 +973,92 @@ def update_days_past_due_in_loans(
 def repost_days_past_due_log(
 	loan, posting_date, loan_product, loan_disbursement, process_loan_classification
 ):
-	"""Get outstanding demands for a loan"""
-	where_conditions = ""
-	payment_conditions = ""
+	"""Rebuilds the days past due history of a loan disbursement from `posting_date`"""
+	from frappe.query_builder.functions import Max, Sum
+
+	from lending.lending.doctype.days_past_due_interval.days_past_due_interval import (
+		expand_days_past_due_spans,
+		get_days_past_due_on,
+		get_days_past_due_spans,
+		replace_days_past_due_intervals,
+	)
+	from lending.lending.doctype.days_past_due_log.days_past_due_log import (
+		replace_days_past_due_logs,
+	)
 
-	precision = cint(frappe.db.get_default("currency_precision")) or 2
+	loan_demand = frappe.qb.DocType("Loan Demand")
+	loan_repayment = frappe.qb.DocType("Loan Repayment")
+
+	demand_query = (
+		frappe.qb.from_(loan_demand)
+		.select(
+			loan_demand.demand_date,
+			loan_demand.demand_subtype,
+			Max(loan_demand.loan_disbursement).as_("loan_disbursement"),
+			Sum(loan_demand.demand_amount).as_("demand_amount"),
+		)
+		.where(loan_demand.loan == loan)
+		.where(loan_demand.docstatus == 1)
+		.where(loan_demand.demand_type == "EMI")
+		.groupby(loan_demand.demand_date, loan_demand.demand_subtype)
+		.orderby(loan_demand.demand_date)
+	)
+
+	payment_query = (
+		frappe.qb.from_(loan_repayment)
+		.select(
+			loan_repayment.value_date,
+			Sum(loan_repayment.principal_amount_paid).as_("total_principal_paid"),
+			Sum(loan_repayment.total_interest_paid).as_("total_interest_paid"),
+		)
+		.where(loan_repayment.against_loan == loan)
+		.where(loan_repayment.docstatus == 1)
+		.groupby(loan_repayment.value_date)
+		.orderby(loan_repayment.value_date)
+	)
 
 	if loan_product:
-		where_conditions += f"AND loan_product = '{loan_product}'"
+		demand_query = demand_query.where(loan_demand.loan_product == loan_product)
+		payment_query = payment_query.where(loan_repayment.loan_product == loan_product)
 
 	if loan_disbursement:
-		where_conditions += f"AND loan_disbursement = '{loan_disbursement}'"
-
-	demands = frappe.db.sql(
-		"""
-		SELECT demand_date, loan_disbursement, demand_subtype, sum(demand_amount) as demand_amount, sum(outstanding_amount) as outstanding_amount
-		FROM `tabLoan Demand`
-		WHERE loan = %s
-			AND docstatus = 1
-			AND demand_type = "EMI"
-			{0}
-		GROUP BY demand_date, demand_subtype
-		ORDER BY demand_date
-	""".format(
-			where_conditions
-		),
-		(loan),
-		as_dict=1,
-	)
+		demand_query = demand_query.where(loan_demand.loan_disbursement == loan_disbursement)
+		payment_query = payment_query.where(
+			(loan_repayment.loan_disbursement == loan_disbursement)
+			| loan_repayment.loan_disbursement.isnull()
+		)
 
-	if demands:
-		if loan_product:
-			payment_conditions += f"AND loan_product = '{loan_product}'"
+	demands = demand_query.run(as_dict=1)
+	if not demands:
+		return
 
-		if loan_disbursement:
-			payment_conditions += (
-				f"AND (loan_disbursement = '{loan_disbursement}' OR loan_disbursement IS NULL)"
-			)
+	payments = payment_query.run(as_dict=1)
+	if not payments:
+		return
+
+	settings = get_lending_settings()
+	spans = get_days_past_due_spans(demands, payments, posting_date, getdate(), settings.precision)
+	disbursement = loan_disbursement or demands[-1].loan_disbursement
 
-		payment_against_demand = frappe.db.sql(
-			"""
-			SELECT value_date, SUM(principal_amount_paid) as total_principal_paid, SUM(total_interest_paid) as total_interest_paid
-			FROM `tabLoan Repayment`
-			WHERE against_loan = %s
-				and docstatus = 1
-				{0}
-			GROUP BY value_date
-			ORDER BY value_date
-		""".format(
-				payment_conditions
-			),
-			(loan),
-			as_dict=1,
+	company = frappe.db.get_value("Loan", loan, "company")
+	if settings.get_company(company).store_days_past_due_as_intervals:
+		replace_days_past_due_intervals(
+			loan, disbursement, posting_date, spans, process_loan_classification
+		)
+	elif spans:
+		replace_days_past_due_logs(
+			loan,
+			disbursement,
+			spans[0].from_date,
+			spans[-1].to_date,
+			[
+				(loan, disbursement, day, days_past_due, process_loan_classification)
+				for day, days_past_due in expand_days_past_due_spans(spans)
+			],
 		)
 
-		for idx, payment in enumerate(payment_against_demand):
-			next_payment_date = (
-				payment_against_demand[idx + 1].value_date
-				if idx + 1 < len(payment_against_demand)
-				else getdate()
-			)
-			for demand in demands:
-				if getdate(demand.demand_date) <= getdate(payment.value_date):
-					if demand.demand_subtype == "Interest" and flt(payment.total_interest_paid, precision) > 0:
-						paid_interest = min(
-							flt(payment.total_interest_paid, precision), flt(demand.demand_amount, precision)
-						)
-						demand.demand_amount -= paid_interest
-						payment.total_interest_paid -= paid_interest
-
-					if demand.demand_subtype == "Principal" and flt(payment.total_principal_paid, precision) > 0:
-						paid_principal = min(
-							flt(payment.total_principal_paid, precision), flt(demand.demand_amount, precision)
-						)
-						demand.demand_amount -= paid_principal
-						payment.total_principal_paid -= paid_principal
-
-			start_date = getdate(payment.value_date)
-			end_date = getdate(next_payment_date)
-
-			for current_date in daterange(start_date, end_date):
-				final_dpd = 0
-				if current_date >= getdate(posting_date):
-					matching_demand_found = False
-					for d in demands:
-						demand_amount = flt(d.demand_amount, precision)
-						if getdate(d.demand_date) <= current_date and demand_amount > 0:
-							dpd_counter = date_diff(current_date, d.demand_date) + 1
-							create_dpd_record(
-								loan, demand.loan_disbursement, current_date, dpd_counter, process_loan_classification
-							)
-							final_dpd = dpd_counter
-							matching_demand_found = True
-							break
-
-					if not matching_demand_found:
-						final_dpd = 0
-						create_dpd_record(
-							loan, demand.loan_disbursement, current_date, 0, process_loan_classification
-						)
-
-			frappe.db.set_value("Loan", loan, "days_past_due", final_dpd)
+	final_dpd = get_days_past_due_on(spans[-1], spans[-1].to_date) if spans else 0
+	frappe.db.set_value("Loan", loan, "days_past_due", final_dpd)
 
 
 def create_loan_write_off(loan, posting_date):
@@ -1084,25 +1072,13 @@ def create_loan_write_off(loan, posting_date):
 def create_dpd_record(
 	loan, loan_disbursement, posting_date, days_past_due, process_loan_classification=None
 ):
-	existing_log = frappe.db.get_value(
-		"Days Past Due Log",
-		{"loan": loan, "posting_date": posting_date, "loan_disbursement": loan_disbursement},
+	from lending.lending.doctype.days_past_due_log.days_past_due_log import (
+		upsert_days_past_due_logs,
 	)
-	if existing_log:
-		doc = frappe.get_doc("Days Past Due Log", existing_log)
-	else:
-		doc = frappe.new_doc("Days Past Due Log")
 
-	doc.update(
-		{
-			"loan": loan,
-			"loan_disbursement": loan_disbursement,
-			"posting_date": posting_date,
-			"days_past_due": days_past_due,
-			"process_loan_classification": process_loan_classification,
-		}
+	upsert_days_past_due_logs(
+		[(loan, loan_disbursement, posting_date, days_past_due, process_loan_classification)]
 	)
-	doc.save(ignore_permissions=True)
 
 
 def update_loan_and_customer_status(
@@ -1118,6 +1094,9 @@ def update_loan_and_customer_status(
 	is_backdated=0,
 	dpd_threshold=0,
 ):
+	from lending.lending.doctype.days_past_due_interval.days_past_due_interval import (
+		get_last_days_past_due_date,
+	)
 	from lending.lending.doctype.loan_write_off.loan_write_off import (
 		write_off_charges,
 		write_off_suspense_entries,
@@ -1167,7 +1146,7 @@ def update_loan_and_customer_status(
 			"npa",
 			order_by="npa_date desc",
 		)
-		max_date = frappe.db.get_value("Days Past Due Log", {"loan": loan}, [{"MAX": "posting_date"}])
+		max_date = get_last_days_past_due_date(loan)
 
 		actual_diff = date_diff(getdate(max_date), getdate(posting_date))
 		actual_dpd = days_past_due + actual_diff
@@ -1293,6 +1272,61 @@ def update_npa_check(
 		create_loan_npa_log(loan.name, posting_date, is_npa, event, manual_npa=manual_npa)
 
 
+def update_npa_check_for_applicants(applicants, posting_date, event=None):
+	"""`update_npa_check` marking the loans of many (applicant_type, applicant) NPA at
+	once, with one update for the loans and the customers and one insert for the logs"""
+	from lending.utils import bulk_insert_documents
+
+	if not applicants:
+		return
+
+	_loan = frappe.qb.DocType("Loan")
+	applicants = set(applicants)
+
+	rows = (
+		frappe.qb.from_(_loan)
+		.select(_loan.name, _loan.applicant_type, _loan.applicant)
+		.where(
+			(_loan.docstatus == 1)
+			& (_loan.unmark_npa == 0)
+			& (_loan.status.isin(["Disbursed", "Partially Disbursed", "Active"]))
+			& (_loan.applicant.isin([applicant for _applicant_type, applicant in applicants]))
+			& (_loan.watch_period_end_date.isnull() | (_loan.watch_period_end_date < posting_date))
+		)
+		.for_update()
+		.run(as_dict=1)
+	)
+
+	loans = [row.name for row in rows if (row.applicant_type, row.applicant) in applicants]
+	now = now_datetime()
+
+	if loans:
+		frappe.qb.update(_loan).set(_loan.is_npa, 1).set(_loan.modified, now).set(
+			_loan.modified_by, frappe.session.user
+		).where(_loan.name.isin(loans)).run()
+
+	logs = []
+	for loan in loans:
+		loan_npa_log = frappe.new_doc("Loan NPA Log")
+		loan_npa_log.update(
+			{
+				"name": frappe.generate_hash(length=10),
+				"loan": loan,
+				"npa_date": posting_date,
+				"npa": 1,
+				"event": event,
+			}
+		)
+		logs.append(loan_npa_log)
+
+	bulk_insert_documents(logs)
+
+	customer = frappe.qb.DocType("Customer")
+	frappe.qb.update(customer).set(customer.is_npa, 1).set(customer.modified, now).set(
+		customer.modified_by, frappe.session.user
+	).where(customer.name.isin([applicant for _applicant_type, applicant in applicants])).run()
+
+
 def create_loan_npa_log(loan, posting_date, is_npa, event, manual_npa=None):
 	loan_npa_log = frappe.new_doc("Loan NPA Log")
 	loan_npa_log.loan = loan
@@ -1316,44 +1350,10 @@ def update_watch_period_date_for_all_loans(watch_period_end_date, applicant_type
 
 
 def get_classification_code_and_name(days_past_due, company, is_written_off):
-	classification_code = ""
-	classification_name = ""
-
-	ranges = frappe.get_all(
-		"Loan Classification Range",
-		fields=[
-			"is_written_off",
-			"min_dpd_range",
-			"max_dpd_range",
-			"classification_code",
-			"classification_name",
-		],
-		filters={"parent": company},
-		order_by="min_dpd_range",
-	)
-
-	for range in ranges:
-		if range.min_dpd_range <= days_past_due <= range.max_dpd_range and cint(
-			range.is_written_off
-		) == cint(is_written_off):
-			return range.classification_code, range.classification_name
-
-	return classification_code, classification_name
-
-
-@redis_cache(ttl=60 * 60)
-def get_dpd_threshold_map():
-	return frappe._dict(
-		frappe.get_all("Loan Product", fields=["name", "days_past_due_threshold_for_npa"], as_list=1)
-	)
-
-
-@redis_cache(ttl=60 * 60)
-def get_dpd_threshold_write_off_map():
-	return frappe._dict(
-		frappe.get_all(
-			"Company", fields=["name", "days_past_due_threshold_for_auto_write_off"], as_list=1
-		)
+	return (
+		get_lending_settings()
+		.get_company(company)
+		.classification.classify(days_past_due, is_written_off=is_written_off)
 	)
 
 
@@ -30,6 +30,7 @@ def get_data():
 				"items": [
 					"Loan Security Release",
 					"Days Past Due Log",
+					"Days Past Due Interval",
 					"Loan NPA Log",
 					"Journal Entry",
 					"Sales Invoice",
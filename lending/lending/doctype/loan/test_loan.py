@@ -870,6 +870,42 @@ class TestLoan(IntegrationTestCase):
 		amounts = calculate_amounts(against_loan=loan.name, posting_date="2024-07-06")
 		self.assertEqual(flt(amounts["penalty_amount"], 2), 3059.7)
 
+	def test_consolidated_penalty(self):
+		frappe.db.set_value("Loan Product", "Term Loan Product 4", "consolidate_penal_interest", 1)
+		loan = create_loan(
+			self.applicant1,
+			"Term Loan Product 4",
+			500000,
+			"Repay Over Number of Periods",
+			12,
+			repayment_start_date="2024-05-05",
+			posting_date="2024-04-01",
+			penalty_charges_rate=25,
+		)
+
+		loan.submit()
+
+		make_loan_disbursement_entry(
+			loan.name, loan.loan_amount, disbursement_date="2024-04-01", repayment_start_date="2024-05-05"
+		)
+		process_daily_loan_demands(posting_date="2024-07-06", loan=loan.name)
+		process_loan_interest_accrual_for_loans(
+			posting_date="2024-07-06", loan=loan.name, company="_Test Company"
+		)
+		frappe.db.set_value("Loan Product", "Term Loan Product 4", "consolidate_penal_interest", 0)
+
+		penal_accruals = frappe.get_all(
+			"Loan Interest Accrual",
+			{"loan": loan.name, "interest_type": "Penal Interest", "docstatus": 1},
+			["loan_repayment_schedule_detail"],
+		)
+		self.assertEqual(
+			len(penal_accruals), len({d.loan_repayment_schedule_detail for d in penal_accruals})
+		)
+
+		amounts = calculate_amounts(against_loan=loan.name, posting_date="2024-07-06")
+		self.assertAlmostEqual(flt(amounts["penalty_amount"], 2), 3059.7, delta=0.1)
+
 	def test_same_date_for_daily_accruals(self):
 		from lending.tests.test_utils import get_penalty_amount
 
@@ -2610,6 +2646,148 @@ class TestLoan(IntegrationTestCase):
 			posting_date="2024-07-07", loan=loan1.name, force_update_dpd_in_loan=1
 		)
 
+	def test_set_based_days_past_due(self):
+		from lending.lending.doctype.process_loan_classification.process_loan_classification import (
+			process_loan_classification_batch,
+		)
+
+		loans = []
+		for _i in range(2):
+			loan = create_loan(
+				"_Test Customer 1",
+				"Term Loan Product 4",
+				100000,
+				"Repay Over Number of Periods",
+				22,
+				repayment_start_date="2024-04-05",
+				posting_date="2024-03-05",
+				rate_of_interest=8.5,
+				applicant_type="Customer",
+			)
+			loan.submit()
+			make_loan_disbursement_entry(
+				loan.name, loan.loan_amount, disbursement_date="2024-03-05", repayment_start_date="2024-04-05"
+			)
+			process_daily_loan_demands(posting_date="2024-04-05", loan=loan.name)
+			loans.append(loan.name)
+
+		process_loan_classification_batch(
+			loans, "2024-04-10", None, None, None, None, 0, force_update_dpd_in_loan=1
+		)
+
+		for loan in loans:
+			self.assertEqual(frappe.db.get_value("Loan", loan, "days_past_due"), 6)
+			self.assertEqual(
+				frappe.db.get_value(
+					"Days Past Due Log", {"loan": loan, "posting_date": "2024-04-10"}, "days_past_due"
+				),
+				6,
+			)
+
+	def test_nightly_days_past_due_skips_dates_covered_by_intervals(self):
+		from lending.lending.doctype.loan.loan import repost_days_past_due_log
+		from lending.lending.doctype.process_loan_classification.process_loan_classification import (
+			process_loan_classification_batch,
+		)
+
+		company = frappe.get_doc("Company", "Moo Coding")
+		company.store_days_past_due_as_intervals = 1
+		company.save()
+		self.addCleanup(
+			frappe.db.set_value, "Company", "Moo Coding", "store_days_past_due_as_intervals", 0
+		)
+
+		loan = create_loan(
+			"_Test Customer 1",
+			"Term Loan Product 4",
+			100000,
+			"Repay Over Number of Periods",
+			22,
+			repayment_start_date="2024-04-05",
+			posting_date="2024-03-05",
+			rate_of_interest=8.5,
+			applicant_type="Customer",
+		)
+		loan.submit()
+		disbursement = make_loan_disbursement_entry(
+			loan.name, loan.loan_amount, disbursement_date="2024-03-05", repayment_start_date="2024-04-05"
+		)
+		process_daily_loan_demands(posting_date="2024-05-05", loan=loan.name)
+
+		repayment = create_repayment_entry(loan.name, "2024-04-10", 1000)
+		repayment.submit()
+
+		repost_days_past_due_log(loan.name, "2024-04-05", None, disbursement.name, None)
+		self.assertTrue(frappe.db.exists("Days Past Due Interval", {"loan": loan.name}))
+
+		process_loan_classification_batch(
+			[loan.name], "2024-04-20", None, None, None, None, 0, force_update_dpd_in_loan=1
+		)
+
+		intervals = frappe.get_all(
+			"Days Past Due Interval",
+			filters={"loan": loan.name},
+			fields=["loan_disbursement", "from_date", "to_date"],
+		)
+		logs = frappe.get_all(
+			"Days Past Due Log",
+			filters={"loan": loan.name},
+			fields=["loan_disbursement", "posting_date"],
+		)
+		for log in logs:
+			for interval in intervals:
+				self.assertFalse(
+					log.loan_disbursement == interval.loan_disbursement
+					and interval.from_date <= log.posting_date <= interval.to_date,
+					f"{log.posting_date} is in both a Days Past Due Log and a Days Past Due Interval",
+				)
+
+	def test_set_based_npa_marking_for_customer(self):
+		from lending.lending.doctype.process_loan_classification.process_loan_classification import (
+			process_loan_classification_batch,
+		)
+
+		customer = frappe.get_doc(get_customer_dict("NPA Customer 2")).insert()
+		frappe.db.set_value("Loan Product", "Term Loan Product 4", "days_past_due_threshold_for_npa", 90)
+
+		loans = []
+		for disbursement_date, repayment_start_date in (
+			("2024-03-05", "2024-04-05"),
+			("2024-06-05", "2024-07-05"),
+		):
+			loan = create_loan(
+				customer.name,
+				"Term Loan Product 4",
+				100000,
+				"Repay Over Number of Periods",
+				22,
+				repayment_start_date=repayment_start_date,
+				posting_date=disbursement_date,
+				rate_of_interest=8.5,
+				applicant_type="Customer",
+			)
+			loan.submit()
+			make_loan_disbursement_entry(
+				loan.name,
+				loan.loan_amount,
+				disbursement_date=disbursement_date,
+				repayment_start_date=repayment_start_date,
+			)
+			loans.append(loan.name)
+
+		process_daily_loan_demands(posting_date="2024-07-05", loan=loans[0])
+		process_loan_classification_batch(
+			loans, "2024-07-06", None, None, None, None, 0, force_update_dpd_in_loan=1
+		)
+
+		for loan in loans:
+			self.assertTrue(frappe.db.get_value("Loan", loan, "is_npa"), f"{loan} not marked as NPA")
+			self.assertEqual(
+				frappe.db.count("Loan NPA Log", {"loan": loan, "npa": 1, "npa_date": "2024-07-06"}), 1
+			)
+
+		self.assertTrue(frappe.db.get_value("Customer", customer.name, "is_npa"))
+
 	def test_normal_loan_repayment_schedule_close(self):
 		from erpnext.selling.doctype.customer.test_customer import get_customer_dict
 
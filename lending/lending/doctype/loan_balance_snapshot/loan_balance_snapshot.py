@@ -0,0 +1,411 @@
+# Copyright (c) 2026, Frappe Technologies Pvt. Ltd. and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+from frappe.query_builder import Case
+from frappe.query_builder.functions import Coalesce, Max, Sum
+from frappe.utils import flt, getdate, now_datetime
+
+from lending.settings import get_lending_settings
+
+# Outstanding components kept per loan, and per disbursement for line of credit loans
+SNAPSHOT_AMOUNT_FIELDS = (
+	"pending_principal_amount",
+	"principal_overdue",
+	"interest_overdue",
+	"penalty_overdue",
+	"charges_overdue",
+	"total_overdue",
+	"unbooked_interest",
+	"available_security_deposit",
+	"written_off_amount",
+	"excess_amount_paid",
+)
+
+SNAPSHOT_FIELDS = (
+	"loan",
+	"loan_disbursement",
+	"company",
+	"loan_product",
+	"status",
+	"last_demand_date",
+	"due_date",
+	"last_accrual_date",
+	*SNAPSHOT_AMOUNT_FIELDS,
+)
+
+SNAPSHOT_LOAN_FIELDS = (
+	"name",
+	"company",
+	"loan_product",
+	"status",
+	"docstatus",
+	"repayment_schedule_type",
+	"written_off_amount",
+	"excess_amount_paid",
+	"total_payment",
+	"total_principal_paid",
+	"total_interest_payable",
+	"debit_adjustment_amount",
+	"credit_adjustment_amount",
+	"disbursed_amount",
+)
+
+
+class LoanBalanceSnapshot(Document):
+	# begin: auto-generated types
+	# This code is auto-generated. Do not modify anything in this block.
+
+	from typing import TYPE_CHECKING
+
+	if TYPE_CHECKING:
+		from frappe.types import DF
+
+		available_security_deposit: DF.Currency
+		charges_overdue: DF.Currency
+		company: DF.Link | None
+		due_date: DF.Date | None
+		excess_amount_paid: DF.Currency
+		interest_overdue: DF.Currency
+		last_accrual_date: DF.Date | None
+		last_demand_date: DF.Date | None
+		loan: DF.Link
+		loan_disbursement: DF.Link | None
+		loan_product: DF.Link | None
+		pending_principal_amount: DF.Currency
+		penalty_overdue: DF.Currency
+		principal_overdue: DF.Currency
+		status: DF.Data | None
+		total_overdue: DF.Currency
+		unbooked_interest: DF.Currency
+		written_off_amount: DF.Currency
+	# end: auto-generated types
+
+	pass
+
+
+def update_loan_balance_snapshot(doc, method=None):
+	"""`doc_events` hook of the vouchers that change the balances of a loan"""
+	loan = doc.get("against_loan") or doc.get("loan")
+	if loan:
+		mark_loan_balances_stale([loan])
+
+
+def mark_loan_balances_stale(loans):
+	"""Queues the snapshots of `loans` to be rebuilt before the transaction commits.
+
+	A loan touched by several vouchers in a transaction is rebuilt once, and all the
+	loans of a transaction are rebuilt together."""
+	stale_loans = getattr(frappe.local, "stale_loan_balances", None)
+
+	if stale_loans is None:
+		stale_loans = frappe.local.stale_loan_balances = set()
+		frappe.db.before_commit.add(flush_stale_loan_balances)
+		frappe.db.after_rollback.add(clear_stale_loan_balances)
+
+	stale_loans.update(loans)
+
+
+def flush_stale_loan_balances():
+	stale_loans = getattr(frappe.local, "stale_loan_balances", None)
+	frappe.local.stale_loan_balances = None
+
+	if stale_loans:
+		refresh_loan_balance_snapshots(list(stale_loans))
+
+
+def clear_stale_loan_balances():
+	frappe.local.stale_loan_balances = None
+
+
+def refresh_loan_balance_snapshots(loans):
+	"""Rebuilds the snapshots of `loans` from the demands, accruals, disbursements and
+	security deposits, with a fixed number of grouped queries"""
+	from lending.lending.doctype.loan_repayment.utils import (
+		get_disbursement_map,
+		get_pending_principal_amount_for_loans,
+	)
+
+	if not loans:
+		return
+
+	snapshot = frappe.qb.DocType("Loan Balance Snapshot")
+	frappe.qb.from_(snapshot).delete().where(snapshot.loan.isin(loans)).run()
+
+	loan_details = frappe.db.get_all(
+		"Loan",
+		filters={"name": ("in", loans), "docstatus": 1, "status": ("!=", "Cancelled")},
+		fields=list(SNAPSHOT_LOAN_FIELDS),
+	)
+	if not loan_details:
+		return
+
+	loans = [loan.name for loan in loan_details]
+	precision = get_lending_settings().precision
+
+	disbursement_map = get_disbursement_map(loan_details)
+	principal_amount_map = get_pending_principal_amount_for_loans(loan_details, disbursement_map)
+	demand_map = get_outstanding_demand_map(loans)
+	accrual_map = get_unbooked_interest_snapshot_map(loans)
+	security_deposit_map = get_available_security_deposit_map(loans)
+
+	rows = []
+	for loan in loan_details:
+		keys = [loan.name]
+		if loan.repayment_schedule_type == "Line of Credit":
+			keys += [(loan.name, disbursement) for disbursement in disbursement_map.get(loan.name, [])]
+
+		for key in keys:
+			loan_disbursement = key[1] if isinstance(key, tuple) else None
+			row = frappe._dict(
+				loan=loan.name,
+				loan_disbursement=loan_disbursement,
+				company=loan.company,
+				loan_product=loan.loan_product,
+				status=loan.status,
+				written_off_amount=flt(loan.written_off_amount, precision),
+				excess_amount_paid=flt(loan.excess_amount_paid, precision),
+				available_security_deposit=flt(security_deposit_map.get(loan.name), precision),
+			)
+			row.update(demand_map.get(key, {}))
+			row.update(accrual_map.get(key, {}))
+
+			# Dates are of the loan, bulk due details read them per loan
+			for dates in (demand_map.get(loan.name, {}), accrual_map.get(loan.name, {})):
+				for fieldname in ("last_demand_date", "due_date", "last_accrual_date"):
+					if fieldname in dates:
+						row[fieldname] = dates[fieldname]
+
+			if loan_disbursement:
+				row.pending_principal_amount = principal_amount_map.get(key, 0)
+			elif loan.repayment_schedule_type == "Line of Credit":
+				row.pending_principal_amount = sum(
+					flt(principal_amount_map.get((loan.name, disbursement)))
+					for disbursement in disbursement_map.get(loan.name, [])
+				)
+			else:
+				row.pending_principal_amount = principal_amount_map.get(loan.name, 0)
+
+			if loan.status in ("Closed", "Settled"):
+				row.unbooked_interest = 0
+
+			for fieldname in SNAPSHOT_AMOUNT_FIELDS:
+				row[fieldname] = flt(row.get(fieldname), precision)
+
+			row.total_overdue = flt(
+				row.principal_overdue + row.interest_overdue + row.penalty_overdue + row.charges_overdue,
+				precision,
+			)
+			rows.append(row)
+
+	insert_snapshots(rows)
+
+
+def insert_snapshots(rows):
+	now = now_datetime()
+	user = frappe.session.user
+
+	values = [
+		(
+			# a loan has one snapshot, and one per disbursement for line of credit loans
+			row.loan_disbursement or row.loan,
+			now,
+			now,
+			user,
+			user,
+			*(row.get(fieldname) for fieldname in SNAPSHOT_FIELDS),
+		)
+		for row in rows
+	]
+
+	frappe.db.bulk_insert(
+		"Loan Balance Snapshot",
+		fields=["name", "creation", "modified", "owner", "modified_by", *SNAPSHOT_FIELDS],
+		values=values,
+	)
+
+
+def get_outstanding_demand_map(loans):
+	"""Outstanding demands by component, keyed by loan and by (loan, disbursement)"""
+	loan_demand = frappe.qb.DocType("Loan Demand")
+
+	component = (
+		Case()
+		.when(loan_demand.demand_subtype == "Principal", "principal_overdue")
+		.when(loan_demand.demand_subtype == "Interest", "interest_overdue")
+		.when(loan_demand.demand_subtype.isin(["Penalty", "Additional Interest"]), "penalty_overdue")
+		.when(loan_demand.demand_type == "Charges", "charges_overdue")
+		.else_("")
+	)
+
+	demands = (
+		frappe.qb.from_(loan_demand)
+		.select(
+			loan_demand.loan,
+			loan_demand.loan_disbursement,
+			component.as_("component"),
+			Sum(loan_demand.outstanding_amount).as_("outstanding_amount"),
+			Max(loan_demand.demand_date).as_("last_demand_date"),
+			Max(
+				Case().when(loan_demand.demand_subtype == "Interest", loan_demand.demand_date)
+			).as_("due_date"),
+		)
+		.where(loan_demand.loan.isin(loans))
+		.where(loan_demand.docstatus == 1)
+		.groupby(loan_demand.loan, loan_demand.loan_disbursement, component)
+	).run(as_dict=1)
+
+	demand_map = {}
+	for demand in demands:
+		for key in (demand.loan, (demand.loan, demand.loan_disbursement)):
+			row = demand_map.setdefault(key, {})
+			if demand.component:
+				row[demand.component] = flt(row.get(demand.component)) + flt(demand.outstanding_amount)
+
+			for fieldname in ("last_demand_date", "due_date"):
+				if demand[fieldname] and (
+					not row.get(fieldname) or getdate(demand[fieldname]) > getdate(row[fieldname])
+				):
+					row[fieldname] = demand[fieldname]
+
+	return demand_map
+
+
+def get_unbooked_interest_snapshot_map(loans):
+	"""Normal interest accrued since the last interest demand and the last accrual date,
+	keyed by loan and by (loan, disbursement). A disbursement counts from its own last
+	interest demand, the loan from the last interest demand of the loan."""
+	from lending.lending.doctype.loan_repayment.utils import get_unbooked_from_query
+
+	accrual = frappe.qb.DocType("Loan Interest Accrual")
+	loan_unbooked_from = get_unbooked_from_query(loans)
+	disbursement_unbooked_from = get_unbooked_from_query(loans, by_disbursement=True)
+
+	def unbooked_interest(unbooked_from):
+		return Sum(
+			Case()
+			.when(
+				unbooked_from.unbooked_from.isnull()
+				| (accrual.posting_date >= unbooked_from.unbooked_from),
+				accrual.interest_amount,
+			)
+			.else_(0)
+		)
+
+	accruals = (
+		frappe.qb.from_(accrual)
+		.left_join(loan_unbooked_from)
+		.on(loan_unbooked_from.loan == accrual.loan)
+		.left_join(disbursement_unbooked_from)
+		.on(
+			(disbursement_unbooked_from.loan == accrual.loan)
+			& (disbursement_unbooked_from.loan_disbursement == accrual.loan_disbursement)
+		)
+		.select(
+			accrual.loan,
+			accrual.loan_disbursement,
+			unbooked_interest(loan_unbooked_from).as_("unbooked_interest"),
+			unbooked_interest(disbursement_unbooked_from).as_("disbursement_unbooked_interest"),
+			Max(accrual.posting_date).as_("last_accrual_date"),
+		)
+		.where(accrual.loan.isin(loans))
+		.where(accrual.docstatus == 1)
+		.where(accrual.interest_type == "Normal Interest")
+		.groupby(accrual.loan, accrual.loan_disbursement)
+	).run(as_dict=1)
+
+	accrual_map = {}
+	for row in accruals:
+		for key, amount in (
+			(row.loan, row.unbooked_interest),
+			((row.loan, row.loan_disbursement), row.disbursement_unbooked_interest),
+		):
+			entry = accrual_map.setdefault(key, {"unbooked_interest": 0, "last_accrual_date": None})
+			entry["unbooked_interest"] += flt(amount)
+			if not entry["last_accrual_date"] or getdate(row.last_accrual_date) > getdate(
+				entry["last_accrual_date"]
+			):
+				entry["last_accrual_date"] = row.last_accrual_date
+
+	return accrual_map
+
+
+def get_available_security_deposit_map(loans):
+	loan_security_deposit = frappe.qb.DocType("Loan Security Deposit")
+
+	return frappe._dict(
+		frappe.qb.from_(loan_security_deposit)
+		.select(
+			loan_security_deposit.loan, Coalesce(Sum(loan_security_deposit.available_amount), 0)
+		)
+		.where(loan_security_deposit.loan.isin(loans))
+		.groupby(loan_security_deposit.loan)
+		.run()
+	)
+
+
+def get_loan_balance_snapshots(loans=None, posting_date=None, filters=None):
+	"""Snapshots of `loans`, or of every loan matching `filters`, keyed by loan and by
+	(loan, disbursement) for line of credit loans.
+
+	With `posting_date` only the snapshots that hold the dues as of that date are
+	returned, loans with demands or accruals after it are left out for the caller to
+	compute."""
+	flush_stale_loan_balances()
+
+	filters = dict(filters or {})
+	if loans is not None:
+		if not loans:
+			return {}
+		filters["loan"] = ("in", loans)
+
+	snapshots = frappe.db.get_all(
+		"Loan Balance Snapshot", filters=filters, fields=list(SNAPSHOT_FIELDS)
+	)
+
+	snapshot_map = {}
+	for snapshot in snapshots:
+		if posting_date and not is_snapshot_current(snapshot, posting_date):
+			continue
+
+		key = (snapshot.loan, snapshot.loan_disbursement) if snapshot.loan_disbursement else snapshot.loan
+		snapshot_map[key] = snapshot
+
+	return snapshot_map
+
+
+def is_snapshot_current(snapshot, posting_date):
+	"""Dues as of `posting_date` read the demands till the date and the accruals before
+	it, the snapshot has them all if nothing was demanded or accrued after"""
+	posting_date = getdate(posting_date)
+
+	if snapshot.last_demand_date and getdate(snapshot.last_demand_date) > posting_date:
+		return False
+
+	if snapshot.last_accrual_date and getdate(snapshot.last_accrual_date) >= posting_date:
+		return False
+
+	return True
+
+
+def rebuild_loan_balance_snapshots(batch_size=1000):
+	"""Rebuilds the snapshots of every submitted loan, backfills the table and repairs
+	snapshots that drifted from the vouchers"""
+	from lending.utils import iter_loan_batches
+
+	loan = frappe.qb.DocType("Loan")
+	query = frappe.qb.from_(loan).select(loan.name).where(loan.docstatus == 1)
+
+	for batch in iter_loan_batches(query, batch_size):
+		refresh_loan_balance_snapshots([d.name for d in batch])
+		frappe.db.commit()  # nosemgrep
+
+
+@frappe.whitelist()
+def get_loan_balances(filters=None):
+	"""Outstanding of the loans matching `filters` from their snapshots, a row per loan
+	and per line of credit disbursement"""
+	frappe.has_permission("Loan Balance Snapshot", "read", throw=True)
+
+	return list(get_loan_balance_snapshots(filters=frappe.parse_json(filters or {})).values())
@@ -0,0 +1,63 @@
+# Copyright (c) 2026, Frappe Technologies Pvt. Ltd. and Contributors
+# See license.txt
+
+import frappe
+from frappe.tests import IntegrationTestCase
+
+from lending.lending.doctype.loan_balance_snapshot.loan_balance_snapshot import (
+	get_loan_balance_snapshots,
+)
+from lending.lending.doctype.loan_repayment.loan_repayment import calculate_amounts
+from lending.lending.doctype.process_loan_demand.process_loan_demand import (
+	process_daily_loan_demands,
+)
+from lending.tests.test_utils import (
+	create_loan,
+	create_repayment_entry,
+	init_customers,
+	init_loan_products,
+	make_loan_disbursement_entry,
+	master_init,
+)
+
+
+class TestLoanBalanceSnapshot(IntegrationTestCase):
+	def setUp(self):
+		master_init()
+		init_loan_products()
+		init_customers()
+		self.applicant = frappe.db.get_value("Customer", {"name": "_Test Loan Customer"}, "name")
+
+	def test_snapshot_matches_computed_dues(self):
+		loan = create_loan(
+			self.applicant,
+			"Term Loan Product 4",
+			1000000,
+			"Repay Over Number of Periods",
+			6,
+			applicant_type="Customer",
+			repayment_start_date="2024-05-05",
+			posting_date="2024-04-05",
+			rate_of_interest=23,
+		)
+		loan.submit()
+		make_loan_disbursement_entry(
+			loan.name,
+			loan.loan_amount,
+			disbursement_date="2024-04-05",
+			repayment_start_date="2024-05-05",
+		)
+		process_daily_loan_demands(posting_date="2024-06-05", loan=loan.name)
+
+		emi = calculate_amounts(loan.name, "2024-05-05")["payable_amount"]
+		create_repayment_entry(loan.name, "2024-05-05", emi).submit()
+
+		snapshot = get_loan_balance_snapshots([loan.name])[loan.name]
+		amounts = calculate_amounts(loan.name, snapshot.last_demand_date)
+
+		self.assertEqual(snapshot.pending_principal_amount, amounts["pending_principal_amount"])
+		self.assertEqual(snapshot.principal_overdue, amounts["payable_principal_amount"])
+		self.assertEqual(snapshot.interest_overdue, amounts["interest_amount"])
+		self.assertEqual(snapshot.total_overdue, amounts["payable_amount"])
+
+		self.assertFalse(get_loan_balance_snapshots([loan.name], posting_date="2024-05-20"))
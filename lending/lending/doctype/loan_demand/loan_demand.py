@@ -5,10 +5,19 @@ import frappe
 from frappe import _
 from frappe.utils import add_days, cint, flt, get_datetime, getdate
 
-from erpnext.accounts.general_ledger import make_gl_entries
 from erpnext.controllers.accounts_controller import AccountsController
 
-from lending.lending.doctype.loan_repayment.loan_repayment import update_installment_counts
+from lending.gl import (
+	discard_gl_entries,
+	flush_gl_entries,
+	gl_buffer_scope,
+	make_lending_gl_entries,
+)
+from lending.lending.doctype.loan_repayment.loan_repayment import (
+	update_installment_counts_for_demands,
+)
+from lending.settings import get_lending_settings, with_lending_settings
+from lending.utils import iter_loan_batches
 
 
 class LoanDemand(AccountsController):
@@ -78,6 +87,9 @@ class LoanDemand(AccountsController):
 
 		self.update_repayment_schedule()
 
+		if not frappe.flags.on_repost:
+			update_installment_counts_for_demands([self])
+
 		if (
 			not frappe.flags.on_repost
 			and self.demand_type in ("EMI", "Normal")
@@ -104,6 +116,9 @@ class LoanDemand(AccountsController):
 		self.update_repayment_schedule(cancel=1)
 		self.make_credit_note()
 
+		if not frappe.flags.on_repost:
+			update_installment_counts_for_demands([self], cancel=1)
+
 	def make_credit_note(self):
 		if not self.demand_type == "Charges":
 			return
@@ -119,17 +134,28 @@ class LoanDemand(AccountsController):
 			)
 
 	def make_gl_entries(self, cancel=0):
+		gl_entries = self.get_gl_map()
+
+		if gl_entries:
+			make_lending_gl_entries(gl_entries, cancel=cancel, merge_entries=False, adv_adj=0)
+
+	def get_gl_map(self, loan_status=None, account_details=None):
 		gl_entries = []
 
 		if self.demand_subtype == "Principal":
-			return
+			return gl_entries
 
 		if self.demand_type == "Charges":
-			return
+			return gl_entries
+
+		if not loan_status:
+			loan_status = frappe.db.get_value("Loan", self.loan, "status", cache=True)
 
-		loan_status = frappe.db.get_value("Loan", self.loan, "status", cache=True)
 		if loan_status == "Written Off":
-			return
+			return gl_entries
+
+		if not account_details:
+			account_details = get_demand_account_details(self.loan_product)
 
 		party_type = ""
 		party = ""
@@ -145,9 +171,7 @@ class LoanDemand(AccountsController):
 		elif self.demand_subtype == "Additional Interest":
 			fields = ["additional_interest_accrued", "additional_interest_receivable"]
 
-		accrual_account, receivable_account = frappe.db.get_value(
-			"Loan Product", self.loan_product, fields
-		)
+		accrual_account, receivable_account = (account_details.get(field) for field in fields)
 
 		if not accrual_account:
 			frappe.throw(
@@ -168,20 +192,19 @@ class LoanDemand(AccountsController):
 		)
 
 		if self.demand_type == "BPI":
-			receivable_account, accrual_account = frappe.db.get_value(
-				"Loan Product", self.loan_product, ["interest_receivable_account", "interest_accrued_account"]
-			)
+			receivable_account = account_details.get("interest_receivable_account")
+			accrual_account = account_details.get("interest_accrued_account")
 
 			gl_entries = self.add_gl_entries(
 				gl_entries, receivable_account, accrual_account, party_type, party
 			)
 
-		make_gl_entries(gl_entries, cancel=cancel, merge_entries=False, adv_adj=0)
+		return gl_entries
 
 	def add_gl_entries(
 		self, gl_entries, receivable_account, accrual_account, party_type=None, party=None
 	):
-		precision = cint(frappe.db.get_default("currency_precision")) or 2
+		precision = get_lending_settings().precision
 
 		if flt(self.demand_amount, precision):
 			gl_entries.append(
@@ -226,22 +249,24 @@ def make_loan_demand_for_term_loans(
 	process_loan_demand=None,
 	loan_disbursement=None,
 ):
-	precision = cint(frappe.db.get_default("currency_precision")) or 2
+	precision = get_lending_settings().precision
 
-	open_loans = get_open_loans(is_term_loan=1, loan_product=loan_product, loan=loan)
+	query = get_open_loans_query(is_term_loan=1, loan_product=loan_product, loan=loan)
 
 	if loan:
 		process_term_loan_batch(
-			open_loans, posting_date, process_loan_demand, loan_disbursement, precision
+			[d.name for d in query.run(as_dict=1)],
+			posting_date,
+			process_loan_demand,
+			loan_disbursement,
+			precision,
 		)
 	else:
 		BATCH_SIZE = 5000
-		batch_list = list(get_batches(open_loans, BATCH_SIZE))
-
-		for batch in batch_list:
+		for batch in iter_loan_batches(query, BATCH_SIZE):
 			frappe.enqueue(
 				process_term_loan_batch,
-				loans=batch,
+				loans=[d.name for d in batch],
 				posting_date=posting_date,
 				process_loan_demand=process_loan_demand,
 				loan_disbursement=loan_disbursement,
@@ -251,9 +276,12 @@ def make_loan_demand_for_term_loans(
 			)
 
 
+@with_lending_settings
 def process_term_loan_batch(
 	loans, posting_date, process_loan_demand, loan_disbursement, precision
 ):
+	from lending.lending.doctype.loan_demand.utils import make_bulk_term_loan_demands
+
 	freeze_dates = get_freeze_date_map(loans)
 
 	schedule_filters = {
@@ -268,7 +296,7 @@ def process_term_loan_batch(
 	loan_repayment_schedules = frappe.db.get_all(
 		"Loan Repayment Schedule",
 		filters=schedule_filters,
-		fields=["name", "loan", "loan_disbursement", "repayment_start_date"],
+		fields=["name", "loan", "loan_disbursement", "repayment_start_date", "posting_date"],
 	)
 
 	loan_repayment_schedule_map = frappe._dict()
@@ -306,69 +334,82 @@ def process_term_loan_batch(
 
 	emi_rows = query.run(as_dict=True)
 
-	for row in emi_rows:
-		try:
-			freeze_date = freeze_dates.get(loan_repayment_schedule_map.get(row.parent))
-			if freeze_date and getdate(freeze_date) <= getdate(row.payment_date):
-				continue
-
-			paid_amount = 0
-
-			if not row.principal_amount and getdate(row.payment_date) < getdate(
-				start_date_map.get(row.parent)
-			):
-				demand_type = "BPI"
-				paid_amount = row.interest_amount
-			else:
-				demand_type = "EMI"
-
-			if row.interest_amount:
-				create_loan_demand(
-					loan_repayment_schedule_map.get(row.parent),
-					row.payment_date,
-					demand_type,
-					"Interest",
-					flt(row.interest_amount, precision),
-					loan_repayment_schedule=row.parent,
-					loan_disbursement=disbursement_map.get(row.parent),
-					repayment_schedule_detail=row.name,
-					process_loan_demand=process_loan_demand,
-					paid_amount=paid_amount,
-					posting_date=posting_date,
-				)
-
-			if row.principal_amount:
-				create_loan_demand(
-					loan_repayment_schedule_map.get(row.parent),
-					row.payment_date,
-					demand_type,
-					"Principal",
-					flt(row.principal_amount, precision),
-					loan_repayment_schedule=row.parent,
-					loan_disbursement=disbursement_map.get(row.parent),
-					repayment_schedule_detail=row.name,
-					process_loan_demand=process_loan_demand,
-					paid_amount=paid_amount,
-					posting_date=posting_date,
-				)
-
-			update_installment_counts(loan_repayment_schedule_map.get(row.parent))
-
-			if len(loans) > 1:
-				frappe.db.commit()
-		except Exception as e:
-			if len(loans) > 1:
-				frappe.log_error(
-					title="Term Loan Demand Generation Error",
-					message=frappe.get_traceback(),
-					reference_doctype="Loan",
-					reference_name=loan_repayment_schedule_map.get(row.parent),
-				)
-			else:
-				raise e
+	if len(loans) > 1:
+		# Demands for the batch are written in bulk, rows of chunks that fail
+		# are handed back and go through the regular document flow below
+		emi_rows = make_bulk_term_loan_demands(
+			emi_rows,
+			{d.name: d for d in loan_repayment_schedules},
+			freeze_dates,
+			posting_date,
+			process_loan_demand,
+			precision,
+		)
 
-			if len(loans) > 1:
-				frappe.db.rollback()
+	with gl_buffer_scope():
+		for row in emi_rows:
+			try:
+				freeze_date = freeze_dates.get(loan_repayment_schedule_map.get(row.parent))
+				if freeze_date and getdate(freeze_date) <= getdate(row.payment_date):
+					continue
+
+				paid_amount = 0
+
+				if not row.principal_amount and getdate(row.payment_date) < getdate(
+					start_date_map.get(row.parent)
+				):
+					demand_type = "BPI"
+					paid_amount = row.interest_amount
+				else:
+					demand_type = "EMI"
+
+				if row.interest_amount:
+					create_loan_demand(
+						loan_repayment_schedule_map.get(row.parent),
+						row.payment_date,
+						demand_type,
+						"Interest",
+						flt(row.interest_amount, precision),
+						loan_repayment_schedule=row.parent,
+						loan_disbursement=disbursement_map.get(row.parent),
+						repayment_schedule_detail=row.name,
+						process_loan_demand=process_loan_demand,
+						paid_amount=paid_amount,
+						posting_date=posting_date,
+					)
+
+				if row.principal_amount:
+					create_loan_demand(
+						loan_repayment_schedule_map.get(row.parent),
+						row.payment_date,
+						demand_type,
+						"Principal",
+						flt(row.principal_amount, precision),
+						loan_repayment_schedule=row.parent,
+						loan_disbursement=disbursement_map.get(row.parent),
+						repayment_schedule_detail=row.name,
+						process_loan_demand=process_loan_demand,
+						paid_amount=paid_amount,
+						posting_date=posting_date,
+					)
+
+				if len(loans) > 1:
+					flush_gl_entries()
+					frappe.db.commit()
+			except Exception as e:
+				if len(loans) > 1:
+					frappe.log_error(
+						title="Term Loan Demand Generation Error",
+						message=frappe.get_traceback(),
+						reference_doctype="Loan",
+						reference_name=loan_repayment_schedule_map.get(row.parent),
+					)
+				else:
+					raise e
+
+				if len(loans) > 1:
+					frappe.db.rollback()
+					discard_gl_entries()
 
 
 def make_loan_demand_for_demand_loans(
@@ -377,18 +418,18 @@ def make_loan_demand_for_demand_loans(
 	loan=None,
 	process_loan_demand=None,
 ):
-	open_loans = get_open_loans(is_term_loan=0, loan_product=loan_product, loan=loan)
+	query = get_open_loans_query(is_term_loan=0, loan_product=loan_product, loan=loan)
 
 	if loan:
-		process_demand_loan_batch(open_loans, posting_date, process_loan_demand)
+		process_demand_loan_batch(
+			[d.name for d in query.run(as_dict=1)], posting_date, process_loan_demand
+		)
 	else:
 		BATCH_SIZE = 5000
-		batch_list = list(get_batches(open_loans, BATCH_SIZE))
-
-		for batch in batch_list:
+		for batch in iter_loan_batches(query, BATCH_SIZE):
 			frappe.enqueue(
 				process_demand_loan_batch,
-				loans=batch,
+				loans=[d.name for d in batch],
 				posting_date=posting_date,
 				process_loan_demand=process_loan_demand,
 				queue="long",
@@ -396,17 +437,19 @@ def make_loan_demand_for_demand_loans(
 			)
 
 
+@with_lending_settings
 def process_demand_loan_batch(loans, posting_date, process_loan_demand):
-	for loan in loans:
-		try:
-			make_loan_demand_for_demand_loan(posting_date, loan, process_loan_demand)
-		except Exception as e:
-			frappe.log_error(
-				title="Demand Loan Demand Generation Error",
-				message=frappe.get_traceback(),
-				reference_doctype="Loan",
-				reference_name=loan,
-			)
+	with gl_buffer_scope():
+		for loan in loans:
+			try:
+				make_loan_demand_for_demand_loan(posting_date, loan, process_loan_demand)
+			except Exception as e:
+				frappe.log_error(
+					title="Demand Loan Demand Generation Error",
+					message=frappe.get_traceback(),
+					reference_doctype="Loan",
+					reference_name=loan,
+				)
 
 
 def make_loan_demand_for_demand_loan(posting_date, loan, process_loan_demand):
@@ -454,37 +497,32 @@ def make_loan_demand_for_demand_loan(posting_date, loan, process_loan_demand):
 	)
 
 
-def get_batches(open_loans, batch_size):
-	for i in range(0, len(open_loans), batch_size):
-		yield open_loans[i : i + batch_size]
+def get_open_loans_query(is_term_loan, loan_product=None, loan=None):
+	loan_doc = frappe.qb.DocType("Loan")
 
-
-def get_open_loans(is_term_loan, loan_product=None, loan=None):
-	filters = {
-		"docstatus": 1,
-		"status": ("in", ("Disbursed", "Partially Disbursed", "Active")),
-		"is_term_loan": is_term_loan,
-	}
-
-	or_filters = {}
+	query = (
+		frappe.qb.from_(loan_doc)
+		.select(loan_doc.name)
+		.where(loan_doc.docstatus == 1)
+		.where(loan_doc.status.isin(["Disbursed", "Partially Disbursed", "Active"]))
+		.where(loan_doc.is_term_loan == is_term_loan)
+	)
 
 	if is_term_loan:
-		or_filters = {
-			"excess_amount_paid": ("<=", 0),
-			"repayment_schedule_type": "Line of Credit",
-		}
+		query = query.where(
+			(loan_doc.excess_amount_paid <= 0) | (loan_doc.repayment_schedule_type == "Line of Credit")
+		)
 
 	if loan_product:
-		filters["loan_product"] = loan_product
+		query = query.where(loan_doc.loan_product == loan_product)
 
 	if loan:
-		filters["name"] = loan
+		query = query.where(loan_doc.name == loan)
 
-	return frappe.db.get_all(
-		"Loan", filters=filters, or_filters=or_filters, pluck="name", order_by="applicant"
-	)
+	return query
 
 
+@with_lending_settings
 def create_loan_demand(
 	loan,
 	demand_date,
@@ -500,7 +538,7 @@ def create_loan_demand(
 	posting_date=None,
 	loan_repayment=None,
 ):
-	precision = cint(frappe.db.get_default("currency_precision")) or 2
+	precision = get_lending_settings().precision
 	if amount:
 		demand = frappe.new_doc("Loan Demand")
 		demand.loan = loan
@@ -520,6 +558,23 @@ def create_loan_demand(
 		demand.submit()
 
 
+def get_demand_account_details(loan_product):
+	return frappe.db.get_value(
+		"Loan Product",
+		loan_product,
+		[
+			"interest_receivable_account",
+			"broken_period_interest_recovery_account",
+			"interest_accrued_account",
+			"penalty_accrued_account",
+			"penalty_receivable_account",
+			"additional_interest_accrued",
+			"additional_interest_receivable",
+		],
+		as_dict=1,
+	)
+
+
 def reverse_demands(
 	loan,
 	posting_date,
@@ -1,9 +1,199 @@
 # Copyright (c) 2023, Frappe Technologies Pvt. Ltd. and Contributors
 # See license.txt
 
-# import frappe
+import frappe
 from frappe.tests.utils import FrappeTestCase
 
+from lending.gl import gl_buffer_scope
+from lending.lending.doctype.loan_demand.loan_demand import process_term_loan_batch
+from lending.lending.doctype.loan_repayment.loan_repayment import rebuild_installment_counts
+from lending.lending.doctype.process_loan_demand.process_loan_demand import (
+	process_daily_loan_demands,
+)
+from lending.tests.test_utils import (
+	create_loan,
+	init_customers,
+	init_loan_products,
+	make_loan_disbursement_entry,
+	master_init,
+)
+
 
 class TestLoanDemand(FrappeTestCase):
-	pass
+	def setUp(self):
+		master_init()
+		init_loan_products()
+		init_customers()
+		self.applicant = frappe.db.get_value("Customer", {"name": "_Test Loan Customer"}, "name")
+
+	def test_bulk_term_loan_demands(self):
+		loans = []
+		for _i in range(2):
+			loan = create_loan(
+				self.applicant,
+				"Term Loan Product 4",
+				1000000,
+				"Repay Over Number of Periods",
+				6,
+				applicant_type="Customer",
+				repayment_start_date="2024-05-05",
+				posting_date="2024-04-05",
+				rate_of_interest=23,
+			)
+			loan.submit()
+			make_loan_disbursement_entry(
+				loan.name,
+				loan.loan_amount,
+				disbursement_date="2024-04-05",
+				repayment_start_date="2024-05-05",
+			)
+			loans.append(loan.name)
+
+		process_term_loan_batch(loans, "2024-07-05", None, None, 2)
+
+		for loan in loans:
+			schedule = frappe.db.get_value(
+				"Loan Repayment Schedule", {"loan": loan, "docstatus": 1, "status": "Active"}
+			)
+			generated_rows = frappe.get_all(
+				"Repayment Schedule",
+				{"parent": schedule, "demand_generated": 1},
+				["name", "interest_amount", "principal_amount"],
+			)
+			demands = frappe.get_all(
+				"Loan Demand",
+				{"loan": loan, "docstatus": 1, "demand_type": "EMI"},
+				["repayment_schedule_detail", "demand_subtype", "demand_amount", "outstanding_amount"],
+			)
+
+			self.assertEqual(len(generated_rows), 3)
+			self.assertEqual(len(demands), 6)
+			self.assertEqual(
+				sum(d.demand_amount for d in demands),
+				sum(row.interest_amount + row.principal_amount for row in generated_rows),
+			)
+
+			gl_entries = frappe.get_all(
+				"GL Entry",
+				{"voucher_type": "Loan Demand", "against_voucher": loan, "is_cancelled": 0},
+				["sum(debit) as debit", "sum(credit) as credit"],
+			)
+			self.assertEqual(gl_entries[0].debit, gl_entries[0].credit)
+			self.assertEqual(
+				frappe.db.get_value(
+					"Loan Repayment Schedule",
+					schedule,
+					["total_installments_raised", "total_installments_paid", "total_installments_overdue"],
+				),
+				(3, 0, 3),
+			)
+
+		frappe.db.set_value(
+			"Loan Repayment Schedule",
+			{"loan": loans[0], "docstatus": 1, "status": "Active"},
+			{"total_installments_raised": 7, "total_installments_overdue": 1},
+		)
+		rebuild_installment_counts(loans)
+
+		self.assertEqual(
+			frappe.db.get_value(
+				"Loan Repayment Schedule",
+				{"loan": loans[0], "docstatus": 1, "status": "Active"},
+				["total_installments_raised", "total_installments_paid", "total_installments_overdue"],
+			),
+			(3, 0, 3),
+		)
+
+	def test_installment_counts_per_disbursement(self):
+		loan = create_loan(
+			"_Test Customer 1",
+			"Term Loan Product 5",
+			500000,
+			"Repay Over Number of Periods",
+			1,
+			posting_date="2024-10-17",
+			rate_of_interest=17,
+			applicant_type="Customer",
+			limit_applicable_start="2024-10-16",
+			limit_applicable_end="2026-10-16",
+		)
+		loan.submit()
+
+		for amount, repayment_start_date in ((171000, "2024-12-05"), (200000, "2025-01-05")):
+			make_loan_disbursement_entry(
+				loan.name,
+				amount,
+				disbursement_date="2024-11-05",
+				repayment_start_date=repayment_start_date,
+			).submit()
+
+		process_daily_loan_demands(posting_date="2025-01-05", loan=loan.name)
+
+		def get_counts():
+			return {
+				d.loan_disbursement: (
+					d.total_installments_raised,
+					d.total_installments_paid,
+					d.total_installments_overdue,
+				)
+				for d in frappe.get_all(
+					"Loan Repayment Schedule",
+					filters={"loan": loan.name, "docstatus": 1, "status": "Active"},
+					fields=[
+						"loan_disbursement",
+						"total_installments_raised",
+						"total_installments_paid",
+						"total_installments_overdue",
+					],
+				)
+			}
+
+		# each disbursement counts its own installments, as a recount does
+		counts = get_counts()
+		self.assertEqual(len(counts), 2)
+		self.assertTrue(all(count[0] for count in counts.values()))
+
+		rebuild_installment_counts([loan.name])
+		self.assertEqual(get_counts(), counts)
+
+	def test_buffered_gl_entries(self):
+		loan = create_loan(
+			self.applicant,
+			"Term Loan Product 4",
+			1000000,
+			"Repay Over Number of Periods",
+			6,
+			applicant_type="Customer",
+			repayment_start_date="2024-05-05",
+			posting_date="2024-04-05",
+			rate_of_interest=23,
+		)
+		loan.submit()
+		make_loan_disbursement_entry(
+			loan.name,
+			loan.loan_amount,
+			disbursement_date="2024-04-05",
+			repayment_start_date="2024-05-05",
+		)
+
+		with gl_buffer_scope():
+			process_daily_loan_demands(posting_date="2024-06-05", loan=loan.name)
+			demands = frappe.get_all(
+				"Loan Demand", {"loan": loan.name, "docstatus": 1, "demand_subtype": "Interest"}, pluck="name"
+			)
+			self.assertTrue(demands)
+			self.assertFalse(
+				frappe.db.exists("GL Entry", {"voucher_type": "Loan Demand", "voucher_no": ("in", demands)})
+			)
+
+		for demand in demands:
+			gl_map = frappe.get_doc("Loan Demand", demand).get_gl_map()
+			gl_entries = frappe.get_all(
+				"GL Entry",
+				{"voucher_type": "Loan Demand", "voucher_no": demand, "is_cancelled": 0},
+				["account", "debit", "credit"],
+			)
+			self.assertEqual(
+				sorted((d.account, d.debit, d.credit) for d in gl_entries),
+				sorted((d.account, d.debit, d.credit) for d in gl_map),
+			)
@@ -0,0 +1,215 @@
+import frappe
+from frappe.utils import add_days, flt, getdate
+
+from lending.gl import (
+	discard_gl_entries,
+	flush_gl_entries,
+	gl_buffer_scope,
+	make_lending_gl_entries,
+)
+from lending.lending.doctype.loan_balance_snapshot.loan_balance_snapshot import (
+	mark_loan_balances_stale,
+)
+from lending.utils import bulk_insert_documents
+
+
+def make_bulk_term_loan_demands(
+	emi_rows,
+	schedule_map,
+	freeze_dates,
+	posting_date,
+	process_loan_demand,
+	precision,
+	chunk_size=500,
+):
+	"""Set based counterpart of the per row loop in `process_term_loan_batch`.
+
+	Loan Demands and their GL entries are built in memory and written with multi row
+	inserts, one transaction per chunk of loans. Returns the rows of the chunks that
+	could not be written so they can go through the regular document flow."""
+	rows_by_loan = {}
+	for row in emi_rows:
+		loan = schedule_map[row.parent].loan
+		freeze_date = freeze_dates.get(loan)
+		if freeze_date and getdate(freeze_date) <= getdate(row.payment_date):
+			continue
+
+		rows_by_loan.setdefault(loan, []).append(row)
+
+	loans = list(rows_by_loan)
+	fallback_rows = []
+
+	for i in range(0, len(loans), chunk_size):
+		chunk = loans[i : i + chunk_size]
+		chunk_rows = [row for loan in chunk for row in rows_by_loan[loan]]
+
+		try:
+			with gl_buffer_scope():
+				write_term_loan_demands(
+					chunk, chunk_rows, schedule_map, posting_date, process_loan_demand, precision
+				)
+				flush_gl_entries()
+			frappe.db.commit()
+		except Exception:
+			frappe.db.rollback()
+			discard_gl_entries()
+			frappe.log_error(
+				title="Bulk Term Loan Demand Generation Error",
+				message=frappe.get_traceback(),
+			)
+			fallback_rows.extend(chunk_rows)
+
+	return fallback_rows
+
+
+def write_term_loan_demands(
+	loans, emi_rows, schedule_map, posting_date, process_loan_demand, precision
+):
+	from lending.lending.doctype.loan_demand.loan_demand import get_demand_account_details
+	from lending.lending.doctype.loan_repayment.loan_repayment import (
+		update_installment_counts_for_demands,
+	)
+	from lending.lending.doctype.process_loan_interest_accrual.process_loan_interest_accrual import (
+		process_loan_interest_accrual_for_loans,
+	)
+
+	loan_map = get_loan_details_map(loans)
+	partner_share_map = get_partner_share_map(
+		[row.parent for row in emi_rows if loan_map[schedule_map[row.parent].loan].loan_partner]
+	)
+
+	docs = []
+	for row in emi_rows:
+		schedule = schedule_map[row.parent]
+		loan = loan_map[schedule.loan]
+		paid_amount = 0
+
+		if not row.principal_amount and getdate(row.payment_date) < getdate(
+			schedule.repayment_start_date
+		):
+			demand_type = "BPI"
+			paid_amount = row.interest_amount
+		else:
+			demand_type = "EMI"
+
+		for demand_subtype, amount in (
+			("Interest", row.interest_amount),
+			("Principal", row.principal_amount),
+		):
+			amount = flt(amount, precision)
+			if not amount:
+				continue
+
+			doc = frappe.new_doc("Loan Demand")
+			doc.update(
+				{
+					"loan": loan.name,
+					"loan_repayment_schedule": row.parent,
+					"loan_disbursement": schedule.loan_disbursement,
+					"repayment_schedule_detail": row.name,
+					"demand_date": row.payment_date,
+					"posting_date": getdate(),
+					"demand_type": demand_type,
+					"demand_subtype": demand_subtype,
+					"demand_amount": amount,
+					"paid_amount": paid_amount,
+					"outstanding_amount": amount - flt(paid_amount),
+					"partner_share_allocated": 0,
+					"process_loan_demand": process_loan_demand,
+					"loan_product": loan.loan_product,
+					"applicant_type": loan.applicant_type,
+					"applicant": loan.applicant,
+					"company": loan.company,
+					"cost_center": loan.cost_center,
+					"is_term_loan": loan.is_term_loan,
+					"loan_partner": loan.loan_partner,
+					"disbursement_date": schedule.posting_date,
+					"docstatus": 1,
+				}
+			)
+
+			# Same as the `validate` hook, partner share comes from the co-lender schedule
+			if loan.loan_partner and demand_type == "EMI":
+				partner_share = partner_share_map.get((row.parent, getdate(row.payment_date)), {})
+				doc.partner_share = partner_share.get(
+					"principal_amount" if demand_subtype == "Principal" else "interest_amount"
+				)
+
+			docs.append(doc)
+
+	if not docs:
+		return docs
+
+	bulk_insert_documents(docs)
+	# inserted without the document hooks that keep the balance snapshot current
+	mark_loan_balances_stale({doc.loan for doc in docs})
+
+	account_details_map = {}
+	for doc in docs:
+		if doc.loan_product not in account_details_map:
+			account_details_map[doc.loan_product] = get_demand_account_details(doc.loan_product)
+
+		gl_entries = doc.get_gl_map(
+			loan_status=loan_map[doc.loan].status,
+			account_details=account_details_map[doc.loan_product],
+		)
+		if gl_entries:
+			make_lending_gl_entries(gl_entries, merge_entries=False)
+
+	repayment_schedule = frappe.qb.DocType("Repayment Schedule")
+	frappe.qb.update(repayment_schedule).set(repayment_schedule.demand_generated, 1).where(
+		repayment_schedule.name.isin(list({doc.repayment_schedule_detail for doc in docs}))
+	).run()
+
+	update_installment_counts_for_demands(docs)
+
+	# Same as `on_submit`, interest demands of a demand process accrue interest till the
+	# day before the demand date
+	if not frappe.flags.on_repost and process_loan_demand:
+		for doc in docs:
+			if doc.demand_type in ("EMI", "Normal") and doc.demand_subtype == "Interest":
+				process_loan_interest_accrual_for_loans(
+					posting_date=add_days(doc.demand_date, -1),
+					loan=doc.loan,
+					company=doc.company,
+					from_demand=True,
+					loan_disbursement=doc.loan_disbursement,
+				)
+
+	return docs
+
+
+def get_loan_details_map(loans):
+	return frappe._dict(
+		(d.name, d)
+		for d in frappe.db.get_all(
+			"Loan",
+			filters={"name": ("in", loans)},
+			fields=[
+				"name",
+				"loan_product",
+				"applicant_type",
+				"applicant",
+				"company",
+				"cost_center",
+				"is_term_loan",
+				"loan_partner",
+				"status",
+			],
+		)
+	)
+
+
+def get_partner_share_map(loan_repayment_schedules):
+	partner_share_map = {}
+	if not loan_repayment_schedules:
+		return partner_share_map
+
+	for row in frappe.db.get_all(
+		"Co-Lender Schedule",
+		filters={"parent": ("in", list(set(loan_repayment_schedules)))},
+		fields=["parent", "payment_date", "principal_amount", "interest_amount"],
+	):
+		partner_share_map.setdefault((row.parent, getdate(row.payment_date)), row)
+
+	return partner_share_map
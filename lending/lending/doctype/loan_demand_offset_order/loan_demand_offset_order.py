@@ -4,6 +4,8 @@
 # import frappe
 from frappe.model.document import Document
 
+from lending.settings import invalidate_lending_settings
+
 
 class LoanDemandOffsetOrder(Document):
 	# begin: auto-generated types
@@ -22,4 +24,5 @@ class LoanDemandOffsetOrder(Document):
 		title: DF.Data | None
 	# end: auto-generated types
 
-	pass
+	def on_update(self):
+		invalidate_lending_settings(self)
@@ -17,10 +17,11 @@ from frappe.utils import (
 )
 
 import erpnext
-from erpnext.accounts.general_ledger import make_gl_entries, process_gl_map
+from erpnext.accounts.general_ledger import process_gl_map
 from erpnext.controllers.accounts_controller import AccountsController
 from erpnext.controllers.sales_and_purchase_return import make_return_doc
 
+from lending.gl import make_lending_gl_entries
 from lending.lending.doctype.loan.loan import get_cyclic_date
 from lending.lending.doctype.loan_limit_change_log.loan_limit_change_log import (
 	create_loan_limit_change_log,
@@ -734,7 +735,7 @@ class LoanDisbursement(AccountsController):
 			if cancel:
 				gle_map = process_gl_map(gle_map)
 
-			make_gl_entries(gle_map, cancel=cancel, adv_adj=adv_adj)
+			make_lending_gl_entries(gle_map, cancel=cancel, adv_adj=adv_adj)
 
 
 def make_sales_invoice_for_charge(
@@ -1,6 +1,7 @@
 # Copyright (c) 2019, Frappe Technologies Pvt. Ltd. and contributors
 # For license information, please see license.txt
 
+from bisect import bisect_left, bisect_right
 
 import frappe
 from frappe import _
@@ -8,7 +9,6 @@ from frappe.query_builder.functions import Cast
 from frappe.utils import (
 	add_days,
 	add_months,
-	cint,
 	date_diff,
 	flt,
 	get_datetime,
@@ -18,11 +18,17 @@ from frappe.utils import (
 	nowdate,
 )
 
-from erpnext.accounts.general_ledger import make_gl_entries
 from erpnext.controllers.accounts_controller import AccountsController
 
+from lending.gl import (
+	discard_gl_entries,
+	flush_gl_entries,
+	gl_buffer_scope,
+	make_lending_gl_entries,
+)
 from lending.lending.doctype.loan_demand.loan_demand import create_loan_demand
-from lending.utils import daterange
+from lending.settings import get_lending_settings, with_lending_settings
+from lending.utils import iter_loan_batches
 
 
 class LoanInterestAccrual(AccountsController):
@@ -160,9 +166,16 @@ class LoanInterestAccrual(AccountsController):
 		self.ignore_linked_doctypes = ["GL Entry", "Payment Ledger Entry"]
 
 	def make_gl_entries(self, cancel=0, adv_adj=0):
+		gle_map = self.get_gl_map()
+
+		if gle_map:
+			make_lending_gl_entries(gle_map, cancel=cancel, adv_adj=adv_adj, merge_entries=False)
+
+	def get_gl_map(self, loan_status=None, cost_center=None, account_details=None):
 		gle_map = []
 
-		loan_status = frappe.db.get_value("Loan", self.loan, "status")
+		if not loan_status:
+			loan_status = frappe.db.get_value("Loan", self.loan, "status")
 
 		if loan_status == "Written Off":
 			write_off_date = frappe.db.get_value(
@@ -173,24 +186,15 @@ class LoanInterestAccrual(AccountsController):
 			)
 
 			if write_off_date and getdate(self.posting_date) >= write_off_date:
-				return
-
-		precision = cint(frappe.db.get_default("currency_precision")) or 2
-
-		cost_center = frappe.db.get_value("Loan", self.loan, "cost_center")
-		account_details = frappe.db.get_value(
-			"Loan Product",
-			self.loan_product,
-			[
-				"interest_accrued_account",
-				"interest_income_account",
-				"penalty_accrued_account",
-				"penalty_income_account",
-				"additional_interest_income",
-				"additional_interest_accrued",
-			],
-			as_dict=1,
-		)
+				return gle_map
+
+		precision = get_lending_settings().precision
+
+		if not cost_center:
+			cost_center = frappe.db.get_value("Loan", self.loan, "cost_center")
+
+		if not account_details:
+			account_details = get_accrual_account_details(self.loan_product)
 
 		if self.interest_type == "Normal Interest":
 			receivable_account = account_details.interest_accrued_account
@@ -310,8 +314,23 @@ class LoanInterestAccrual(AccountsController):
 				)
 			)
 
-		if gle_map:
-			make_gl_entries(gle_map, cancel=cancel, adv_adj=adv_adj, merge_entries=False)
+		return gle_map
+
+
+def get_accrual_account_details(loan_product):
+	return frappe.db.get_value(
+		"Loan Product",
+		loan_product,
+		[
+			"interest_accrued_account",
+			"interest_income_account",
+			"penalty_accrued_account",
+			"penalty_income_account",
+			"additional_interest_income",
+			"additional_interest_accrued",
+		],
+		as_dict=1,
+	)
 
 
 # For Eg: If Loan disbursement date is '01-09-2019' and disbursed amount is 1000000 and
@@ -327,6 +346,7 @@ def calculate_accrual_amount_for_loans(
 	loan_disbursement=None,
 	loan_accrual_frequency=None,
 ):
+	from lending.lending.doctype.loan_interest_accrual.utils import get_term_loan_accrual_context
 	from lending.lending.doctype.loan_repayment.loan_repayment import (
 		get_pending_principal_amount,
 	)
@@ -337,14 +357,18 @@ def calculate_accrual_amount_for_loans(
 	total_payable_interest = 0
 
 	if loan_accrual_frequency == None:
-		loan_accrual_frequency = frappe.db.get_value("Company", loan.company, "loan_accrual_frequency")
+		loan_accrual_frequency = (
+			get_lending_settings().get_company(loan.company).loan_accrual_frequency
+		)
 
 	if loan.is_term_loan:
+		accrual_context = get_term_loan_accrual_context([loan.name], for_update=True)
 		parent_wise_schedules, last_accrual_date_map = get_overlapping_dates(
 			loan.name,
 			posting_date,
 			loan_accrual_frequency,
 			loan_disbursement=loan_disbursement,
+			accrual_context=accrual_context,
 		)
 
 		total_payable_interest = process_loan_interest_accrual_per_schedule(
@@ -354,6 +378,7 @@ def calculate_accrual_amount_for_loans(
 			is_future_accrual=is_future_accrual,
 			process_loan_interest=process_loan_interest,
 			accrual_type=accrual_type,
+			accrual_context=accrual_context,
 		)
 	else:
 		last_accrual_date = get_last_accrual_date(
@@ -364,7 +389,9 @@ def calculate_accrual_amount_for_loans(
 		if no_of_days <= 0:
 			return
 
-		pending_principal_amount = get_pending_principal_amount(loan)
+		pending_principal_amount = get_pending_principal_amount(
+			loan, loan_disbursement=loan_disbursement
+		)
 
 		payable_interest = get_interest_amount(
 			no_of_days,
@@ -426,14 +453,23 @@ def process_loan_interest_accrual_per_schedule(
 	is_future_accrual=False,
 	process_loan_interest=None,
 	accrual_type=None,
+	accrual_context=None,
 ):
-	precision = cint(frappe.db.get_default("currency_precision")) or 2
+	from lending.lending.doctype.loan_interest_accrual.utils import (
+		get_principal_as_of,
+		get_term_loan_accrual_context,
+	)
+
+	precision = get_lending_settings().precision
 	total_payable_interest = 0
 
+	if not accrual_context:
+		accrual_context = get_term_loan_accrual_context([loan.name])
+
 	for parent in parent_wise_schedules:
 		for payment_date in parent_wise_schedules[parent]:
 			last_accrual_date_for_schedule = last_accrual_date_map.get(parent)
-			pending_principal_amount = get_principal_amount_for_term_loan(parent, payment_date)
+			pending_principal_amount = get_principal_as_of(accrual_context, parent, payment_date)
 			payable_interest = get_interest_for_term(
 				loan.company,
 				loan.rate_of_interest,
@@ -509,7 +545,7 @@ def make_loan_interest_accrual_entry(
 	loan_repayment_schedule_detail=None,
 	loan_disbursement=None,
 ):
-	precision = cint(frappe.db.get_default("currency_precision")) or 2
+	precision = get_lending_settings().precision
 	if flt(interest_amount, precision) > 0:
 		loan_interest_accrual = frappe.new_doc("Loan Interest Accrual")
 		loan_interest_accrual.loan = loan
@@ -532,9 +568,15 @@ def make_loan_interest_accrual_entry(
 		loan_interest_accrual.submit()
 
 
-def get_overlapping_dates(loan, posting_date, loan_accrual_frequency, loan_disbursement=None):
+def get_overlapping_dates(
+	loan, posting_date, loan_accrual_frequency, loan_disbursement=None, accrual_context=None
+):
 	parent_wise_schedules, maturity_map, accrual_schedule_map = get_parent_wise_dates(
-		loan, posting_date, loan_accrual_frequency, loan_disbursement=loan_disbursement
+		loan,
+		posting_date,
+		loan_accrual_frequency,
+		loan_disbursement=loan_disbursement,
+		accrual_context=accrual_context,
 	)
 
 	# Merge accrual_frequency_breaks into repayment_schedule breaks and get all unique dates
@@ -558,22 +600,6 @@ def get_overlapping_dates(loan, posting_date, loan_accrual_frequency, loan_disbu
 	return parent_wise_schedules, accrual_schedule_map
 
 
-def get_principal_amount_for_term_loan(repayment_schedule, date):
-	principal_amount = frappe.db.get_value(
-		"Repayment Schedule",
-		{"parent": repayment_schedule, "payment_date": ("<=", date)},
-		"balance_loan_amount",
-		order_by="payment_date DESC",
-	)
-
-	if not principal_amount:
-		principal_amount = frappe.db.get_value(
-			"Loan Repayment Schedule", repayment_schedule, "current_principal_amount", cache=True
-		)
-
-	return principal_amount
-
-
 def get_term_loan_payment_date(loan_repayment_schedule, date):
 	payment_date = frappe.db.get_value(
 		"Repayment Schedule",
@@ -592,134 +618,139 @@ def calculate_penal_interest_for_loans(
 	is_future_accrual=0,
 	loan_disbursement=None,
 ):
+	from lending.lending.doctype.loan_interest_accrual.utils import (
+		get_last_penal_accrual_date_map,
+		get_penal_interest_entries,
+		get_penal_interest_plan,
+		get_principal_outstanding_map,
+	)
 	from lending.lending.doctype.loan_repayment.loan_repayment import get_unpaid_demands
 
-	precision = cint(frappe.db.get_default("currency_precision")) or 2
+	settings = get_lending_settings()
+	precision = settings.precision
 
 	loan_product = loan.loan_product
 	freeze_date = loan.freeze_date
 	loan_status = loan.status
 	penal_interest_rate = loan.penalty_charges_rate
 
+	product_settings = settings.get_loan_product(loan_product)
+
 	if not penal_interest_rate:
-		penal_interest_rate = frappe.get_value(
-			"Loan Product", loan_product, "penalty_interest_rate", cache=True
-		)
+		penal_interest_rate = product_settings.penalty_interest_rate
 
 	if flt(penal_interest_rate, precision) <= 0:
 		return 0
 
 	demands = get_unpaid_demands(loan.name, posting_date, emi_wise=True)
 
-	grace_period_days = cint(
-		frappe.get_value("Loan Product", loan_product, "grace_period_in_days", cache=True)
-	)
-	total_penal_interest = 0
+	grace_period_days = product_settings.grace_period_in_days
+	consolidate = product_settings.consolidate_penal_interest
 
 	if freeze_date and getdate(freeze_date) < getdate(posting_date):
 		posting_date = freeze_date
 
-	for demand in demands:
-		penal_interest_amount = 0
-		additional_interest = 0
-		on_migrate = False
+	demands = [
+		demand
+		for demand in demands
+		if getdate(posting_date) >= add_days(getdate(demand.demand_date), grace_period_days)
+	]
 
-		if getdate(posting_date) >= add_days(getdate(demand.demand_date), grace_period_days):
-			last_accrual_date = get_last_accrual_date(
-				loan.name,
-				posting_date,
-				"Penal Interest",
-				repayment_schedule_detail=demand.repayment_schedule_detail,
-				loan_disbursement=loan_disbursement,
-			)
+	principal_map = get_principal_outstanding_map(
+		[loan.name], [demand.repayment_schedule_detail for demand in demands]
+	)
+	last_accrual_date_map = get_last_penal_accrual_date_map(
+		[loan.name], demands, loan_disbursement=loan_disbursement
+	)
 
-			if not last_accrual_date:
-				last_accrual_date = get_last_accrual_date(
-					loan.name,
-					posting_date,
-					"Penal Interest",
-					demand=demand.name,
-				)
-				on_migrate = True
-
-			if not last_accrual_date:
-				from_date = demand.demand_date
-			elif on_migrate:
-				from_date = last_accrual_date
-				if getdate(from_date) <= getdate(demand.demand_date):
-					from_date = demand.demand_date
-			else:
-				from_date = add_days(last_accrual_date, 1)
+	penal_interest_plan = get_penal_interest_plan(
+		loan,
+		demands,
+		posting_date,
+		principal_map,
+		last_accrual_date_map,
+		penal_interest_rate,
+		precision,
+		with_segments=not is_future_accrual,
+	)
 
-			for current_date in daterange(getdate(from_date), getdate(posting_date)):
+	if is_future_accrual:
+		return sum(plan.penal_interest_amount * plan.no_of_days for plan in penal_interest_plan)
 
-				penal_interest_amount = flt(demand.pending_amount) * penal_interest_rate / 36500
+	for plan in penal_interest_plan:
+		for entry in get_penal_interest_entries(plan, consolidate):
+			make_penal_interest_entries(
+				loan.name,
+				plan.demand,
+				entry.penal_interest_amount,
+				entry.additional_interest,
+				entry.penalty_amount,
+				entry.start_date,
+				entry.posting_date,
+				process_loan_interest,
+				accrual_type,
+				penal_interest_rate,
+				loan_status,
+			)
 
-				if flt(penal_interest_amount, precision) > 0:
-					total_penal_interest += penal_interest_amount
 
-					principal_amount = frappe.db.get_value(
-						"Loan Demand",
-						{
-							"loan": loan.name,
-							"repayment_schedule_detail": demand.repayment_schedule_detail,
-							"demand_type": "EMI",
-							"demand_subtype": "Principal",
-						},
-						"outstanding_amount",
-					)
+def make_penal_interest_entries(
+	loan,
+	demand,
+	penal_interest_amount,
+	additional_interest,
+	penalty_amount,
+	start_date,
+	posting_date,
+	process_loan_interest,
+	accrual_type,
+	penal_interest_rate,
+	loan_status,
+):
+	"""Books the penal interest accrual of an overdue demand along with the penalty and
+	additional interest demands raised the day after"""
+	precision = get_lending_settings().precision
+
+	make_loan_interest_accrual_entry(
+		loan,
+		demand.pending_amount,
+		penal_interest_amount,
+		process_loan_interest,
+		start_date,
+		posting_date,
+		accrual_type,
+		"Penal Interest",
+		penal_interest_rate,
+		loan_demand=demand.name,
+		additional_interest=additional_interest,
+		loan_disbursement=demand.loan_disbursement,
+		loan_repayment_schedule_detail=demand.repayment_schedule_detail,
+	)
 
-					if not principal_amount:
-						continue
+	if loan_status == "Written Off":
+		return
 
-					per_day_interest = get_per_day_interest(
-						principal_amount, loan.rate_of_interest, loan.company, current_date
-					)
-					additional_interest = flt(per_day_interest, precision)
-
-					if not is_future_accrual:
-						if flt(penal_interest_amount, precision) > 0:
-							make_loan_interest_accrual_entry(
-								loan.name,
-								demand.pending_amount,
-								penal_interest_amount,
-								process_loan_interest,
-								current_date,
-								current_date,
-								accrual_type,
-								"Penal Interest",
-								penal_interest_rate,
-								loan_demand=demand.name,
-								additional_interest=additional_interest,
-								loan_disbursement=demand.loan_disbursement,
-								loan_repayment_schedule_detail=demand.repayment_schedule_detail,
-							)
-
-						if loan_status != "Written Off":
-							if penal_interest_amount > additional_interest:
-								create_loan_demand(
-									loan.name,
-									add_days(current_date, 1),
-									"Penalty",
-									"Penalty",
-									penal_interest_amount - additional_interest,
-									loan_repayment_schedule=demand.loan_repayment_schedule,
-									loan_disbursement=demand.loan_disbursement,
-								)
-
-							if flt(additional_interest, precision) > 0:
-								create_loan_demand(
-									loan.name,
-									add_days(current_date, 1),
-									"Additional Interest",
-									"Additional Interest",
-									additional_interest,
-									loan_repayment_schedule=demand.loan_repayment_schedule,
-									loan_disbursement=demand.loan_disbursement,
-								)
+	if penalty_amount > 0:
+		create_loan_demand(
+			loan,
+			add_days(posting_date, 1),
+			"Penalty",
+			"Penalty",
+			penalty_amount,
+			loan_repayment_schedule=demand.loan_repayment_schedule,
+			loan_disbursement=demand.loan_disbursement,
+		)
 
-	if is_future_accrual:
-		return total_penal_interest
+	if flt(additional_interest, precision) > 0:
+		create_loan_demand(
+			loan,
+			add_days(posting_date, 1),
+			"Additional Interest",
+			"Additional Interest",
+			additional_interest,
+			loan_repayment_schedule=demand.loan_repayment_schedule,
+			loan_disbursement=demand.loan_disbursement,
+		)
 
 
 def make_accrual_interest_entry_for_loans(
@@ -734,64 +765,11 @@ def make_accrual_interest_entry_for_loans(
 	from_demand=False,
 	loan_disbursement=None,
 ):
+	query = get_accrual_loans_query(loan=loan, loan_product=loan_product, company=company)
 
-	loan_doc = frappe.qb.DocType("Loan")
-
-	query = (
-		frappe.qb.from_(loan_doc)
-		.select(
-			loan_doc.name,
-			loan_doc.total_payment,
-			loan_doc.total_amount_paid,
-			loan_doc.debit_adjustment_amount,
-			loan_doc.credit_adjustment_amount,
-			loan_doc.refund_amount,
-			loan_doc.loan_account,
-			loan_doc.interest_income_account,
-			loan_doc.penalty_income_account,
-			loan_doc.loan_amount,
-			loan_doc.is_term_loan,
-			loan_doc.status,
-			loan_doc.disbursement_date,
-			loan_doc.disbursed_amount,
-			loan_doc.applicant_type,
-			loan_doc.applicant,
-			loan_doc.rate_of_interest,
-			loan_doc.total_interest_payable,
-			loan_doc.written_off_amount,
-			loan_doc.total_principal_paid,
-			loan_doc.repayment_start_date,
-			loan_doc.company,
-			loan_doc.freeze_account,
-			loan_doc.freeze_date,
-			loan_doc.loan_product,
-			loan_doc.penalty_charges_rate,
-			loan_doc.repayment_schedule_type,
-		)
-		.where(loan_doc.docstatus == 1)
-		.where(loan_doc.status.isin(["Disbursed", "Partially Disbursed", "Active", "Written Off"]))
-		.where(
-			(loan_doc.excess_amount_paid <= 0) | (loan_doc.repayment_schedule_type == "Line of Credit")
-		)
-		.where((loan_doc.loan_product.isnotnull()) & (loan_doc.loan_product != ""))
-	)
-
-	if loan:
-		query = query.where(loan_doc.name == loan)
-
-	if loan_product:
-		query = query.where(loan_doc.loan_product == loan_product)
-
-	if company:
-		query = query.where(loan_doc.company == company)
-
-	if limit:
-		query = query.limit(limit)
-
-	open_loans = query.run(as_dict=1)
 	if loan:
 		process_interest_accrual_batch(
-			open_loans,
+			query.run(as_dict=1),
 			posting_date,
 			process_loan_interest,
 			accrual_type,
@@ -801,8 +779,7 @@ def make_accrual_interest_entry_for_loans(
 		)
 	else:
 		BATCH_SIZE = 3000
-		batch_list = list(get_batches(open_loans, BATCH_SIZE))
-		for batch in batch_list:
+		for batch in iter_loan_batches(query, BATCH_SIZE, limit=limit):
 			frappe.enqueue(
 				process_interest_accrual_batch,
 				loans=batch,
@@ -816,11 +793,65 @@ def make_accrual_interest_entry_for_loans(
 			)
 
 
-def get_batches(open_loans, batch_size):
-	for i in range(0, len(open_loans), batch_size):
-		yield open_loans[i : i + batch_size]
+ACCRUAL_LOAN_FIELDS = (
+	"name",
+	"total_payment",
+	"total_amount_paid",
+	"debit_adjustment_amount",
+	"credit_adjustment_amount",
+	"refund_amount",
+	"loan_account",
+	"interest_income_account",
+	"penalty_income_account",
+	"loan_amount",
+	"is_term_loan",
+	"status",
+	"disbursement_date",
+	"disbursed_amount",
+	"applicant_type",
+	"applicant",
+	"rate_of_interest",
+	"total_interest_payable",
+	"written_off_amount",
+	"total_principal_paid",
+	"repayment_start_date",
+	"company",
+	"freeze_account",
+	"freeze_date",
+	"loan_product",
+	"penalty_charges_rate",
+	"repayment_schedule_type",
+)
+
+
+def get_accrual_loans_query(loan=None, loan_product=None, company=None, fields=None):
+	"""Open loans that accrue interest, by default with the fields the accrual needs"""
+	loan_doc = frappe.qb.DocType("Loan")
 
+	query = (
+		frappe.qb.from_(loan_doc)
+		.select(*[loan_doc[field] for field in (fields or ACCRUAL_LOAN_FIELDS)])
+		.where(loan_doc.docstatus == 1)
+		.where(loan_doc.status.isin(["Disbursed", "Partially Disbursed", "Active", "Written Off"]))
+		.where(
+			(loan_doc.excess_amount_paid <= 0) | (loan_doc.repayment_schedule_type == "Line of Credit")
+		)
+		.where((loan_doc.loan_product.isnotnull()) & (loan_doc.loan_product != ""))
+	)
+
+	if loan:
+		query = query.where(loan_doc.name == loan)
+
+	if loan_product:
+		query = query.where(loan_doc.loan_product == loan_product)
+
+	if company:
+		query = query.where(loan_doc.company == company)
 
+	return query
+
+
+@with_lending_settings
 def process_interest_accrual_batch(
 	loans,
 	posting_date,
@@ -830,42 +861,62 @@ def process_interest_accrual_batch(
 	from_demand=False,
 	loan_disbursement=None,
 ):
-	for loan in loans:
-		loan_accrual_frequency = get_loan_accrual_frequency(loan.company)
-
-		try:
-			if not from_demand:
-				calculate_penal_interest_for_loans(
-					loan,
-					loan.freeze_date or posting_date,
-					process_loan_interest=process_loan_interest,
-					accrual_type=accrual_type,
-					loan_disbursement=loan_disbursement,
-				)
-			calculate_accrual_amount_for_loans(
-				loan,
-				loan.freeze_date or posting_date,
-				process_loan_interest=process_loan_interest,
-				accrual_type=accrual_type,
-				accrual_date=accrual_date,
-				loan_accrual_frequency=loan_accrual_frequency,
-				loan_disbursement=loan_disbursement,
-			)
+	from lending.lending.doctype.loan_interest_accrual.utils import process_bulk_interest_accrual
 
-			if len(loans) > 1:
-				frappe.db.commit()
+	is_batch = len(loans) > 1
+	bulk_accrued_loans = set()
+	failed_loans = []
 
-		except Exception as e:
-			if len(loans) > 1:
-				frappe.log_error(
-					title="Loan Interest Accrual Error",
-					message=frappe.get_traceback(),
-					reference_doctype="Loan",
-					reference_name=loan.name,
-				)
-				frappe.db.rollback()
-			else:
-				raise e
+	if is_batch and not from_demand and not loan_disbursement:
+		# Normal interest for the batch is accrued set based, loans that need
+		# the regular document flow are handed back and accrued below
+		fallback_loans = process_bulk_interest_accrual(
+			loans, posting_date, process_loan_interest, accrual_type
+		)
+		bulk_accrued_loans = {loan.name for loan in loans} - {loan.name for loan in fallback_loans}
+
+	with gl_buffer_scope():
+		for loan in loans:
+			try:
+				if not from_demand:
+					calculate_penal_interest_for_loans(
+						loan,
+						loan.freeze_date or posting_date,
+						process_loan_interest=process_loan_interest,
+						accrual_type=accrual_type,
+						loan_disbursement=loan_disbursement,
+					)
+
+				if loan.name not in bulk_accrued_loans:
+					calculate_accrual_amount_for_loans(
+						loan,
+						loan.freeze_date or posting_date,
+						process_loan_interest=process_loan_interest,
+						accrual_type=accrual_type,
+						accrual_date=accrual_date,
+						loan_accrual_frequency=get_loan_accrual_frequency(loan.company),
+						loan_disbursement=loan_disbursement,
+					)
+
+				if is_batch:
+					flush_gl_entries()
+					frappe.db.commit()
+
+			except Exception as e:
+				if is_batch:
+					frappe.log_error(
+						title="Loan Interest Accrual Error",
+						message=frappe.get_traceback(),
+						reference_doctype="Loan",
+						reference_name=loan.name,
+					)
+					frappe.db.rollback()
+					discard_gl_entries()
+					failed_loans.append(loan.name)
+				else:
+					raise e
+
+	return failed_loans
 
 
 def get_last_accrual_date(
@@ -921,14 +972,8 @@ def get_last_accrual_date(
 	if interest_type == "Penal Interest":
 		return last_interest_accrual_date
 
-	if last_interest_accrual_date:
-		if last_disbursement_date and getdate(last_disbursement_date) > getdate(
-			last_interest_accrual_date
-		):
-			last_interest_accrual_date = add_days(last_disbursement_date, -1)
-
-		return last_interest_accrual_date
-	else:
+	moratorium_details = None
+	if not last_interest_accrual_date:
 		moratorium_details = frappe.db.get_value(
 			"Loan Repayment Schedule",
 			{"loan": loan, "docstatus": 1, "status": "Active"},
@@ -936,18 +981,32 @@ def get_last_accrual_date(
 			as_dict=1,
 		)
 
-		if (
-			moratorium_details
-			and moratorium_details.moratorium_end_date
-			and moratorium_details.moratorium_type == "EMI"
-			and getdate(moratorium_details.moratorium_end_date) > getdate(last_disbursement_date)
+	return resolve_last_accrual_date(
+		last_interest_accrual_date, last_disbursement_date, moratorium_details
+	)
+
+
+def resolve_last_accrual_date(
+	last_interest_accrual_date, last_disbursement_date, moratorium_details=None
+):
+	if last_interest_accrual_date:
+		if last_disbursement_date and getdate(last_disbursement_date) > getdate(
+			last_interest_accrual_date
 		):
-			last_interest_accrual_date = add_days(moratorium_details.moratorium_end_date, 1)
-		else:
 			last_interest_accrual_date = add_days(last_disbursement_date, -1)
 
 		return last_interest_accrual_date
 
+	if (
+		moratorium_details
+		and moratorium_details.moratorium_end_date
+		and moratorium_details.moratorium_type == "EMI"
+		and getdate(moratorium_details.moratorium_end_date) > getdate(last_disbursement_date)
+	):
+		return add_days(moratorium_details.moratorium_end_date, 1)
+
+	return add_days(last_disbursement_date, -1)
+
 
 def get_last_disbursement_date(loan, posting_date, loan_disbursement=None):
 	schedule_type = frappe.db.get_value("Loan", loan, "repayment_schedule_type", cache=True)
@@ -987,8 +1046,8 @@ def get_per_day_interest(
 		posting_date = getdate()
 
 	if not interest_day_count_convention:
-		interest_day_count_convention = frappe.get_cached_value(
-			"Company", company, "interest_day_count_convention"
+		interest_day_count_convention = (
+			get_lending_settings().get_company(company).interest_day_count_convention
 		)
 
 	if interest_day_count_convention == "Actual/365" or interest_day_count_convention == "30/365":
@@ -1010,8 +1069,8 @@ def get_interest_amount(
 	posting_date=None,
 	interest_per_day=None,
 ):
-	interest_day_count_convention = frappe.get_cached_value(
-		"Company", company, "interest_day_count_convention"
+	interest_day_count_convention = (
+		get_lending_settings().get_company(company).interest_day_count_convention
 	)
 
 	if not interest_per_day:
@@ -1104,82 +1163,69 @@ def reverse_loan_interest_accruals(
 
 
 def get_loan_accrual_frequency(company):
-	company_doc = frappe.qb.DocType("Company")
-	query = (
-		frappe.qb.from_(company_doc)
-		.select(company_doc.loan_accrual_frequency)
-		.where(company_doc.name == company)
-	)
-	loan_accrual_frequency = query.run(as_dict=True)[0]["loan_accrual_frequency"]
+	return get_lending_settings().get_company(company).get_loan_accrual_frequency()
 
-	if not loan_accrual_frequency:
-		frappe.throw(_("Loan Accrual Frequency not set for company {0}").format(frappe.bold(company)))
 
-	return loan_accrual_frequency
-
-
-def get_parent_wise_dates(loan, posting_date, loan_accrual_frequency, loan_disbursement=None):
-	filters = {"loan": loan, "docstatus": 1, "status": "Active", "posting_date": ("<=", posting_date)}
+def get_parent_wise_dates(
+	loan, posting_date, loan_accrual_frequency, loan_disbursement=None, accrual_context=None
+):
+	from lending.lending.doctype.loan_interest_accrual.utils import get_term_loan_accrual_context
 
-	if loan_disbursement:
-		filters["loan_disbursement"] = loan_disbursement
+	if not accrual_context:
+		accrual_context = get_term_loan_accrual_context([loan], for_update=True)
 
-	schedules_details = frappe.db.get_all(
-		"Loan Repayment Schedule", filters=filters, fields=["name", "maturity_date"], order_by=None
-	)
+	schedules_details = [
+		d
+		for d in accrual_context.schedule_map.values()
+		if d.loan == loan
+		and getdate(d.posting_date) <= getdate(posting_date)
+		and (not loan_disbursement or d.loan_disbursement == loan_disbursement)
+	]
 
 	schedules = [d.name for d in schedules_details]
-	schedule_dates = []
 
 	accrual_schedule_map = {}
 	parent_wise_schedules = frappe._dict()
 
-	freeze_date = frappe.db.get_value("Loan", loan, "freeze_date")
+	freeze_date = accrual_context.freeze_date_map.get(loan)
 	if freeze_date and getdate(freeze_date) < getdate(posting_date):
 		posting_date = freeze_date
 
 	maturity_map = add_maturity_breaks(parent_wise_schedules, schedules_details, posting_date)
 
-	for schedule in schedules:
-		maturity_date = maturity_map.get(schedule)
+	# Same for every schedule of the loan, schedules without accruals start from their
+	# posting date or the end of an EMI moratorium
+	last_interest_accrual_date = accrual_context.last_accrual_map.get(
+		(loan, loan_disbursement) if loan_disbursement else loan
+	)
+	last_accrual_date = None
 
-		last_accrual_date = get_last_accrual_date(
-			loan,
-			posting_date,
-			"Normal Interest",
-			loan_repayment_schedule=schedule,
-			loan_disbursement=loan_disbursement,
-		)
+	for schedule in schedules_details:
+		maturity_date = maturity_map.get(schedule.name)
+
+		if last_interest_accrual_date:
+			last_accrual_date = add_days(last_interest_accrual_date, 1)
+		elif schedule.moratorium_type == "EMI" and schedule.moratorium_end_date:
+			last_accrual_date = schedule.moratorium_end_date
+		else:
+			last_accrual_date = schedule.posting_date
 
-		accrual_schedule_map[schedule] = last_accrual_date
+		accrual_schedule_map[schedule.name] = last_accrual_date
 
-		parent_wise_schedules.setdefault(schedule, [])
+		parent_wise_schedules.setdefault(schedule.name, [])
 		if (
 			getdate(last_accrual_date) < getdate(maturity_date)
-			and getdate(last_accrual_date) <= posting_date
+			and getdate(last_accrual_date) <= getdate(posting_date)
 			and loan_accrual_frequency == "Daily"
 		):
-			parent_wise_schedules[schedule].append(getdate(last_accrual_date))
-
-		schedule_filters = {
-			"parent": schedule,
-			"payment_date": ("between", [last_accrual_date, posting_date]),
-		}
-
-		schedule_dates.extend(
-			frappe.db.get_all(
-				"Repayment Schedule",
-				filters=schedule_filters,
-				fields=["payment_date", "parent"],
-				order_by="payment_date",
-			)
-			or []
-		)
-
-	for schedule_date in schedule_dates:
-		parent_wise_schedules.setdefault(schedule_date.parent, [])
-		accrual_date = add_days(schedule_date.payment_date, -1)
-		parent_wise_schedules[schedule_date.parent].append(accrual_date)
+			parent_wise_schedules[schedule.name].append(getdate(last_accrual_date))
+
+		# Installments falling between the last accrual and the posting date
+		dates, _balances = accrual_context.balance_map.get(schedule.name, ([], []))
+		for payment_date in dates[
+			bisect_left(dates, getdate(last_accrual_date)) : bisect_right(dates, getdate(posting_date))
+		]:
+			parent_wise_schedules[schedule.name].append(add_days(payment_date, -1))
 
 	if (
 		schedules
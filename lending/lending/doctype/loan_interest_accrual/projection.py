@@ -0,0 +1,254 @@
+"""Side effect free projection of the interest accrual.
+
+Returns the Loan Interest Accruals and the penalty and additional interest demands the
+regular accrual would book for a set of loans up to a posting date, without writing
+anything. Inputs for all the loans are read with a handful of grouped queries upfront,
+the projection of each loan is then computed in memory."""
+
+from dataclasses import dataclass, field
+from datetime import date
+
+import frappe
+from frappe.query_builder.functions import Sum
+from frappe.utils import add_days, flt, getdate
+
+from lending.settings import get_lending_settings, lending_settings_scope
+
+
+@dataclass
+class ProjectedAccrual:
+	loan: str
+	interest_type: str
+	start_date: date
+	posting_date: date
+	base_amount: float
+	interest_amount: float
+	rate_of_interest: float
+	additional_interest_amount: float = 0.0
+	loan_repayment_schedule: str | None = None
+	loan_repayment_schedule_detail: str | None = None
+	loan_demand: str | None = None
+	loan_disbursement: str | None = None
+
+
+@dataclass
+class ProjectedDemand:
+	loan: str
+	demand_date: date
+	demand_type: str
+	demand_subtype: str
+	demand_amount: float
+	loan_repayment_schedule: str | None = None
+	loan_disbursement: str | None = None
+
+
+@dataclass
+class AccrualProjection:
+	loan: str
+	posting_date: date
+	accruals: list[ProjectedAccrual] = field(default_factory=list)
+	demands: list[ProjectedDemand] = field(default_factory=list)
+
+	@property
+	def normal_interest(self):
+		return sum(d.interest_amount for d in self.accruals if d.interest_type == "Normal Interest")
+
+	@property
+	def penal_interest(self):
+		return sum(d.interest_amount for d in self.accruals if d.interest_type == "Penal Interest")
+
+
+def project_accruals(loans, posting_date, loan_disbursement=None) -> dict[str, AccrualProjection]:
+	"""Projects the accrual of `loans` (names or rows with the accrual fields) up to
+	`posting_date`, keyed by loan name"""
+	if not loans:
+		return {}
+
+	with lending_settings_scope():
+		loans = get_loan_snapshots(loans)
+		context = get_projection_context(loans, posting_date, loan_disbursement=loan_disbursement)
+
+		return {
+			loan.name: project_loan_accruals(loan, posting_date, context, loan_disbursement)
+			for loan in loans
+		}
+
+
+def get_loan_snapshots(loans):
+	from lending.lending.doctype.loan_interest_accrual.loan_interest_accrual import (
+		ACCRUAL_LOAN_FIELDS,
+	)
+
+	if not isinstance(loans[0], str):
+		return loans
+
+	return frappe.db.get_all(
+		"Loan", filters={"name": ("in", loans)}, fields=list(ACCRUAL_LOAN_FIELDS)
+	)
+
+
+def get_projection_context(loans, posting_date, loan_disbursement=None):
+	"""Everything `project_loan_accruals` reads, for all the loans at once"""
+	from lending.lending.doctype.loan_interest_accrual.utils import (
+		get_accrual_context,
+		get_last_penal_accrual_date_map,
+		get_principal_outstanding_map,
+	)
+
+	loan_names = [loan.name for loan in loans]
+	context = get_accrual_context(loans, for_update=False)
+
+	context.demand_map = get_overdue_emi_demand_map(loan_names, posting_date, loan_disbursement)
+	demands = [demand for loan_demands in context.demand_map.values() for demand in loan_demands]
+
+	context.principal_map = get_principal_outstanding_map(
+		loan_names, [demand.repayment_schedule_detail for demand in demands]
+	)
+	context.last_penal_accrual_map = get_last_penal_accrual_date_map(
+		loan_names, demands, loan_disbursement=loan_disbursement, for_update=False
+	)
+
+	return context
+
+
+def get_overdue_emi_demand_map(loans, posting_date, loan_disbursement=None):
+	"""Unpaid EMI demands summed per repayment schedule detail, as `get_unpaid_demands`
+	returns them with `emi_wise`, for all the loans in one query"""
+	from lending.lending.doctype.loan_repayment.loan_repayment import (
+		get_demand_query,
+		get_unpaid_demand_condition,
+	)
+
+	precision = get_lending_settings().precision
+	loan_demand = frappe.qb.DocType("Loan Demand")
+
+	query = (
+		get_demand_query()
+		.select(Sum(loan_demand.outstanding_amount).as_("pending_amount"))
+		.where(loan_demand.loan.isin(loans))
+		.where(loan_demand.docstatus == 1)
+		.where(loan_demand.demand_date <= posting_date)
+		.where(get_unpaid_demand_condition(loan_demand, precision))
+		.where(loan_demand.demand_type == "EMI")
+		.where(loan_demand.repayment_schedule_detail.isnotnull())
+		.groupby(loan_demand.loan, loan_demand.repayment_schedule_detail)
+		.orderby(loan_demand.demand_date)
+	)
+
+	if loan_disbursement:
+		query = query.where(loan_demand.loan_disbursement == loan_disbursement)
+
+	demand_map = {}
+	for demand in query.run(as_dict=1):
+		demand_map.setdefault(demand.loan, []).append(demand)
+
+	return demand_map
+
+
+def project_loan_accruals(loan, posting_date, context, loan_disbursement=None):
+	"""Accruals of a single loan from the prefetched `context`, does not query the database"""
+	from lending.lending.doctype.loan_interest_accrual.utils import get_accruals_for_loan
+
+	settings = get_lending_settings()
+	precision = settings.precision
+	projection = AccrualProjection(loan=loan.name, posting_date=getdate(posting_date))
+
+	for accrual in get_accruals_for_loan(
+		loan,
+		loan.freeze_date or posting_date,
+		settings.get_company(loan.company).get_loan_accrual_frequency(),
+		context,
+		precision,
+		loan_disbursement=loan_disbursement,
+	):
+		schedule = context.schedule_map.get(accrual.loan_repayment_schedule) or {}
+		projection.accruals.append(
+			ProjectedAccrual(
+				loan=loan.name,
+				interest_type="Normal Interest",
+				start_date=getdate(accrual.start_date),
+				posting_date=getdate(accrual.posting_date),
+				base_amount=flt(accrual.base_amount, precision),
+				interest_amount=flt(accrual.interest_amount, precision),
+				rate_of_interest=accrual.rate_of_interest,
+				loan_repayment_schedule=accrual.loan_repayment_schedule,
+				loan_disbursement=schedule.get("loan_disbursement") or loan_disbursement,
+			)
+		)
+
+	add_penal_interest_projection(projection, loan, posting_date, context, precision)
+
+	return projection
+
+
+def add_penal_interest_projection(projection, loan, posting_date, context, precision):
+	"""Mirrors `calculate_penal_interest_for_loans` and `make_penal_interest_entries`"""
+	from lending.lending.doctype.loan_interest_accrual.utils import (
+		get_penal_interest_entries,
+		get_penal_interest_plan,
+	)
+
+	product_settings = get_lending_settings().get_loan_product(loan.loan_product)
+	penal_interest_rate = loan.penalty_charges_rate or product_settings.penalty_interest_rate
+
+	if flt(penal_interest_rate, precision) <= 0:
+		return
+
+	if loan.freeze_date and getdate(loan.freeze_date) < getdate(posting_date):
+		posting_date = loan.freeze_date
+
+	demands = [
+		demand
+		for demand in context.demand_map.get(loan.name, [])
+		if getdate(posting_date)
+		>= add_days(getdate(demand.demand_date), product_settings.grace_period_in_days)
+	]
+
+	for plan in get_penal_interest_plan(
+		loan,
+		demands,
+		posting_date,
+		context.principal_map,
+		context.last_penal_accrual_map,
+		penal_interest_rate,
+		precision,
+	):
+		demand = plan.demand
+		for entry in get_penal_interest_entries(plan, product_settings.consolidate_penal_interest):
+			if flt(entry.penal_interest_amount, precision) > 0:
+				projection.accruals.append(
+					ProjectedAccrual(
+						loan=loan.name,
+						interest_type="Penal Interest",
+						start_date=getdate(entry.start_date),
+						posting_date=getdate(entry.posting_date),
+						base_amount=flt(demand.pending_amount, precision),
+						interest_amount=flt(entry.penal_interest_amount, precision),
+						rate_of_interest=penal_interest_rate,
+						additional_interest_amount=entry.additional_interest,
+						loan_repayment_schedule_detail=demand.repayment_schedule_detail,
+						loan_demand=demand.name,
+						loan_disbursement=demand.loan_disbursement,
+					)
+				)
+
+			if loan.status == "Written Off":
+				continue
+
+			demand_date = getdate(add_days(entry.posting_date, 1))
+			for demand_type, amount in (
+				("Penalty", entry.penalty_amount),
+				("Additional Interest", entry.additional_interest),
+			):
+				if flt(amount, precision) > 0:
+					projection.demands.append(
+						ProjectedDemand(
+							loan=loan.name,
+							demand_date=demand_date,
+							demand_type=demand_type,
+							demand_subtype=demand_type,
+							demand_amount=flt(amount, precision),
+							loan_repayment_schedule=demand.loan_repayment_schedule,
+							loan_disbursement=demand.loan_disbursement,
+						)
+					)
@@ -5,6 +5,7 @@ from frappe.utils import add_days, date_diff, flt, getdate
 from lending.lending.doctype.loan_interest_accrual.loan_interest_accrual import (
 	process_interest_accrual_batch,
 )
+from lending.lending.doctype.loan_interest_accrual.projection import project_accruals
 from lending.lending.doctype.loan_repayment.loan_repayment import calculate_amounts
 from lending.lending.doctype.process_loan_demand.process_loan_demand import (
 	process_daily_loan_demands,
@@ -94,6 +95,160 @@ class TestLoanInterestAccrual(IntegrationTestCase):
 		self.assertEqual(getdate(last_accrual_date_a), getdate("2024-04-10"))
 		self.assertEqual(getdate(last_accrual_date_b), getdate("2024-04-20"))
 
+	def test_bulk_accrual_matches_single_loan_accrual(self):
+		set_loan_accrual_frequency("Daily")
+
+		posting_date = "2024-04-05"
+		repayment_start_date = "2024-05-05"
+
+		loans = []
+		for _i in range(3):
+			loan = create_loan(
+				self.applicant2,
+				"Term Loan Product 4",
+				1000000,
+				"Repay Over Number of Periods",
+				6,
+				applicant_type="Customer",
+				repayment_start_date=repayment_start_date,
+				posting_date=posting_date,
+				rate_of_interest=23,
+			)
+			loan.submit()
+			make_loan_disbursement_entry(
+				loan.name,
+				loan.loan_amount,
+				disbursement_date=posting_date,
+				repayment_start_date=repayment_start_date,
+			)
+			loans.append(loan)
+
+		process_interest_accrual_batch(
+			loans=[get_loan_object(loan.load_from_db()) for loan in loans[:2]],
+			posting_date="2024-04-20",
+			process_loan_interest="",
+			accrual_type="Regular",
+			accrual_date="2024-04-20",
+		)
+		process_interest_accrual_batch(
+			loans=[get_loan_object(loans[2].load_from_db())],
+			posting_date="2024-04-20",
+			process_loan_interest="",
+			accrual_type="Regular",
+			accrual_date="2024-04-20",
+		)
+
+		accruals = [
+			frappe.get_all(
+				"Loan Interest Accrual",
+				filters={"loan": loan.name, "docstatus": 1},
+				fields=["posting_date", "interest_amount", "base_amount", "last_accrual_date"],
+				order_by="posting_date asc",
+			)
+			for loan in loans
+		]
+
+		self.assertEqual(accruals[0], accruals[2])
+		self.assertEqual(accruals[1], accruals[2])
+
+		gl_amounts = [
+			frappe.db.get_value(
+				"GL Entry",
+				{
+					"against_voucher_type": "Loan",
+					"against_voucher": loan.name,
+					"voucher_type": "Loan Interest Accrual",
+				},
+				[{"SUM": "debit"}],
+			)
+			for loan in loans
+		]
+		self.assertEqual(gl_amounts[0], gl_amounts[2])
+
+	def test_projection_matches_booked_accruals(self):
+		set_loan_accrual_frequency("Daily")
+
+		loan = create_loan(
+			self.applicant2,
+			"Term Loan Product 4",
+			1000000,
+			"Repay Over Number of Periods",
+			6,
+			applicant_type="Customer",
+			repayment_start_date="2024-05-05",
+			posting_date="2024-04-05",
+			rate_of_interest=23,
+		)
+		loan.submit()
+		make_loan_disbursement_entry(
+			loan.name,
+			loan.loan_amount,
+			disbursement_date="2024-04-05",
+			repayment_start_date="2024-05-05",
+		)
+
+		projection = project_accruals([loan.name], "2024-04-20")[loan.name]
+		self.assertFalse(
+			frappe.db.exists("Loan Interest Accrual", {"loan": loan.name, "docstatus": 1})
+		)
+
+		process_loan_interest_accrual_for_loans(posting_date="2024-04-20", loan=loan.name)
+
+		accruals = frappe.get_all(
+			"Loan Interest Accrual",
+			filters={"loan": loan.name, "docstatus": 1, "interest_type": "Normal Interest"},
+			fields=["posting_date", "interest_amount"],
+			order_by="posting_date asc",
+		)
+
+		self.assertEqual(
+			[(d.posting_date, d.interest_amount) for d in projection.accruals],
+			[(getdate(d.posting_date), d.interest_amount) for d in accruals],
+		)
+
+	def test_projection_matches_booked_accruals_for_line_of_credit(self):
+		set_loan_accrual_frequency("Daily")
+		loan = create_loan(
+			"_Test Customer 1",
+			"Term Loan Product 5",
+			500000,
+			"Repay Over Number of Periods",
+			1,
+			posting_date="2024-10-17",
+			rate_of_interest=17,
+			applicant_type="Customer",
+			limit_applicable_start="2024-10-16",
+			limit_applicable_end="2026-10-16",
+		)
+		loan.submit()
+
+		for amount, disbursement_date in ((171000, "2024-11-30"), (200000, "2024-12-01")):
+			make_loan_disbursement_entry(
+				loan.name,
+				amount,
+				disbursement_date=disbursement_date,
+				repayment_start_date="2025-02-28",
+				repayment_frequency="One Time",
+			).submit()
+
+		projection = project_accruals([loan.name], "2024-12-05")[loan.name]
+
+		process_loan_interest_accrual_for_loans(
+			posting_date="2024-12-05", loan=loan.name, company="_Test Company"
+		)
+
+		accruals = frappe.get_all(
+			"Loan Interest Accrual",
+			filters={"loan": loan.name, "docstatus": 1, "interest_type": "Normal Interest"},
+			fields=["posting_date", "interest_amount"],
+		)
+
+		self.assertTrue(accruals)
+		self.assertEqual(
+			sorted((d.posting_date, d.interest_amount) for d in projection.accruals),
+			sorted((getdate(d.posting_date), d.interest_amount) for d in accruals),
+		)
+
 	def test_loc_loan_interest_accrual(self):
 		set_loan_accrual_frequency("Daily")
 		loan = create_loan(
@@ -0,0 +1,668 @@
+import bisect
+
+import frappe
+from frappe.query_builder.functions import Max
+from frappe.utils import add_days, cint, date_diff, flt, getdate, nowdate
+
+from lending.gl import (
+	discard_gl_entries,
+	flush_gl_entries,
+	gl_buffer_scope,
+	make_lending_gl_entries,
+)
+from lending.lending.doctype.loan_balance_snapshot.loan_balance_snapshot import (
+	mark_loan_balances_stale,
+)
+from lending.settings import get_lending_settings
+from lending.utils import bulk_insert_documents, daterange
+
+
+def process_bulk_interest_accrual(
+	loans, posting_date, process_loan_interest, accrual_type, chunk_size=500
+):
+	"""Set based counterpart of `calculate_accrual_amount_for_loans` for a batch of loans.
+
+	Inputs for the whole batch are prefetched with a handful of grouped queries, interest
+	is computed for every loan in a single pass and the resulting accruals are written with
+	multi row inserts. Returns the loans that have to go through the per loan path."""
+	from lending.lending.doctype.loan_interest_accrual.loan_interest_accrual import (
+		get_accrual_account_details,
+		get_loan_accrual_frequency,
+	)
+
+	bulk_loans, fallback_loans = split_loans_for_bulk_accrual(loans)
+	if not bulk_loans:
+		return fallback_loans
+
+	precision = get_lending_settings().precision
+	account_details_map = {}
+
+	for i in range(0, len(bulk_loans), chunk_size):
+		chunk = bulk_loans[i : i + chunk_size]
+		try:
+			accrual_context = get_accrual_context(chunk)
+			accruals = []
+
+			for loan in chunk:
+				accruals.extend(
+					get_accruals_for_loan(
+						loan,
+						loan.freeze_date or posting_date,
+						get_loan_accrual_frequency(loan.company),
+						accrual_context,
+						precision,
+					)
+				)
+
+			for accrual in accruals:
+				loan = accrual_context.loan_map[accrual.loan]
+				if loan.loan_product not in account_details_map:
+					account_details_map[loan.loan_product] = get_accrual_account_details(loan.loan_product)
+
+			with gl_buffer_scope():
+				make_bulk_loan_interest_accruals(
+					accruals,
+					accrual_context,
+					account_details_map,
+					process_loan_interest,
+					accrual_type,
+				)
+				flush_gl_entries()
+
+			frappe.db.commit()
+		except Exception:
+			frappe.db.rollback()
+			discard_gl_entries()
+			frappe.log_error(
+				title="Bulk Loan Interest Accrual Error",
+				message=frappe.get_traceback(),
+			)
+			fallback_loans.extend(chunk)
+
+	return fallback_loans
+
+
+def split_loans_for_bulk_accrual(loans):
+	"""NPA and written off loans need suspense and write off handling on submit,
+	so they are left to the regular document flow"""
+	loan_details = frappe._dict(
+		(d.name, d)
+		for d in frappe.db.get_all(
+			"Loan",
+			filters={"name": ("in", [loan.name for loan in loans])},
+			fields=[
+				"name",
+				"is_npa",
+				"unmark_npa",
+				"cost_center",
+				"loan_product",
+				"status",
+				"repayment_schedule_type",
+			],
+		)
+	)
+
+	bulk_loans, fallback_loans = [], []
+	for loan in loans:
+		details = loan_details.get(loan.name)
+		if (
+			not details
+			or details.status == "Written Off"
+			or (cint(details.is_npa) and not cint(details.unmark_npa))
+		):
+			fallback_loans.append(loan)
+			continue
+
+		loan.update(details)
+		bulk_loans.append(loan)
+
+	return bulk_loans, fallback_loans
+
+
+def get_accrual_context(loans, for_update=True):
+	loan_names = [loan.name for loan in loans]
+	term_loans = [loan.name for loan in loans if loan.is_term_loan]
+
+	context = frappe._dict(
+		loan_map={loan.name: loan for loan in loans},
+		disbursement_map=get_disbursement_date_map(loan_names),
+		moratorium_map=get_moratorium_map(loan_names),
+	)
+	context.update(get_term_loan_accrual_context(loan_names, term_loans, for_update=for_update))
+
+	return context
+
+
+def get_term_loan_accrual_context(loans, term_loans=None, for_update=False):
+	"""Inputs of the term loan accrual for `loans`, each loaded with a single query.
+
+	Active repayment schedules are keyed by name with their rows kept as date sorted
+	arrays, last Normal Interest accrual dates are keyed as in `get_last_accrual_date_map`."""
+	if term_loans is None:
+		term_loans = loans
+
+	context = frappe._dict(
+		last_accrual_map=get_last_accrual_date_map(loans, for_update=for_update),
+		freeze_date_map=frappe._dict(
+			frappe.db.get_all(
+				"Loan", filters={"name": ("in", loans)}, fields=["name", "freeze_date"], as_list=1
+			)
+		),
+		schedule_map=frappe._dict(),
+		balance_map=frappe._dict(),
+	)
+
+	if term_loans:
+		schedules = frappe.db.get_all(
+			"Loan Repayment Schedule",
+			filters={"loan": ("in", term_loans), "docstatus": 1, "status": "Active"},
+			fields=[
+				"name",
+				"loan",
+				"loan_disbursement",
+				"current_principal_amount",
+				"posting_date",
+				"maturity_date",
+				"moratorium_end_date",
+				"moratorium_type",
+			],
+			order_by=None,
+		)
+		context.schedule_map = frappe._dict((d.name, d) for d in schedules)
+		if schedules:
+			context.balance_map = get_schedule_balance_map(context.schedule_map)
+
+	return context
+
+
+def get_last_accrual_date_map(loans, interest_type="Normal Interest", for_update=False):
+	"""Returns MAX(posting_date) of submitted accruals keyed by loan and by (loan, disbursement)"""
+	accruals = frappe.db.get_all(
+		"Loan Interest Accrual",
+		filters={"loan": ("in", loans), "docstatus": 1, "interest_type": interest_type},
+		fields=["loan", "loan_disbursement", "MAX(posting_date) as last_accrual_date"],
+		group_by="loan, loan_disbursement",
+		order_by=None,
+		for_update=for_update,
+	)
+
+	last_accrual_map = {}
+	for accrual in accruals:
+		last_accrual_map[(accrual.loan, accrual.loan_disbursement)] = accrual.last_accrual_date
+		if not last_accrual_map.get(accrual.loan) or getdate(accrual.last_accrual_date) > getdate(
+			last_accrual_map[accrual.loan]
+		):
+			last_accrual_map[accrual.loan] = accrual.last_accrual_date
+
+	return last_accrual_map
+
+
+def get_disbursement_date_map(loans):
+	disbursements = frappe.db.get_all(
+		"Loan Disbursement",
+		filters={"against_loan": ("in", loans), "docstatus": 1},
+		fields=["name", "against_loan", "disbursement_date"],
+		order_by="disbursement_date",
+	)
+
+	disbursement_map = {}
+	for disbursement in disbursements:
+		disbursement_date = getdate(disbursement.disbursement_date)
+		disbursement_map.setdefault(disbursement.against_loan, []).append(disbursement_date)
+		disbursement_map[(disbursement.against_loan, disbursement.name)] = [disbursement_date]
+
+	return disbursement_map
+
+
+def get_moratorium_map(loans):
+	schedules = frappe.db.get_all(
+		"Loan Repayment Schedule",
+		filters={"loan": ("in", loans), "docstatus": 1, "status": "Active"},
+		fields=["loan", "moratorium_end_date", "moratorium_type"],
+		order_by="modified desc",
+	)
+
+	moratorium_map = {}
+	for schedule in schedules:
+		moratorium_map.setdefault(schedule.loan, schedule)
+
+	return moratorium_map
+
+
+def get_schedule_balance_map(schedule_map):
+	"""Repayment Schedule rows of every schedule as (payment_dates, balances) sorted by date"""
+	rows = frappe.db.get_all(
+		"Repayment Schedule",
+		filters={"parent": ("in", list(schedule_map))},
+		fields=["parent", "payment_date", "balance_loan_amount"],
+		order_by="parent, payment_date",
+	)
+
+	balance_map = frappe._dict()
+	for row in rows:
+		dates, balances = balance_map.setdefault(row.parent, ([], []))
+		dates.append(getdate(row.payment_date))
+		balances.append(row.balance_loan_amount)
+
+	return balance_map
+
+
+def get_principal_as_of(accrual_context, loan_repayment_schedule, date):
+	"""Balance of the schedule as of `date` by binary search over its sorted rows, the
+	schedule's current principal before the first installment"""
+	dates, balances = accrual_context.balance_map.get(loan_repayment_schedule, ([], []))
+	idx = bisect.bisect_right(dates, getdate(date))
+
+	principal_amount = balances[idx - 1] if idx else None
+	if not principal_amount:
+		principal_amount = accrual_context.schedule_map[loan_repayment_schedule].current_principal_amount
+
+	return principal_amount
+
+
+def get_last_disbursement_date_from_map(accrual_context, loan, posting_date, loan_disbursement=None):
+	key = (loan.name, loan_disbursement) if loan_disbursement else loan.name
+	dates = [d for d in accrual_context.disbursement_map.get(key, []) if d <= getdate(posting_date)]
+
+	if not dates:
+		return None
+
+	return dates[0] if loan.repayment_schedule_type == "Line of Credit" else dates[-1]
+
+
+def get_last_accrual_date_from_map(accrual_context, loan, posting_date, loan_disbursement=None):
+	"""Equivalent of `get_last_accrual_date` for Normal Interest on prefetched data"""
+	from lending.lending.doctype.loan_interest_accrual.loan_interest_accrual import (
+		resolve_last_accrual_date,
+	)
+
+	key = (loan.name, loan_disbursement) if loan_disbursement else loan.name
+	last_interest_accrual_date = accrual_context.last_accrual_map.get(key)
+
+	return resolve_last_accrual_date(
+		last_interest_accrual_date,
+		get_last_disbursement_date_from_map(accrual_context, loan, posting_date, loan_disbursement),
+		accrual_context.moratorium_map.get(loan.name),
+	)
+
+
+def get_accruals_for_loan(
+	loan, posting_date, loan_accrual_frequency, accrual_context, precision, loan_disbursement=None
+):
+	from lending.lending.doctype.loan_interest_accrual.loan_interest_accrual import (
+		get_interest_amount,
+		get_interest_for_term,
+		get_overlapping_dates,
+	)
+	from lending.lending.doctype.loan_repayment.loan_repayment import (
+		get_pending_principal_amount,
+	)
+
+	posting_date = getdate(posting_date)
+	accruals = []
+
+	if loan.is_term_loan:
+		parent_wise_schedules, last_accrual_date_map = get_overlapping_dates(
+			loan.name,
+			posting_date,
+			loan_accrual_frequency,
+			loan_disbursement=loan_disbursement,
+			accrual_context=accrual_context,
+		)
+
+		for parent in parent_wise_schedules:
+			for payment_date in parent_wise_schedules[parent]:
+				last_accrual_date_for_schedule = last_accrual_date_map.get(parent)
+				pending_principal_amount = get_principal_as_of(accrual_context, parent, payment_date)
+				payable_interest = get_interest_for_term(
+					loan.company,
+					loan.rate_of_interest,
+					pending_principal_amount,
+					last_accrual_date_for_schedule,
+					payment_date,
+				)
+
+				if payable_interest > 0:
+					accruals.append(
+						frappe._dict(
+							loan=loan.name,
+							base_amount=pending_principal_amount,
+							interest_amount=flt(payable_interest, precision),
+							start_date=last_accrual_date_for_schedule,
+							posting_date=payment_date,
+							rate_of_interest=loan.rate_of_interest,
+							loan_repayment_schedule=parent,
+						)
+					)
+
+					last_accrual_date_map[parent] = add_days(payment_date, 1)
+	else:
+		last_accrual_date = get_last_accrual_date_from_map(
+			accrual_context, loan, posting_date, loan_disbursement
+		)
+
+		no_of_days = date_diff(posting_date, last_accrual_date)
+		if no_of_days <= 0:
+			return accruals
+
+		pending_principal_amount = get_pending_principal_amount(
+			loan, loan_disbursement=loan_disbursement
+		)
+		payable_interest = get_interest_amount(
+			no_of_days,
+			principal_amount=pending_principal_amount,
+			rate_of_interest=loan.rate_of_interest,
+			company=loan.company,
+			posting_date=posting_date,
+		)
+
+		if payable_interest > 0:
+			accruals.append(
+				frappe._dict(
+					loan=loan.name,
+					base_amount=pending_principal_amount,
+					interest_amount=payable_interest,
+					start_date=last_accrual_date,
+					posting_date=posting_date,
+					rate_of_interest=loan.rate_of_interest,
+				)
+			)
+
+	return [d for d in accruals if flt(d.interest_amount, precision) > 0]
+
+
+def make_bulk_loan_interest_accruals(
+	accruals, accrual_context, account_details_map, process_loan_interest, accrual_type
+):
+	"""Builds submitted Loan Interest Accrual documents in memory, inserts them in bulk
+	and posts their GL entries. Field values mirror `make_loan_interest_accrual_entry`
+	followed by the document's validate and fetch steps."""
+	precision = get_lending_settings().precision
+	docs = []
+
+	for accrual in accruals:
+		loan = accrual_context.loan_map[accrual.loan]
+		schedule = accrual_context.schedule_map.get(accrual.loan_repayment_schedule) or {}
+		loan_disbursement = schedule.get("loan_disbursement")
+
+		doc = frappe.new_doc("Loan Interest Accrual")
+		doc.update(
+			{
+				"loan": loan.name,
+				"interest_amount": flt(accrual.interest_amount, precision),
+				"base_amount": flt(accrual.base_amount, precision),
+				"posting_date": accrual.posting_date or nowdate(),
+				"start_date": accrual.start_date,
+				"process_loan_interest_accrual": process_loan_interest,
+				"accrual_type": accrual_type,
+				"interest_type": "Normal Interest",
+				"rate_of_interest": accrual.rate_of_interest,
+				"loan_repayment_schedule": accrual.loan_repayment_schedule,
+				"loan_disbursement": loan_disbursement,
+				"additional_interest_amount": 0,
+				"accrual_date": nowdate(),
+				"applicant_type": loan.applicant_type,
+				"applicant": loan.applicant,
+				"company": loan.company,
+				"is_term_loan": loan.is_term_loan,
+				"loan_product": loan.loan_product,
+				"is_npa": loan.is_npa,
+				"unmark_npa": loan.unmark_npa,
+				"cost_center": loan.cost_center,
+				"docstatus": 1,
+			}
+		)
+
+		# Same as the `validate` hook, later accruals of a loan see the earlier ones
+		doc.last_accrual_date = get_last_accrual_date_from_map(
+			accrual_context, loan, doc.posting_date, loan_disbursement
+		)
+		for key in (loan.name, (loan.name, loan_disbursement)):
+			if not accrual_context.last_accrual_map.get(key) or getdate(doc.posting_date) > getdate(
+				accrual_context.last_accrual_map[key]
+			):
+				accrual_context.last_accrual_map[key] = doc.posting_date
+
+		docs.append(doc)
+
+	bulk_insert_documents(docs)
+	# inserted without the document hooks that keep the balance snapshot current
+	mark_loan_balances_stale({doc.loan for doc in docs})
+
+	for doc in docs:
+		loan = accrual_context.loan_map[doc.loan]
+		gle_map = doc.get_gl_map(
+			loan_status=loan.status,
+			cost_center=loan.cost_center,
+			account_details=account_details_map[loan.loan_product],
+		)
+		if gle_map:
+			make_lending_gl_entries(gle_map, merge_entries=False)
+
+	return docs
+
+
+def get_principal_outstanding_map(loans, repayment_schedule_details):
+	"""Outstanding EMI principal of every repayment schedule detail in a single query"""
+	principal_map = {}
+	if not repayment_schedule_details:
+		return principal_map
+
+	principal_demands = frappe.db.get_all(
+		"Loan Demand",
+		filters={
+			"loan": ("in", loans),
+			"repayment_schedule_detail": ("in", repayment_schedule_details),
+			"demand_type": "EMI",
+			"demand_subtype": "Principal",
+		},
+		fields=["repayment_schedule_detail", "outstanding_amount"],
+		order_by="modified desc",
+	)
+
+	for demand in principal_demands:
+		principal_map.setdefault(demand.repayment_schedule_detail, demand.outstanding_amount)
+
+	return principal_map
+
+
+def get_last_penal_accrual_date_map(loans, demands, loan_disbursement=None, for_update=True):
+	"""MAX(posting_date) of submitted penal accruals keyed by repayment schedule detail and,
+	for accruals booked before the schedule detail was tracked, by loan demand"""
+	last_accrual_date_map = {}
+	if not demands:
+		return last_accrual_date_map
+
+	loan_interest_accrual = frappe.qb.DocType("Loan Interest Accrual")
+	base_query = (
+		frappe.qb.from_(loan_interest_accrual)
+		.where(loan_interest_accrual.loan.isin(loans))
+		.where(loan_interest_accrual.docstatus == 1)
+		.where(loan_interest_accrual.interest_type == "Penal Interest")
+	)
+
+	if for_update:
+		base_query = base_query.for_update()
+
+	query = (
+		base_query.select(
+			loan_interest_accrual.loan_repayment_schedule_detail.as_("key"),
+			Max(loan_interest_accrual.posting_date).as_("last_accrual_date"),
+		)
+		.where(
+			loan_interest_accrual.loan_repayment_schedule_detail.isin(
+				[demand.repayment_schedule_detail for demand in demands]
+			)
+		)
+		.groupby(loan_interest_accrual.loan_repayment_schedule_detail)
+	)
+
+	if loan_disbursement:
+		query = query.where(loan_interest_accrual.loan_disbursement == loan_disbursement)
+
+	for row in query.run(as_dict=1):
+		last_accrual_date_map[row.key] = row.last_accrual_date
+
+	pending_demands = [
+		demand.name
+		for demand in demands
+		if not last_accrual_date_map.get(demand.repayment_schedule_detail)
+	]
+
+	if pending_demands:
+		query = (
+			base_query.select(
+				loan_interest_accrual.loan_demand.as_("key"),
+				Max(loan_interest_accrual.posting_date).as_("last_accrual_date"),
+			)
+			.where(loan_interest_accrual.loan_demand.isin(pending_demands))
+			.groupby(loan_interest_accrual.loan_demand)
+		)
+
+		for row in query.run(as_dict=1):
+			last_accrual_date_map[row.key] = row.last_accrual_date
+
+	return last_accrual_date_map
+
+
+def get_penal_interest_plan(
+	loan,
+	demands,
+	posting_date,
+	principal_map,
+	last_accrual_date_map,
+	penal_interest_rate,
+	precision,
+	with_segments=True,
+):
+	"""Penal interest due on every overdue EMI from its last penal accrual till `posting_date`.
+
+	Works on prefetched inputs only. Demands whose EMI principal is settled are kept for the
+	total but get no segments, so no accrual is booked for them."""
+	plan = []
+
+	for demand in demands:
+		on_migrate = False
+		last_accrual_date = last_accrual_date_map.get(demand.repayment_schedule_detail)
+
+		if not last_accrual_date:
+			last_accrual_date = last_accrual_date_map.get(demand.name)
+			on_migrate = True
+
+		if not last_accrual_date:
+			from_date = demand.demand_date
+		elif on_migrate:
+			from_date = last_accrual_date
+			if getdate(from_date) <= getdate(demand.demand_date):
+				from_date = demand.demand_date
+		else:
+			from_date = add_days(last_accrual_date, 1)
+
+		no_of_days = date_diff(posting_date, from_date) + 1
+		penal_interest_amount = flt(demand.pending_amount) * penal_interest_rate / 36500
+
+		if no_of_days <= 0 or flt(penal_interest_amount, precision) <= 0:
+			continue
+
+		# Penal interest is flat for every day of the range, the additional interest part only
+		# changes with the year divisor so the range is evaluated per year segment
+		segments = None
+		principal_amount = principal_map.get(demand.repayment_schedule_detail)
+		if principal_amount and with_segments:
+			segments = get_additional_interest_segments(
+				principal_amount,
+				loan.rate_of_interest,
+				loan.company,
+				from_date,
+				posting_date,
+				precision,
+			)
+
+		plan.append(
+			frappe._dict(
+				demand=demand,
+				from_date=from_date,
+				posting_date=posting_date,
+				no_of_days=no_of_days,
+				penal_interest_amount=penal_interest_amount,
+				segments=segments,
+			)
+		)
+
+	return plan
+
+
+def get_penal_interest_entries(plan, consolidate):
+	"""Penal accruals of one demand of `get_penal_interest_plan`, a single entry over the
+	whole range when consolidated and one per day otherwise"""
+	if not plan.segments:
+		return []
+
+	penal_interest_amount = plan.penal_interest_amount
+
+	if consolidate:
+		return [
+			frappe._dict(
+				penal_interest_amount=penal_interest_amount * plan.no_of_days,
+				additional_interest=sum(
+					segment.additional_interest * segment.days for segment in plan.segments
+				),
+				penalty_amount=sum(
+					(penal_interest_amount - segment.additional_interest) * segment.days
+					for segment in plan.segments
+					if penal_interest_amount > segment.additional_interest
+				),
+				start_date=plan.from_date,
+				posting_date=plan.posting_date,
+			)
+		]
+
+	entries = []
+	for segment in plan.segments:
+		penalty_amount = 0
+		if penal_interest_amount > segment.additional_interest:
+			penalty_amount = penal_interest_amount - segment.additional_interest
+
+		for current_date in daterange(segment.from_date, segment.to_date):
+			entries.append(
+				frappe._dict(
+					penal_interest_amount=penal_interest_amount,
+					additional_interest=segment.additional_interest,
+					penalty_amount=penalty_amount,
+					start_date=current_date,
+					posting_date=current_date,
+				)
+			)
+
+	return entries
+
+
+def get_additional_interest_segments(
+	principal_amount, rate_of_interest, company, from_date, to_date, precision
+):
+	"""Splits `from_date` to `to_date` (both inclusive) by calendar year, the per day
+	additional interest on the EMI principal does not change within a segment"""
+	from lending.lending.doctype.loan_interest_accrual.loan_interest_accrual import (
+		get_per_day_interest,
+	)
+
+	segments = []
+	from_date, to_date = getdate(from_date), getdate(to_date)
+
+	while from_date <= to_date:
+		segment_end = min(to_date, from_date.replace(month=12, day=31))
+		per_day_interest = get_per_day_interest(
+			principal_amount, rate_of_interest, company, from_date
+		)
+
+		segments.append(
+			frappe._dict(
+				from_date=from_date,
+				to_date=segment_end,
+				days=date_diff(segment_end, from_date) + 1,
+				additional_interest=flt(per_day_interest, precision),
+			)
+		)
+		from_date = getdate(add_days(segment_end, 1))
+
+	return segments
@@ -6,6 +6,8 @@ import frappe
 from frappe import _
 from frappe.model.document import Document
 
+from lending.settings import invalidate_lending_settings
+
 
 class LoanProduct(Document):
 	# begin: auto-generated types
@@ -33,6 +35,7 @@ class LoanProduct(Document):
 		collection_offset_sequence_for_sub_standard_asset: DF.Link | None
 		collection_offset_sequence_for_written_off_asset: DF.Link | None
 		company: DF.Link
+		consolidate_penal_interest: DF.Check
 		customer_refund_account: DF.Link
 		cyclic_day_of_the_month: DF.Int
 		days_past_due_threshold_for_npa: DF.Int
@@ -87,6 +90,9 @@ class LoanProduct(Document):
 		self.validate_accounts()
 		self.validate_rates()
 
+	def on_update(self):
+		invalidate_lending_settings(self)
+
 	def set_missing_values(self):
 		company_min_days_bw_disbursement_first_repayment = frappe.get_cached_value(
 			"Company", self.company, "min_days_bw_disbursement_first_repayment"
@@ -1,9 +1,28 @@
 # Copyright (c) 2019, Frappe Technologies Pvt. Ltd. and Contributors
 # See license.txt
 
-# import frappe
-import unittest
+import frappe
+from frappe.tests import IntegrationTestCase
 
+from lending.settings import lending_settings_scope
+from lending.tests.test_utils import init_loan_products, master_init
 
-class TestLoanProduct(unittest.TestCase):
-	pass
+
+class TestLoanProduct(IntegrationTestCase):
+	def setUp(self):
+		master_init()
+		init_loan_products()
+
+	def test_settings_snapshot_invalidated_on_save(self):
+		with lending_settings_scope() as settings:
+			grace_period = settings.get_loan_product("Term Loan Product 4").grace_period_in_days
+
+			loan_product = frappe.get_doc("Loan Product", "Term Loan Product 4")
+			loan_product.grace_period_in_days = grace_period + 1
+			loan_product.save()
+
+			self.assertEqual(
+				settings.get_loan_product("Term Loan Product 4").grace_period_in_days, grace_period + 1
+			)
+
+		frappe.db.rollback()
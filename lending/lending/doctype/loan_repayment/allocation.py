@@ -0,0 +1,186 @@
+"""Allocation of a collected amount against the unpaid demands of a loan.
+
+A `Loan Demand Offset Order` is compiled once into the ordered list of demand buckets
+it pays, and cached on the settings snapshot. The unpaid demands are bucketed by type
+and subtype in a single pass, and the amount is then allocated by walking the compiled
+steps over those buckets. Nothing here reads a `Loan Repayment`, so the engine also
+runs on plain demand rows for bulk callers."""
+
+from dataclasses import dataclass, field
+
+import frappe
+from frappe.utils import flt
+
+from lending.settings import get_lending_settings
+
+# Repayment types that pay the whole pending principal after the principal demands
+PRINCIPAL_BALANCE_REPAYMENT_TYPES = (
+	"Partial Settlement",
+	"Full Settlement",
+	"Write Off Recovery",
+	"Write Off Settlement",
+	"Principal Adjustment",
+)
+WAIVER_REPAYMENT_TYPES = ("Interest Waiver", "Penalty Waiver", "Charges Waiver")
+
+# Steps are (demand_type, demand_subtype, term_loans_only), `None` is the pending
+# principal balance step
+OFFSET_COMPONENT_STEPS = {
+	"EMI (Principal + Interest)": (("BPI", None, False), ("EMI", None, True)),
+	"Principal": (("Normal", None, False), ("EMI", "Principal", True), None),
+	"Normal": (("Normal", "Interest", False), ("EMI", "Interest", False)),
+	"Penalty": (("Penalty", None, False),),
+	"Additional Interest": (("Additional Interest", None, False),),
+	"Charges": (("Charges", None, False),),
+}
+
+
+@dataclass
+class PartnerShareTerms:
+	schedule_type: str | None = None
+	payment_ratio: float = 0.0
+	share_percentage: float = 0.0
+
+
+@dataclass
+class AllocationResult:
+	unallocated_amount: float = 0.0
+	# principal paid over and above the principal demands, by the balance step
+	principal_amount_paid: float = 0.0
+	allocations: list = field(default_factory=list)
+
+
+def compile_offset_order(offset_order):
+	"""Steps of the `Loan Demand Offset Order`, in the order they are paid"""
+	components = frappe.get_all(
+		"Loan Demand Offset Detail",
+		filters={"parent": offset_order, "parenttype": "Loan Demand Offset Order"},
+		pluck="demand_type",
+		order_by="idx",
+	)
+
+	return tuple(
+		step for component in components for step in OFFSET_COMPONENT_STEPS.get(component, ())
+	)
+
+
+def get_demand_buckets(demands):
+	"""Demands by type and by (type, subtype), keeping their order"""
+	buckets = {}
+	for demand in demands:
+		buckets.setdefault((demand.demand_type, None), []).append(demand)
+		buckets.setdefault((demand.demand_type, demand.demand_subtype), []).append(demand)
+
+	return buckets
+
+
+def allocate_amount(
+	amount,
+	demands,
+	offset_order,
+	is_term_loan=False,
+	repayment_type=None,
+	loan_status=None,
+	pending_principal_amount=0,
+	partner=None,
+	precision=None,
+):
+	"""Allocates `amount` against `demands` as per the `offset_order` name.
+
+	Returns the repayment detail rows to book along with what is left unallocated. A
+	demand is never paid beyond its outstanding amount, even when the offset order
+	reaches it through more than one component."""
+	settings = get_lending_settings()
+	if precision is None:
+		precision = settings.precision
+
+	pays_principal_balance = (
+		repayment_type in PRINCIPAL_BALANCE_REPAYMENT_TYPES
+		or loan_status == "Settled"
+		and repayment_type not in WAIVER_REPAYMENT_TYPES
+	)
+
+	buckets = get_demand_buckets(demands)
+	paid_map = {}
+	result = AllocationResult(unallocated_amount=amount)
+	principal_demands_paid = 0
+
+	for step in settings.get_offset_order(offset_order):
+		if result.unallocated_amount <= 0:
+			break
+
+		if step is None:
+			if pays_principal_balance:
+				payable_principal_amount = pending_principal_amount - principal_demands_paid
+				paid_amount = min(flt(result.unallocated_amount), payable_principal_amount)
+				result.principal_amount_paid += paid_amount
+				result.unallocated_amount -= paid_amount
+			continue
+
+		demand_type, demand_subtype, term_loans_only = step
+		if term_loans_only and not is_term_loan:
+			continue
+
+		partner_share = 0
+		if partner:
+			partner_share = get_overall_partner_share(partner, result.unallocated_amount) or 0
+
+		for demand in buckets.get((demand_type, demand_subtype), ()):
+			if result.unallocated_amount <= 0:
+				break
+
+			outstanding_amount = flt(demand.outstanding_amount) - paid_map.get(demand.name, 0)
+			partner_share_paid = 0
+
+			if result.unallocated_amount >= outstanding_amount:
+				paid_amount = outstanding_amount
+				if demand_type == "EMI" and partner:
+					partner_share_paid = (
+						get_loan_partner_share_paid(partner, 0, paid_amount, demand) or 0
+					)
+			else:
+				paid_amount = result.unallocated_amount
+				if demand_type == "EMI" and partner:
+					partner_share_paid = (
+						get_loan_partner_share_paid(partner, partner_share, paid_amount, demand) or 0
+					)
+
+			result.unallocated_amount -= paid_amount
+			partner_share -= partner_share_paid
+
+			if flt(paid_amount, precision) > 0:
+				paid_map[demand.name] = paid_map.get(demand.name, 0) + paid_amount
+				if demand.demand_subtype == "Principal":
+					principal_demands_paid += paid_amount
+
+				result.allocations.append(
+					{
+						"loan_demand": demand.name,
+						"paid_amount": paid_amount,
+						"demand_type": demand.demand_type,
+						"demand_subtype": demand.demand_subtype,
+						"sales_invoice": demand.sales_invoice,
+						"partner_share": partner_share_paid,
+					}
+				)
+
+	return result
+
+
+def get_loan_partner_share_paid(partner, amount_to_adjust, paid_amount, demand):
+	if partner.schedule_type == "EMI (PMT) based":
+		return flt(amount_to_adjust) or flt(demand.partner_outstanding)
+	elif partner.schedule_type == "Collection at partner's percentage":
+		return flt(partner.payment_ratio * paid_amount)
+	elif partner.schedule_type == "POS reduction plus interest at partner ROI":
+		if demand.demand_subtype == "Interest":
+			return flt(partner.payment_ratio * paid_amount)
+		elif demand.demand_subtype == "Principal":
+			return flt(partner.share_percentage * paid_amount) / 100
+
+
+def get_overall_partner_share(partner, paid_amount):
+	if partner.schedule_type in ("EMI (PMT) based", "Collection at partner's percentage"):
+		return flt(partner.payment_ratio * paid_amount)
+	elif partner.schedule_type == "POS reduction plus interest at partner ROI":
+		return flt(partner.share_percentage * paid_amount)
@@ -2,30 +2,40 @@
 # For license information, please see license.txt
 
 
+import time
 import traceback
+from contextlib import contextmanager
 
 import frappe
 from frappe import _
-from frappe.query_builder.functions import Coalesce, Round, Sum
+from frappe.query_builder import Case
+from frappe.query_builder.functions import Coalesce, Count, Sum
 from frappe.utils import add_days, cint, flt, get_datetime, getdate, random_string
 
 import erpnext
-from erpnext.accounts.general_ledger import (
-	make_gl_entries,
-	make_reverse_gl_entries,
-	process_gl_map,
-)
+from erpnext.accounts.general_ledger import make_reverse_gl_entries, process_gl_map
 from erpnext.controllers.accounts_controller import AccountsController
 
+from lending.gl import make_lending_gl_entries
 from lending.lending.doctype.loan_limit_change_log.loan_limit_change_log import (
 	create_loan_limit_change_log,
 )
+from lending.lending.doctype.loan_repost_request.loan_repost_request import queue_loan_repost
 from lending.lending.doctype.loan_security_assignment.loan_security_assignment import (
 	update_loan_securities_values,
 )
 from lending.lending.doctype.loan_security_shortfall.loan_security_shortfall import (
 	update_shortfall_status,
 )
+from lending.settings import (
+	get_lending_settings,
+	lending_settings_scope,
+	with_lending_settings,
+)
+
+# Loans per `bulk_repost` job when bulk payments are fanned out to the workers
+BULK_REPAYMENT_SHARD_SIZE = 200
+BULK_REPAYMENT_SHARD_TIMEOUT = 3600
 
 
 class LoanRepayment(AccountsController):
@@ -125,6 +135,7 @@ class LoanRepayment(AccountsController):
 	def before_validate(self):
 		self.set_repayment_account()
 
+	@with_lending_settings
 	def validate(self):
 		charges = None
 		if self.get("payable_charges") and self.repayment_type == "Charge Payment":
@@ -162,7 +173,7 @@ class LoanRepayment(AccountsController):
 
 		excess_amount = self.principal_amount_paid - self.pending_principal_amount
 
-		precision = cint(frappe.db.get_default("currency_precision")) or 2
+		precision = get_lending_settings().precision
 		if self.repayment_type in ("Advance Payment", "Pre Payment") and excess_amount < 0:
 			if flt(self.amount_paid, precision) > flt(self.payable_amount, precision):
 				create_update_loan_reschedule(
@@ -175,7 +186,101 @@ class LoanRepayment(AccountsController):
 					loan_disbursement=self.loan_disbursement,
 				)
 
+	@with_lending_settings
 	def on_submit(self):
+		if self.flags.from_bulk_payment:
+			return
+
+		if self.is_backdated:
+			self.create_repost()
+			return
+
+		self.flags.stage_timings = {}
+		is_regular_emi_payment = self.is_regular_emi_payment()
+
+		if is_regular_emi_payment:
+			self.submit_regular_emi_payment()
+		else:
+			self.submit_repayment()
+
+		frappe.logger("lending").debug(
+			{
+				"loan_repayment": self.name,
+				"regular_emi_payment": is_regular_emi_payment,
+				"stage_timings": self.flags.stage_timings,
+			}
+		)
+
+	@contextmanager
+	def submit_stage(self, stage):
+		"""Times a stage of the submit, timings are kept in `flags.stage_timings`"""
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			if self.flags.stage_timings is None:
+				self.flags.stage_timings = {}
+
+			self.flags.stage_timings[stage] = self.flags.stage_timings.get(stage, 0) + (
+				time.perf_counter() - start
+			)
+
+	def is_regular_emi_payment(self):
+		"""An on time EMI payment of a standard term loan that pays no penalty or charges,
+		does not close the loan and leaves no penal interest or penalty to reverse"""
+		precision = get_lending_settings().precision
+
+		if (
+			self.repayment_type != "Normal Repayment"
+			or not self.is_term_loan
+			or self.is_npa
+			or self.flags.from_repost
+			or self.flags.auto_close
+			or self.get("prepayment_charges")
+		):
+			return False
+
+		if (
+			flt(self.total_penalty_paid, precision) > 0
+			or flt(self.unbooked_penalty_paid, precision) > 0
+			or flt(self.total_charges_paid, precision) > 0
+			or flt(self.excess_amount, precision) > 0
+			or self.principal_amount_paid >= self.pending_principal_amount
+		):
+			return False
+
+		if any(d.demand_type not in ("EMI", "BPI") for d in self.get("repayment_details")):
+			return False
+
+		return not has_penal_entries_from(
+			self.against_loan, self.value_date, loan_disbursement=self.loan_disbursement
+		)
+
+	def submit_regular_emi_payment(self):
+		"""Stages of `submit_repayment` that have something to do for a regular EMI payment"""
+		with self.submit_stage("Book Demands"):
+			self.book_interest_accrued_not_demanded()
+			self.book_pending_principal()
+
+		with self.submit_stage("Paid Amounts"):
+			self.update_paid_amounts()
+
+		with self.submit_stage("Demands"):
+			self.update_demands()
+
+		with self.submit_stage("Loan Security Values"):
+			update_loan_securities_values(self.against_loan, self.principal_amount_paid, self.doctype)
+
+		with self.submit_stage("Limit Change Log"):
+			self.create_loan_limit_change_log()
+
+		with self.submit_stage("GL Entries"):
+			self.make_gl_entries()
+
+		with self.submit_stage("Classification"):
+			self.process_loan_classification()
+
+	def submit_repayment(self):
 		from lending.lending.doctype.loan_demand.loan_demand import reverse_demands
 		from lending.lending.doctype.loan_disbursement.loan_disbursement import (
 			make_sales_invoice_for_charge,
@@ -196,81 +301,86 @@ class LoanRepayment(AccountsController):
 			process_loan_interest_accrual_for_loans,
 		)
 
-		if self.flags.from_bulk_payment:
-			return
+		reversed_accruals = []
+		is_rescheduled = False
+		with self.submit_stage("Charges"):
+			make_sales_invoice_for_charge(
+				self.against_loan,
+				"loan_repayment",
+				self.name,
+				self.applicant if self.applicant_type == "Customer" else None,
+				self.posting_date,
+				self.company,
+				self.get("prepayment_charges"),
+			)
 
-		if self.is_backdated:
-			if frappe.flags.in_test:
-				self.create_repost()
-			else:
-				frappe.enqueue(
-					self.create_repost,
-					enqueue_after_commit=True,
-				)
-			return
+		with self.submit_stage("Reschedule"):
+			if self.repayment_type in ("Advance Payment", "Pre Payment"):
+				reversed_accruals += self.reverse_future_accruals_and_demands()
 
-		reversed_accruals = []
-		make_sales_invoice_for_charge(
-			self.against_loan,
-			"loan_repayment",
-			self.name,
-			self.applicant if self.applicant_type == "Customer" else None,
-			self.posting_date,
-			self.company,
-			self.get("prepayment_charges"),
-		)
+			if self.principal_amount_paid < self.pending_principal_amount:
+				if self.is_term_loan and self.repayment_type in ("Advance Payment", "Pre Payment"):
+					amounts = calculate_amounts(
+						self.against_loan,
+						self.value_date,
+						payment_type=self.repayment_type,
+						loan_disbursement=self.loan_disbursement,
+						for_update=True,
+					)
+					self.allocate_amount_against_demands(amounts, on_submit=True)
+					self.db_update_all()
+
+					create_update_loan_reschedule(
+						self.against_loan,
+						self.value_date,
+						self.name,
+						self.repayment_type,
+						self.principal_amount_paid,
+						self.unbooked_interest_paid,
+						loan_disbursement=self.loan_disbursement,
+					)
 
-		if self.repayment_type in ("Advance Payment", "Pre Payment"):
-			reversed_accruals += self.reverse_future_accruals_and_demands()
+					self.process_reschedule()
+					is_rescheduled = True
 
-		if self.principal_amount_paid < self.pending_principal_amount:
-			if self.is_term_loan and self.repayment_type in ("Advance Payment", "Pre Payment"):
-				amounts = calculate_amounts(
-					self.against_loan,
-					self.value_date,
-					payment_type=self.repayment_type,
-					loan_disbursement=self.loan_disbursement,
-					for_update=True,
-				)
-				self.allocate_amount_against_demands(amounts, on_submit=True)
-				self.db_update_all()
+		with self.submit_stage("Book Demands"):
+			if self.repayment_type not in ("Advance Payment", "Pre Payment") or (
+				self.principal_amount_paid >= self.pending_principal_amount
+			):
+				self.book_interest_accrued_not_demanded()
+				if self.is_term_loan:
+					self.book_pending_principal()
 
-				create_update_loan_reschedule(
-					self.against_loan,
-					self.value_date,
-					self.name,
-					self.repayment_type,
-					self.principal_amount_paid,
-					self.unbooked_interest_paid,
-					loan_disbursement=self.loan_disbursement,
-				)
+		with self.submit_stage("Suspense Entries"):
+			self.post_suspense_entries()
 
-				self.process_reschedule()
+		with self.submit_stage("Paid Amounts"):
+			self.update_paid_amounts()
+			self.handle_auto_demand_write_off()
 
-		if self.repayment_type not in ("Advance Payment", "Pre Payment") or (
-			self.principal_amount_paid >= self.pending_principal_amount
-		):
-			self.book_interest_accrued_not_demanded()
-			if self.is_term_loan:
-				self.book_pending_principal()
+		with self.submit_stage("Demands"):
+			self.update_demands()
+			self.update_security_deposit_amount()
 
-		self.post_suspense_entries()
+			if is_rescheduled:
+				# Counters of the new schedule are recounted once, later changes move them by deltas
+				update_installment_counts(self.against_loan, loan_disbursement=self.loan_disbursement)
 
-		self.update_paid_amounts()
-		self.handle_auto_demand_write_off()
-		self.update_demands()
-		self.update_security_deposit_amount()
-		update_installment_counts(self.against_loan, loan_disbursement=self.loan_disbursement)
+		with self.submit_stage("Settlement"):
+			if self.repayment_type == "Full Settlement":
+				if not frappe.flags.in_test:
+					frappe.enqueue(self.post_write_off_settlements, enqueue_after_commit=True)
+				else:
+					self.post_write_off_settlements()
 
-		if self.repayment_type == "Full Settlement":
-			if not frappe.flags.in_test:
-				frappe.enqueue(self.post_write_off_settlements, enqueue_after_commit=True)
-			else:
-				self.post_write_off_settlements()
+		with self.submit_stage("Loan Security Values"):
+			update_loan_securities_values(self.against_loan, self.principal_amount_paid, self.doctype)
 
-		update_loan_securities_values(self.against_loan, self.principal_amount_paid, self.doctype)
-		self.create_loan_limit_change_log()
-		self.make_gl_entries()
+		with self.submit_stage("Limit Change Log"):
+			self.create_loan_limit_change_log()
+
+		with self.submit_stage("GL Entries"):
+			self.make_gl_entries()
 
 		if (
 			self.is_term_loan
@@ -279,96 +389,102 @@ class LoanRepayment(AccountsController):
 			and not self.flags.from_repost
 		):
 			max_date = None
-			reversed_accruals += reverse_loan_interest_accruals(
-				self.against_loan,
-				self.value_date,
-				interest_type="Penal Interest",
-				is_npa=self.is_npa,
-				loan_disbursement=self.loan_disbursement,
-				on_payment_allocation=True,
-			)
-
-			if self.repayment_type in ("Full Settlement", "Write Off Settlement"):
+			with self.submit_stage("Penalty Reversal"):
 				reversed_accruals += reverse_loan_interest_accruals(
 					self.against_loan,
 					self.value_date,
-					interest_type="Normal Interest",
+					interest_type="Penal Interest",
 					is_npa=self.is_npa,
+					loan_disbursement=self.loan_disbursement,
 					on_payment_allocation=True,
 				)
 
-			reverse_demands(
-				self.against_loan,
-				self.value_date,
-				demand_type="Penalty",
-				loan_disbursement=self.loan_disbursement,
-				future_demands=True,
-			)
+				if self.repayment_type in ("Full Settlement", "Write Off Settlement"):
+					reversed_accruals += reverse_loan_interest_accruals(
+						self.against_loan,
+						self.value_date,
+						interest_type="Normal Interest",
+						is_npa=self.is_npa,
+						on_payment_allocation=True,
+					)
 
-			if reversed_accruals:
-				create_process_loan_classification(
-					posting_date=self.value_date,
-					loan_product=self.loan_product,
-					loan=self.against_loan,
+				reverse_demands(
+					self.against_loan,
+					self.value_date,
+					demand_type="Penalty",
 					loan_disbursement=self.loan_disbursement,
-					payment_reference=self.name,
-					is_backdated=1,
+					future_demands=True,
 				)
-			else:
-				if frappe.flags.in_test:
+
+			with self.submit_stage("Classification"):
+				if reversed_accruals:
 					create_process_loan_classification(
 						posting_date=self.value_date,
 						loan_product=self.loan_product,
 						loan=self.against_loan,
 						loan_disbursement=self.loan_disbursement,
-						is_backdated=0,
+						payment_reference=self.name,
+						is_backdated=1,
 					)
 				else:
-					frappe.enqueue(
-						create_process_loan_classification,
-						posting_date=self.value_date,
-						loan_product=self.loan_product,
-						loan=self.against_loan,
-						loan_disbursement=self.loan_disbursement,
-						is_backdated=0,
-						enqueue_after_commit=True,
-					)
-
-			if reversed_accruals:
-				dates = [getdate(d.get("posting_date")) for d in reversed_accruals]
-				max_date = max(dates)
-				if getdate(max_date) > getdate(self.value_date):
-					process_loan_interest_accrual_for_loans(
-						posting_date=max_date,
-						loan=self.against_loan,
-						loan_product=self.loan_product,
-						loan_disbursement=self.loan_disbursement,
-					)
-					process_daily_loan_demands(posting_date=add_days(max_date, 1), loan=self.against_loan)
+					self.process_loan_classification()
+
+			with self.submit_stage("Accruals and Demands"):
+				if reversed_accruals:
+					dates = [getdate(d.get("posting_date")) for d in reversed_accruals]
+					max_date = max(dates)
+					if getdate(max_date) > getdate(self.value_date):
+						process_loan_interest_accrual_for_loans(
+							posting_date=max_date,
+							loan=self.against_loan,
+							loan_product=self.loan_product,
+							loan_disbursement=self.loan_disbursement,
+						)
+						process_daily_loan_demands(posting_date=add_days(max_date, 1), loan=self.against_loan)
 
 		if not self.is_term_loan:
-			process_loan_interest_accrual_for_loans(
+			with self.submit_stage("Accruals and Demands"):
+				process_loan_interest_accrual_for_loans(
+					posting_date=self.value_date,
+					loan=self.against_loan,
+					loan_product=self.loan_product,
+					loan_disbursement=self.loan_disbursement,
+				)
+				process_daily_loan_demands(
+					posting_date=self.value_date,
+					loan_product=self.loan_product,
+					loan=self.against_loan,
+				)
+
+		with self.submit_stage("Auto Waiver"):
+			self.create_auto_waiver()
+
+	def process_loan_classification(self):
+		from lending.lending.doctype.process_loan_classification.process_loan_classification import (
+			create_process_loan_classification,
+		)
+
+		if frappe.flags.in_test:
+			create_process_loan_classification(
 				posting_date=self.value_date,
-				loan=self.against_loan,
 				loan_product=self.loan_product,
+				loan=self.against_loan,
 				loan_disbursement=self.loan_disbursement,
+				is_backdated=0,
 			)
-			process_daily_loan_demands(
+		else:
+			frappe.enqueue(
+				create_process_loan_classification,
 				posting_date=self.value_date,
 				loan_product=self.loan_product,
 				loan=self.against_loan,
+				loan_disbursement=self.loan_disbursement,
+				is_backdated=0,
+				enqueue_after_commit=True,
 			)
 
-		self.create_auto_waiver()
-
 	def create_repost(self):
-		repost = frappe.new_doc("Loan Repayment Repost")
-		repost.loan = self.against_loan
-		repost.loan_disbursement = self.loan_disbursement
-		repost.repost_date = self.value_date
-		repost.cancel_future_accruals_and_demands = True
-		repost.cancel_future_emi_demands = True
-		repost.submit()
+		queue_loan_repost(self.against_loan, self.value_date, loan_disbursement=self.loan_disbursement)
 
 	def post_suspense_entries(self, cancel=0):
 		from lending.lending.doctype.loan_write_off.loan_write_off import (
@@ -465,7 +581,7 @@ class LoanRepayment(AccountsController):
 		from lending.lending.doctype.loan_demand.loan_demand import create_loan_demand
 
 		overdue_principal_paid = 0
-		precision = cint(frappe.db.get_default("currency_precision")) or 2
+		precision = get_lending_settings().precision
 
 		for d in self.get("repayment_details"):
 			if d.demand_subtype == "Principal":
@@ -627,6 +743,7 @@ class LoanRepayment(AccountsController):
 			value_change=self.principal_amount_paid,
 		)
 
+	@with_lending_settings
 	def on_cancel(self):
 		from lending.lending.doctype.loan_npa_log.loan_npa_log import delink_npa_logs
 		from lending.lending.doctype.process_loan_classification.process_loan_classification import (
@@ -674,19 +791,15 @@ class LoanRepayment(AccountsController):
 		]
 		self.make_gl_entries(cancel=1)
 		self.post_suspense_entries(cancel=1)
-		update_installment_counts(self.against_loan, loan_disbursement=self.loan_disbursement)
+
+		if self.repayment_type in ("Advance Payment", "Pre Payment"):
+			update_installment_counts(self.against_loan, loan_disbursement=self.loan_disbursement)
 
 		self.check_future_entries(cancel=1)
 		if self.flags.from_bulk_payment:
 			return
 		if self.is_backdated:
-			if frappe.flags.in_test:
-				self.create_repost()
-			else:
-				frappe.enqueue(
-					self.create_repost,
-					enqueue_after_commit=True,
-				)
+			self.create_repost()
 			return
 		else:
 			# No need to do this in case of backdated prepayment as will be handled in repost
@@ -741,7 +854,7 @@ class LoanRepayment(AccountsController):
 			restructure.cancel()
 
 	def set_missing_values(self, amounts):
-		precision = cint(frappe.db.get_default("currency_precision")) or 2
+		precision = get_lending_settings().precision
 
 		self.posting_date = get_datetime()
 
@@ -895,7 +1008,7 @@ class LoanRepayment(AccountsController):
 				frappe.throw(_("Amount paid cannot be less than payable amount for loan closure"))
 
 		if self.repayment_type in ("Interest Waiver", "Penalty Waiver", "Charges Waiver"):
-			precision = cint(frappe.db.get_default("currency_precision")) or 2
+			precision = get_lending_settings().precision
 			payable_amount = self.get_waiver_amount(amounts)
 
 			if flt(self.amount_paid, precision) > flt(payable_amount, precision):
@@ -920,7 +1033,7 @@ class LoanRepayment(AccountsController):
 
 	def get_waiver_amount(self, amounts):
 
-		precision = cint(frappe.db.get_default("currency_precision")) or 2
+		precision = get_lending_settings().precision
 
 		if self.repayment_type == "Interest Waiver":
 			return flt(
@@ -937,7 +1050,7 @@ class LoanRepayment(AccountsController):
 	def book_interest_accrued_not_demanded(self):
 		from lending.lending.doctype.loan_demand.loan_demand import create_loan_demand
 
-		precision = cint(frappe.db.get_default("currency_precision")) or 2
+		precision = get_lending_settings().precision
 
 		if flt(self.unbooked_interest_paid, precision) > 0:
 			create_loan_demand(
@@ -1042,7 +1155,7 @@ class LoanRepayment(AccountsController):
 		update_shortfall_status(self.against_loan, self.principal_amount_paid)
 
 	def handle_auto_demand_write_off(self):
-		precision = cint(frappe.db.get_default("currency_precision")) or 2
+		precision = get_lending_settings().precision
 
 		overdue_principal_paid = sum(
 			d.paid_amount for d in self.get("repayment_details") if d.demand_subtype == "Principal"
@@ -1074,7 +1187,7 @@ class LoanRepayment(AccountsController):
 			create_loan_repayment,
 		)
 
-		precision = cint(frappe.db.get_default("currency_precision")) or 2
+		precision = get_lending_settings().precision
 
 		last_demand_date = get_last_demand_date(
 			self.against_loan, self.value_date, loan_disbursement=self.loan_disbursement
@@ -1172,7 +1285,7 @@ class LoanRepayment(AccountsController):
 	def auto_close_loan(self):
 		self.flags.auto_close = False
 
-		precision = cint(frappe.db.get_default("currency_precision")) or 2
+		precision = get_lending_settings().precision
 
 		auto_write_off_amount, excess_amount_limit = frappe.db.get_value(
 			"Loan Product",
@@ -1230,7 +1343,7 @@ class LoanRepayment(AccountsController):
 		return self.flags.auto_close
 
 	def get_auto_waiver_type(self, amounts):
-		precision = cint(frappe.db.get_default("currency_precision")) or 2
+		precision = get_lending_settings().precision
 
 		waiver_type = None
 
@@ -1259,7 +1372,7 @@ class LoanRepayment(AccountsController):
 			if not waiver_type:
 				return
 
-			precision = cint(frappe.db.get_default("currency_precision")) or 2
+			precision = get_lending_settings().precision
 
 			key_map = {
 				"Interest Waiver": "interest_amount",
@@ -1359,19 +1472,43 @@ class LoanRepayment(AccountsController):
 
 	def update_demands(self, cancel=0):
 		loan_demand = frappe.qb.DocType("Loan Demand")
-		for payment in self.repayment_details:
-			paid_amount = payment.paid_amount
-			partner_share = flt(payment.partner_share)
 
-			if cancel:
-				paid_amount = -1 * flt(payment.paid_amount)
-				partner_share = -1 * flt(payment.partner_share)
+		emi_demands = [d.loan_demand for d in self.repayment_details if d.demand_type == "EMI"]
+		schedule_details = []
+
+		# Reposts recount installments once they are done
+		if emi_demands and not frappe.flags.on_repost:
+			schedule_details = frappe.db.get_all(
+				"Loan Demand",
+				filters={"name": ("in", emi_demands), "repayment_schedule_detail": ("is", "set")},
+				pluck="repayment_schedule_detail",
+			)
 
+		states_before = get_installment_states(self.against_loan, schedule_details)
+
+		# Every demand paid by the repayment is updated in a single statement
+		paid_map = {}
+		for payment in self.repayment_details:
+			paid = paid_map.setdefault(payment.loan_demand, [0, 0])
+			paid[0] += flt(payment.paid_amount)
+			paid[1] += flt(payment.partner_share)
+
+		if paid_map:
 			if self.repayment_type in ("Interest Waiver", "Penalty Waiver", "Charges Waiver"):
 				paid_amount_field = "waived_amount"
 			else:
 				paid_amount_field = "paid_amount"
 
+			sign = -1 if cancel else 1
+			paid_amount = Case()
+			partner_share = Case()
+			for demand, (amount, share) in paid_map.items():
+				paid_amount = paid_amount.when(loan_demand.name == demand, sign * amount)
+				partner_share = partner_share.when(loan_demand.name == demand, sign * share)
+
+			paid_amount = paid_amount.else_(0)
+			partner_share = partner_share.else_(0)
+
 			frappe.qb.update(loan_demand).set(
 				loan_demand[paid_amount_field], loan_demand[paid_amount_field] + paid_amount
 			).set(
@@ -1380,9 +1517,17 @@ class LoanRepayment(AccountsController):
 				loan_demand.partner_share_allocated,
 				loan_demand.partner_share_allocated + partner_share,
 			).where(
-				loan_demand.name == payment.loan_demand
+				loan_demand.name.isin(list(paid_map))
 			).run()
 
+		if schedule_details:
+			apply_installment_count_deltas(
+				self.against_loan,
+				states_before,
+				get_installment_states(self.against_loan, schedule_details),
+				loan_disbursement=self.loan_disbursement,
+			)
+
 	def update_limits(self, query, loan, cancel=0):
 		principal_amount_paid = self.principal_amount_paid
 		if cancel:
@@ -1425,7 +1570,7 @@ class LoanRepayment(AccountsController):
 			get_write_off_waivers,
 		)
 
-		precision = cint(frappe.db.get_default("currency_precision")) or 2
+		precision = get_lending_settings().precision
 		loan_status = frappe.db.get_value("Loan", self.against_loan, "status")
 
 		if not on_submit:
@@ -1643,7 +1788,7 @@ class LoanRepayment(AccountsController):
 
 	def set_partner_payment_ratio(self):
 		if self.get("loan_partner"):
-			precision = cint(frappe.db.get_default("currency_precision")) or 2
+			precision = get_lending_settings().precision
 
 			schedule_details = frappe.db.get_value(
 				"Loan Repayment Schedule",
@@ -1739,120 +1884,37 @@ class LoanRepayment(AccountsController):
 
 	def apply_allocation_order(self, allocation_order, pending_amount, demands, status=None):
 		"""Allocate amount based on allocation order"""
-		allocation_order_doc = frappe.get_doc("Loan Demand Offset Order", allocation_order)
-		for d in allocation_order_doc.get("components"):
-			if d.demand_type == "EMI (Principal + Interest)" and pending_amount > 0:
-				pending_amount = self.adjust_component(pending_amount, "BPI", demands)
-				if self.is_term_loan:
-					pending_amount = self.adjust_component(pending_amount, "EMI", demands)
-			if d.demand_type == "Principal" and pending_amount > 0:
-				pending_amount = self.adjust_component(pending_amount, "Normal", demands)
-				if self.is_term_loan:
-					pending_amount = self.adjust_component(
-						pending_amount, "EMI", demands, demand_subtype="Principal"
-					)
-				if (
-					self.repayment_type
-					in (
-						"Partial Settlement",
-						"Full Settlement",
-						"Write Off Recovery",
-						"Write Off Settlement",
-						"Principal Adjustment",
-					)
-					or status == "Settled"
-					and self.repayment_type not in ("Interest Waiver", "Penalty Waiver", "Charges Waiver")
-				):
-					principal_amount_paid = sum(
-						d.paid_amount for d in self.get("repayment_details") if d.demand_subtype == "Principal"
-					)
-					payable_principal_amount = self.pending_principal_amount - principal_amount_paid
-					if flt(pending_amount) >= payable_principal_amount:
-						self.principal_amount_paid += payable_principal_amount
-						pending_amount -= payable_principal_amount
-					else:
-						self.principal_amount_paid += pending_amount
-						pending_amount = 0
-
-			if d.demand_type == "Normal" and pending_amount > 0:
-				pending_amount = self.adjust_component(
-					pending_amount, "Normal", demands, demand_subtype="Interest"
-				)
-				pending_amount = self.adjust_component(
-					pending_amount, "EMI", demands, demand_subtype="Interest"
-				)
-			if d.demand_type == "Penalty" and pending_amount > 0:
-				pending_amount = self.adjust_component(pending_amount, "Penalty", demands)
-			if d.demand_type == "Additional Interest" and pending_amount > 0:
-				pending_amount = self.adjust_component(pending_amount, "Additional Interest", demands)
-			if d.demand_type == "Charges" and pending_amount > 0:
-				pending_amount = self.adjust_component(pending_amount, "Charges", demands)
+		from lending.lending.doctype.loan_repayment.allocation import allocate_amount
+
+		result = allocate_amount(
+			pending_amount,
+			demands,
+			allocation_order,
+			is_term_loan=self.is_term_loan,
+			repayment_type=self.repayment_type,
+			loan_status=status,
+			pending_principal_amount=self.pending_principal_amount,
+			partner=self.get_partner_share_terms(),
+		)
 
-		return pending_amount
+		for allocation in result.allocations:
+			self.append("repayment_details", allocation)
 
-	def adjust_component(self, amount_to_adjust, demand_type, demands, demand_subtype=None):
-		partner_share = 0
-		precision = cint(frappe.db.get_default("currency_precision")) or 2
+		self.principal_amount_paid += result.principal_amount_paid
 
-		if self.get("loan_partner"):
-			partner_share = self.get_overall_partner_share(amount_to_adjust) or 0
+		return result.unallocated_amount
 
-		for demand in demands:
-			paid_amount = 0
-			partner_share_paid = 0
-
-			if demand.demand_type == demand_type:
-				if not demand_subtype or demand.demand_subtype == demand_subtype:
-					if amount_to_adjust >= demand.outstanding_amount:
-						paid_amount = flt(demand.outstanding_amount)
-						amount_to_adjust -= flt(demand.outstanding_amount)
-
-						if demand_type == "EMI" and self.get("loan_partner"):
-							partner_share_paid = self.get_loan_partner_share_paid(0, paid_amount, demand) or 0
-							partner_share -= partner_share_paid
-					elif amount_to_adjust > 0:
-						paid_amount = amount_to_adjust
-						amount_to_adjust = 0
-
-						if demand_type == "EMI" and self.get("loan_partner"):
-							partner_share_paid = (
-								self.get_loan_partner_share_paid(partner_share, paid_amount, demand) or 0
-							)
-							partner_share -= partner_share_paid
-
-					if flt(paid_amount, precision) > 0:
-						self.append(
-							"repayment_details",
-							{
-								"loan_demand": demand.name,
-								"paid_amount": paid_amount,
-								"demand_type": demand.demand_type,
-								"demand_subtype": demand.demand_subtype,
-								"sales_invoice": demand.sales_invoice,
-								"partner_share": partner_share_paid,
-							},
-						)
+	def get_partner_share_terms(self):
+		from lending.lending.doctype.loan_repayment.allocation import PartnerShareTerms
 
-		return amount_to_adjust
-
-	def get_loan_partner_share_paid(self, amount_to_adjust, paid_amount, demand):
-		if self.loan_partner_repayment_schedule_type == "EMI (PMT) based":
-			return flt(amount_to_adjust) or flt(demand.partner_outstanding)
-		elif self.loan_partner_repayment_schedule_type == "Collection at partner's percentage":
-			return flt(self.loan_partner_payment_ratio * paid_amount)
-		elif self.loan_partner_repayment_schedule_type == "POS reduction plus interest at partner ROI":
-			if demand.demand_subtype == "Interest":
-				return flt(self.loan_partner_payment_ratio * paid_amount)
-			elif demand.demand_subtype == "Principal":
-				return flt(self.loan_partner_share_percentage * paid_amount) / 100
-
-	def get_overall_partner_share(self, paid_amount):
-		if self.loan_partner_repayment_schedule_type == "EMI (PMT) based":
-			return flt(self.loan_partner_payment_ratio * paid_amount)
-		elif self.loan_partner_repayment_schedule_type == "Collection at partner's percentage":
-			return flt(self.loan_partner_payment_ratio * paid_amount)
-		elif self.loan_partner_repayment_schedule_type == "POS reduction plus interest at partner ROI":
-			return flt(self.loan_partner_share_percentage * paid_amount)
+		if not self.get("loan_partner"):
+			return None
+
+		return PartnerShareTerms(
+			schedule_type=self.loan_partner_repayment_schedule_type,
+			payment_ratio=flt(self.loan_partner_payment_ratio),
+			share_percentage=flt(self.loan_partner_share_percentage),
+		)
 
 	def make_gl_entries(self, cancel=0, adv_adj=0):
 		from lending.lending.doctype.loan_restructure.loan_restructure import (
@@ -1879,10 +1941,10 @@ class LoanRepayment(AccountsController):
 			merge_entries = False
 
 		if gle_map:
-			make_gl_entries(gle_map, merge_entries=merge_entries, cancel=cancel, adv_adj=adv_adj)
+			make_lending_gl_entries(gle_map, merge_entries=merge_entries, cancel=cancel, adv_adj=adv_adj)
 
 	def get_gl_map(self):
-		precision = cint(frappe.db.get_default("currency_precision")) or 2
+		precision = get_lending_settings().precision
 		gle_map = []
 		payment_account = self.get_payment_account()
 
@@ -2061,7 +2123,7 @@ class LoanRepayment(AccountsController):
 		if self.repayment_type == "Penalty Waiver":
 			return
 
-		precision = cint(frappe.db.get_default("currency_precision")) or 2
+		precision = get_lending_settings().precision
 
 		payment_account = self.get_payment_account()
 		total_payment_amount = sum(d.debit for d in gle_map if d.account == payment_account)
@@ -2077,7 +2139,7 @@ class LoanRepayment(AccountsController):
 			self.add_gl_entry(payment_account, round_off_account, -1 * diff, gle_map, is_waiver_entry=True)
 
 	def add_loan_partner_gl_entries(self, gle_map):
-		precision = cint(frappe.db.get_default("currency_precision")) or 2
+		precision = get_lending_settings().precision
 		partner_details = frappe.db.get_value(
 			"Loan Partner",
 			self.loan_partner,
@@ -2257,9 +2319,9 @@ class LoanRepayment(AccountsController):
 		}
 		offset_field = offset_mapping[offset_name]
 
-		allocation_order = frappe.db.get_value("Loan Product", self.loan_product, offset_field)
-		if not allocation_order:
-			allocation_order = frappe.db.get_value("Company", self.company, offset_field)
+		allocation_order = get_lending_settings().get_offset_sequence(
+			self.loan_product, self.company, offset_field
+		)
 
 		if not allocation_order:
 			frappe.throw(_("Please set {0} in either Company or Loan Product").format(offset_name))
@@ -2363,6 +2425,34 @@ def create_repayment_entry(
 	return lr
 
 
+def has_penal_entries_from(loan, value_date, loan_disbursement=None):
+	"""Whether a payment on `value_date` has penal interest accruals or penalty demands
+	to reverse, as `LoanRepayment.submit_repayment` reverses them"""
+	value_date = getdate(value_date)
+
+	accrual_filters = {
+		"loan": loan,
+		"docstatus": 1,
+		"interest_type": ("in", ["Penal Interest", "Additional Interest"]),
+		"posting_date": (">=", value_date),
+	}
+	demand_filters = {
+		"loan": loan,
+		"docstatus": 1,
+		"demand_type": ("in", ["Penalty", "Additional Interest"]),
+		"demand_date": (">", value_date),
+	}
+
+	if loan_disbursement:
+		accrual_filters["loan_disbursement"] = loan_disbursement
+		demand_filters["loan_disbursement"] = loan_disbursement
+
+	return bool(
+		frappe.db.exists("Loan Interest Accrual", accrual_filters)
+		or frappe.db.exists("Loan Demand", demand_filters)
+	)
+
+
 def get_unpaid_demands(
 	against_loan,
 	posting_date=None,
@@ -2379,7 +2469,7 @@ def get_unpaid_demands(
 	if not posting_date:
 		posting_date = getdate()
 
-	precision = cint(frappe.db.get_default("currency_precision")) or 2
+	precision = get_lending_settings().precision
 
 	loan_demand = frappe.qb.DocType("Loan Demand")
 	query = get_demand_query()
@@ -2389,7 +2479,7 @@ def get_unpaid_demands(
 			(loan_demand.loan == against_loan)
 			& (loan_demand.docstatus == 1)
 			& (loan_demand.demand_date <= posting_date)
-			& (Round(loan_demand.outstanding_amount, precision) > 0)
+			& get_unpaid_demand_condition(loan_demand, precision)
 		)
 		.orderby(loan_demand.demand_date)
 		.orderby(loan_demand.disbursement_date)
@@ -2462,8 +2552,15 @@ def get_demand_query():
 	)
 
 
+def get_unpaid_demand_condition(loan_demand, precision):
+	"""Same as `ROUND(outstanding_amount, precision) > 0` on the bare column, so that the
+	outstanding amount can be read from the index. ROUND rounds half away from zero, an
+	amount rounds to more than zero from half of the smallest unit onwards."""
+	return loan_demand.outstanding_amount >= 0.5 / 10**precision
+
+
 def get_pending_principal_amount(loan, loan_disbursement=None):
-	precision = cint(frappe.db.get_default("currency_precision")) or 2
+	precision = get_lending_settings().precision
 
 	LoanDisbursement = frappe.qb.DocType("Loan Disbursement")
 	if loan_disbursement and loan.repayment_schedule_type == "Line of Credit":
@@ -2566,7 +2663,7 @@ def process_amount_for_loan(
 		calculate_penal_interest_for_loans,
 	)
 
-	precision = cint(frappe.db.get_default("currency_precision")) or 2
+	precision = get_lending_settings().precision
 	total_pending_interest = 0
 	charges = 0
 	penalty_amount = 0
@@ -2637,70 +2734,92 @@ def process_amount_for_loan(
 	return amounts
 
 
+BULK_DUE_LOAN_FIELDS = (
+	"name",
+	"repayment_schedule_type",
+	"company",
+	"rate_of_interest",
+	"is_term_loan",
+	"written_off_amount",
+	"excess_amount_paid",
+	"status",
+	"total_payment",
+	"total_principal_paid",
+	"total_interest_payable",
+	"refund_amount",
+	"debit_adjustment_amount",
+	"credit_adjustment_amount",
+	"disbursed_amount",
+)
+
+
 @frappe.whitelist()
 def get_bulk_due_details(loans, posting_date):
+	"""Dues of `loans` as of `posting_date`, a row per loan or per line of credit
+	disbursement. Every input is read with a grouped query, so the number of queries
+	does not grow with the number of loans.
+
+	Pending principal, unbooked interest and security deposit are read from the `Loan
+	Balance Snapshot` of the loans with nothing demanded or accrued after
+	`posting_date`, and computed for the rest."""
+	from lending.lending.doctype.loan_balance_snapshot.loan_balance_snapshot import (
+		get_loan_balance_snapshots,
+	)
 	from lending.lending.doctype.loan_repayment.utils import (
 		get_disbursement_map,
-		get_last_demand_date,
+		get_last_demand_date_map,
 		get_pending_principal_amount_for_loans,
+		get_unbooked_interest_map,
 		process_amount_for_bulk_loans,
 	)
 
-	last_demand_dates = {loan: get_last_demand_date(posting_date, loan=loan) for loan in loans}
+	loans = frappe.parse_json(loans)
+	if not loans:
+		return []
 
 	loan_details = frappe.db.get_all(
-		"Loan",
-		fields=[
-			"name",
-			"repayment_schedule_type",
-			"company",
-			"rate_of_interest",
-			"is_term_loan",
-			"written_off_amount",
-			"status",
-			"total_payment",
-			"total_principal_paid",
-			"total_interest_payable",
-			"refund_amount",
-			"debit_adjustment_amount",
-			"credit_adjustment_amount",
-			"disbursed_amount",
-		],
-		filters={"name": ("in", loans)},
+		"Loan", fields=list(BULK_DUE_LOAN_FIELDS), filters={"name": ("in", loans)}
 	)
 
-	disbursement_map = get_disbursement_map(loan_details)
-	principal_amount_map = get_pending_principal_amount_for_loans(loan_details, disbursement_map)
+	snapshots = get_loan_balance_snapshots(loans, posting_date=posting_date)
+	computed_loans = [loan for loan in loan_details if loan.name not in snapshots]
+	computed_loan_names = [loan.name for loan in computed_loans]
 
-	unbooked_interest_map = {
-		loan: get_unbooked_interest(
-			loan=loan, posting_date=posting_date, last_demand_date=last_demand_dates[loan]
+	disbursement_map = get_disbursement_map(loan_details)
+	last_demand_dates = {}
+	principal_amount_map = {}
+	unbooked_interest_map = {}
+	available_security_deposit_map = {}
+
+	if computed_loans:
+		last_demand_dates = get_last_demand_date_map(computed_loan_names, posting_date)
+		principal_amount_map = get_pending_principal_amount_for_loans(computed_loans, disbursement_map)
+		unbooked_interest_map = get_unbooked_interest_map(computed_loans, posting_date)
+
+		loan_security_deposit_doc = frappe.qb.DocType("Loan Security Deposit")
+		loan_doc = frappe.qb.DocType("Loan")
+		query = (
+			frappe.qb.from_(loan_doc)
+			.select(loan_doc.name, Coalesce(Sum(loan_security_deposit_doc.available_amount), 0))
+			.left_join(loan_security_deposit_doc)
+			.on(loan_security_deposit_doc.loan == loan_doc.name)
+			.where(loan_doc.name.isin(computed_loan_names))
+			.groupby(loan_doc.name)
 		)
-		for loan in loans
-	}
+		available_security_deposit_map = dict(query.run(as_list=1))
+
+	for key, snapshot in snapshots.items():
+		principal_amount_map[key] = snapshot.pending_principal_amount
+		unbooked_interest_map[key] = snapshot.unbooked_interest
+		last_demand_dates[snapshot.loan] = snapshot.due_date
+		available_security_deposit_map[snapshot.loan] = snapshot.available_security_deposit
+
 	loan_demands = get_all_demands(loans, posting_date)
 
 	demand_map = {}
 	for loan in loan_demands:
 		demand_map.setdefault(loan.loan, [])
 		demand_map[loan.loan].append(loan)
-
-	# Get unbooked interest for all loans
-	loan_security_deposit_doc = frappe.qb.DocType("Loan Security Deposit")
-	loan_doc = frappe.qb.DocType("Loan")
-	query = (
-		frappe.qb.from_(loan_doc)
-		.select(loan_doc.name, Coalesce(Sum(loan_security_deposit_doc.available_amount), 0))
-		.left_join(loan_security_deposit_doc)
-		.on(loan_security_deposit_doc.loan == loan_doc.name)
-		.where(loan_doc.name.isin(loans))
-		.groupby(loan_doc.name)
-	)
-	available_security_deposit_list = query.run(as_list=1)
-	available_security_deposit_map = {
-		available_security_deposit_item[0]: available_security_deposit_item[1]
-		for available_security_deposit_item in available_security_deposit_list
-	}
 	due_details = []
 	for loan in loan_details:
 		if loan.repayment_schedule_type == "Line of Credit":
@@ -2719,6 +2838,7 @@ def get_bulk_due_details(loans, posting_date):
 					amounts,
 					posting_date,
 					available_security_deposit_map,
+					last_demand_date=last_demand_dates.get(loan.name),
 				)
 				due_details.append(amounts)
 		else:
@@ -2735,22 +2855,99 @@ def get_bulk_due_details(loans, posting_date):
 				amounts,
 				posting_date,
 				available_security_deposit_map,
+				last_demand_date=last_demand_dates.get(loan.name),
 			)
 			due_details.append(amounts)
 
 	return due_details
 
 
+@frappe.whitelist(methods=["POST"])
+def get_bulk_closure_amounts(loans, posting_date):
+	"""Closure quotes for `loans` as of `posting_date`, the bulk counterpart of
+	`calculate_amounts` with the Loan Closure payment type.
+
+	Interest and penalty not yet accrued till `posting_date` are projected for all the
+	loans together, so quoting a whole portfolio takes a fixed number of queries."""
+	from lending.lending.doctype.loan_interest_accrual.loan_interest_accrual import (
+		get_accrual_loans_query,
+	)
+	from lending.lending.doctype.loan_interest_accrual.projection import project_accruals
+
+	frappe.has_permission("Loan", "read", throw=True)
+
+	loans = frappe.parse_json(loans)
+	if not loans:
+		return []
+
+	precision = get_lending_settings().precision
+	posting_date = getdate(posting_date)
+
+	with lending_settings_scope():
+		due_details = get_bulk_due_details(loans, posting_date)
+
+		loan = frappe.qb.DocType("Loan")
+		accruing_loans = get_accrual_loans_query().where(loan.name.isin(loans)).run(as_dict=1)
+		projections = project_accruals(accruing_loans, posting_date)
+
+	line_of_credit_loans = {
+		amounts["loan"] for amounts in due_details if amounts.get("loan_disbursement")
+	}
+	unaccrued_map = {}
+	for projection in projections.values():
+		for accrual in projection.accruals:
+			key = (
+				(accrual.loan, accrual.loan_disbursement)
+				if accrual.loan in line_of_credit_loans
+				else accrual.loan
+			)
+			unaccrued = unaccrued_map.setdefault(key, {"interest": 0.0, "penalty": 0.0})
+			if accrual.interest_type == "Normal Interest":
+				unaccrued["interest"] += accrual.interest_amount
+			else:
+				unaccrued["penalty"] += accrual.interest_amount
+
+	for amounts in due_details:
+		key = (
+			(amounts["loan"], amounts["loan_disbursement"])
+			if amounts.get("loan_disbursement")
+			else amounts["loan"]
+		)
+		unaccrued = unaccrued_map.get(key, {})
+		amounts["unaccrued_interest"] = flt(unaccrued.get("interest"), precision)
+		amounts["unbooked_penalty"] = flt(unaccrued.get("penalty"), precision)
+
+		amounts["payable_principal_amount"] = amounts["pending_principal_amount"]
+		amounts["interest_amount"] = flt(
+			amounts["interest_amount"] + amounts["unbooked_interest"] + amounts["unaccrued_interest"],
+			precision,
+		)
+		amounts["penalty_amount"] = flt(
+			amounts["penalty_amount"] + amounts["unbooked_penalty"], precision
+		)
+		amounts["payable_amount"] = flt(
+			amounts["payable_principal_amount"]
+			+ amounts["interest_amount"]
+			+ amounts["penalty_amount"]
+			+ amounts.get("total_charges_payable", 0),
+			precision,
+		)
+		# the quote is the only thing the desks need, not the demands behind it
+		amounts.pop("unpaid_demands", None)
+
+	return due_details
+
+
 def get_all_demands(loans, posting_date):
 	loan_demand = frappe.qb.DocType("Loan Demand")
 
-	precision = cint(frappe.db.get_default("currency_precision")) or 2
+	precision = get_lending_settings().precision
 	query = get_demand_query()
 	query = (
 		query.where(loan_demand.docstatus == 1)
 		.where(loan_demand.loan.isin(loans))
 		.where(loan_demand.demand_date <= posting_date)
-		.where(Round(loan_demand.outstanding_amount, precision) > 0)
+		.where(get_unpaid_demand_condition(loan_demand, precision))
 	)
 
 	return query.run(as_dict=1)
@@ -2831,7 +3028,7 @@ def init_amounts():
 
 
 def update_installment_counts(against_loan, loan_disbursement=None):
-	precision = cint(frappe.db.get_default("currency_precision")) or 2
+	precision = get_lending_settings().precision
 
 	loan_demand = frappe.qb.DocType("Loan Demand")
 	query = (
@@ -2890,6 +3087,219 @@ def update_installment_counts(against_loan, loan_disbursement=None):
 	)
 
 
+def get_installment_states(against_loan, repayment_schedule_details):
+	"""Number of EMI demands and their total outstanding for each installment raised against
+	the given schedule details, keyed by (repayment_schedule_detail, demand_date)"""
+	if not repayment_schedule_details:
+		return {}
+
+	loan_demand = frappe.qb.DocType("Loan Demand")
+	query = (
+		frappe.qb.from_(loan_demand)
+		.select(
+			loan_demand.repayment_schedule_detail,
+			loan_demand.demand_date,
+			Count(loan_demand.name).as_("demand_count"),
+			Sum(loan_demand.outstanding_amount).as_("total_outstanding_amount"),
+		)
+		.where(
+			(loan_demand.loan == against_loan)
+			& (loan_demand.docstatus == 1)
+			& (loan_demand.demand_type == "EMI")
+			& (loan_demand.repayment_schedule_detail.isin(list(set(repayment_schedule_details))))
+		)
+		.groupby(
+			loan_demand.repayment_schedule_detail,
+			loan_demand.demand_date,
+		)
+	)
+
+	return {
+		(d.repayment_schedule_detail, getdate(d.demand_date)): (
+			d.demand_count,
+			flt(d.total_outstanding_amount),
+		)
+		for d in query.run(as_dict=1)
+	}
+
+
+def apply_installment_count_deltas(
+	against_loan, states_before, states_after, loan_disbursement=None
+):
+	"""Moves the installment counters of the active schedule by the difference between
+	two sets of installment states instead of recounting every demand of the loan"""
+	precision = get_lending_settings().precision
+
+	def get_counts(state):
+		if not state or not state[0]:
+			return 0, 0, 0
+
+		is_paid = flt(state[1], precision) <= 0
+		return 1, cint(is_paid), cint(not is_paid)
+
+	raised = paid = overdue = 0
+	for key in set(states_before) | set(states_after):
+		before = get_counts(states_before.get(key))
+		after = get_counts(states_after.get(key))
+
+		raised += after[0] - before[0]
+		paid += after[1] - before[1]
+		overdue += after[2] - before[2]
+
+	if not (raised or paid or overdue):
+		return
+
+	# Counted as `rebuild_installment_counts` counts them, loan wise on the only active
+	# schedule and disbursement wise when a loan has an active schedule per disbursement
+	schedules = frappe.db.get_all(
+		"Loan Repayment Schedule",
+		filters={"loan": against_loan, "docstatus": 1, "status": "Active"},
+		fields=["name", "loan_disbursement"],
+	)
+
+	if len(schedules) > 1:
+		schedules = [d for d in schedules if d.loan_disbursement == loan_disbursement]
+
+	if not schedules:
+		return
+
+	schedule = schedules[0].name
+
+	loan_repayment_schedule = frappe.qb.DocType("Loan Repayment Schedule")
+	frappe.qb.update(loan_repayment_schedule).set(
+		loan_repayment_schedule.total_installments_raised,
+		loan_repayment_schedule.total_installments_raised + raised,
+	).set(
+		loan_repayment_schedule.total_installments_paid,
+		loan_repayment_schedule.total_installments_paid + paid,
+	).set(
+		loan_repayment_schedule.total_installments_overdue,
+		loan_repayment_schedule.total_installments_overdue + overdue,
+	).where(
+		loan_repayment_schedule.name == schedule
+	).run()
+
+
+def update_installment_counts_for_demands(demands, cancel=0):
+	"""Applies the counter change caused by submitting or cancelling EMI demands. Called
+	after the change, the earlier installment states are derived from the current ones."""
+	# counters are kept on the schedule of each disbursement
+	demands_by_loan = {}
+	for demand in demands:
+		if demand.demand_type == "EMI" and demand.repayment_schedule_detail:
+			key = (demand.loan, demand.get("loan_disbursement") or None)
+			demands_by_loan.setdefault(key, []).append(demand)
+
+	for (loan, loan_disbursement), loan_demands in demands_by_loan.items():
+		states_after = get_installment_states(
+			loan, [demand.repayment_schedule_detail for demand in loan_demands]
+		)
+		states_before = dict(states_after)
+
+		sign = 1 if cancel else -1
+		for demand in loan_demands:
+			key = (demand.repayment_schedule_detail, getdate(demand.demand_date))
+			demand_count, outstanding_amount = states_before.get(key, (0, 0))
+			states_before[key] = (
+				demand_count + sign,
+				outstanding_amount + sign * flt(demand.outstanding_amount),
+			)
+
+		apply_installment_count_deltas(
+			loan, states_before, states_after, loan_disbursement=loan_disbursement
+		)
+
+
+def rebuild_installment_counts(loans=None, batch_size=1000):
+	"""Maintenance job that recounts installments of active schedules and repairs the
+	counters that drifted from the demands"""
+	precision = get_lending_settings().precision
+
+	if not loans:
+		loans = frappe.db.get_all(
+			"Loan Repayment Schedule",
+			filters={"docstatus": 1, "status": "Active"},
+			pluck="loan",
+			distinct=True,
+		)
+
+	loan_demand = frappe.qb.DocType("Loan Demand")
+
+	for i in range(0, len(loans), batch_size):
+		batch = loans[i : i + batch_size]
+
+		installments = (
+			frappe.qb.from_(loan_demand)
+			.select(
+				loan_demand.loan,
+				loan_demand.loan_disbursement,
+				Sum(loan_demand.outstanding_amount).as_("total_outstanding_amount"),
+			)
+			.where(
+				(loan_demand.loan.isin(batch))
+				& (loan_demand.docstatus == 1)
+				& (loan_demand.demand_type == "EMI")
+				& (loan_demand.repayment_schedule_detail.isnotnull())
+			)
+			.groupby(
+				loan_demand.loan,
+				loan_demand.repayment_schedule_detail,
+				loan_demand.demand_date,
+			)
+		).run(as_dict=1)
+
+		# Counted loan wise and, for loans with an active schedule per disbursement, disbursement wise
+		counts = {}
+		for installment in installments:
+			is_paid = flt(installment.total_outstanding_amount, precision) <= 0
+			for key in (installment.loan, (installment.loan, installment.loan_disbursement)):
+				raised, paid, overdue = counts.get(key, (0, 0, 0))
+				counts[key] = (raised + 1, paid + cint(is_paid), overdue + cint(not is_paid))
+
+		schedules = frappe.db.get_all(
+			"Loan Repayment Schedule",
+			filters={"loan": ("in", batch), "docstatus": 1, "status": "Active"},
+			fields=[
+				"name",
+				"loan",
+				"loan_disbursement",
+				"total_installments_raised",
+				"total_installments_paid",
+				"total_installments_overdue",
+			],
+		)
+
+		schedules_per_loan = {}
+		for schedule in schedules:
+			schedules_per_loan[schedule.loan] = schedules_per_loan.get(schedule.loan, 0) + 1
+
+		for schedule in schedules:
+			key = schedule.loan
+			if schedules_per_loan[schedule.loan] > 1:
+				key = (schedule.loan, schedule.loan_disbursement)
+
+			expected = counts.get(key, (0, 0, 0))
+			current = (
+				cint(schedule.total_installments_raised),
+				cint(schedule.total_installments_paid),
+				cint(schedule.total_installments_overdue),
+			)
+
+			if current != expected:
+				frappe.db.set_value(
+					"Loan Repayment Schedule",
+					schedule.name,
+					{
+						"total_installments_raised": expected[0],
+						"total_installments_paid": expected[1],
+						"total_installments_overdue": expected[2],
+					},
+					update_modified=False,
+				)
+
+		frappe.db.commit()
+
+
 def get_last_demand_date(
 	loan, posting_date, demand_subtype="Interest", loan_disbursement=None, status=None
 ):
@@ -2944,7 +3354,7 @@ def get_latest_accrual_date(
 
 
 def get_unbooked_interest(loan, posting_date, loan_disbursement=None, last_demand_date=None):
-	precision = cint(frappe.db.get_default("currency_precision")) or 2
+	precision = get_lending_settings().precision
 
 	accrued_interest = get_accrued_interest(
 		loan, posting_date, loan_disbursement=loan_disbursement, last_demand_date=last_demand_date
@@ -3010,11 +3420,30 @@ def post_bulk_payments(data):
 	# custom hash best
 	trace_id = random_string(10)
 
+	# one log per loan upfront, so the trace reports pending loans while the shards run
+	queue_bulk_repayment_logs(grouped_by_loan, trace_id)
+	# the queued logs have to survive the rollback of a failing loan in the shards
+	frappe.db.commit()  # nosemgrep
+
+	shards = get_bulk_repayment_shards(grouped_by_loan)
+
 	if frappe.flags.in_test:
-		bulk_repost(grouped_by_loan, trace_id)
+		for shard in shards:
+			bulk_repost(shard, trace_id)
 	else:
-		job = frappe.enqueue(bulk_repost, grouped_by_loan=grouped_by_loan, trace_id=trace_id)
-		return {"job_id": job.id, "trace_id": trace_id}
+		job_ids = []
+		for shard in shards:
+			job = frappe.enqueue(
+				bulk_repost,
+				grouped_by_loan=shard,
+				trace_id=trace_id,
+				queue="long",
+				timeout=BULK_REPAYMENT_SHARD_TIMEOUT,
+				enqueue_after_commit=True,
+			)
+			job_ids.append(job.id)
+
+		return {"job_id": job_ids[0], "job_ids": job_ids, "trace_id": trace_id}
 
 
 def group_by_loan(data):
@@ -3026,15 +3455,101 @@ def group_by_loan(data):
 	return grouped_by_loan
 
 
+def get_bulk_repayment_shards(grouped_by_loan, shard_size=BULK_REPAYMENT_SHARD_SIZE):
+	"""Splits the loans into shards of `shard_size` loans each.
+
+	Loans are independent of each other, so shards are processed by separate workers
+	while the payments of a loan stay together and in value date order."""
+	loans = list(grouped_by_loan)
+	return [
+		{loan: grouped_by_loan[loan] for loan in loans[i : i + shard_size]}
+		for i in range(0, len(loans), shard_size)
+	]
+
+
+def queue_bulk_repayment_logs(grouped_by_loan, trace_id):
+	from lending.utils import bulk_insert_documents
+
+	timestamp = get_datetime()
+	logs = []
+	for loan, rows in grouped_by_loan.items():
+		log = frappe.new_doc("Bulk Repayment Log")
+		log.update(
+			{
+				"name": f"Bulk Repayment for {loan} at {timestamp}",
+				"loan": loan,
+				"timestamp": timestamp,
+				"details": str(rows),
+				"trace_id": trace_id,
+				"status": "Queued",
+			}
+		)
+		logs.append(log)
+
+	bulk_insert_documents(logs)
+
+
+@frappe.whitelist()
+def get_bulk_payment_status(trace_id):
+	"""Progress of a `post_bulk_payments` call, can be polled while its shards are running"""
+	bulk_repayment_log = frappe.qb.DocType("Bulk Repayment Log")
+	counts = dict(
+		frappe.qb.from_(bulk_repayment_log)
+		.select(bulk_repayment_log.status, Count(bulk_repayment_log.name))
+		.where(bulk_repayment_log.trace_id == trace_id)
+		.where(bulk_repayment_log.docstatus < 2)
+		.groupby(bulk_repayment_log.status)
+		.run()
+	)
+
+	status = frappe._dict(
+		trace_id=trace_id,
+		total=sum(counts.values()),
+		completed=counts.get("Success", 0),
+		failed=counts.get("Failure", 0),
+		pending=counts.get("Queued", 0),
+	)
+	status.failed_loans = (
+		frappe.get_all(
+			"Bulk Repayment Log",
+			filters={"trace_id": trace_id, "status": "Failure", "docstatus": 1},
+			pluck="loan",
+		)
+		if status.failed
+		else []
+	)
+
+	return status
+
+
 # Function that can be nicely enqueued
+@with_lending_settings
 def bulk_repost(grouped_by_loan, trace_id):
+	queued_logs = dict(
+		frappe.get_all(
+			"Bulk Repayment Log",
+			filters={
+				"trace_id": trace_id,
+				"loan": ("in", list(grouped_by_loan)),
+				"status": "Queued",
+				"docstatus": 0,
+			},
+			fields=["loan", "name"],
+			as_list=True,
+		)
+	)
+
 	for loan, rows in grouped_by_loan.items():
-		bulk_repayment_log = frappe.new_doc("Bulk Repayment Log")
-		bulk_repayment_log.loan = loan
-		bulk_repayment_log.timestamp = frappe.utils.get_datetime()
-		bulk_repayment_log.details = str(rows)
-		bulk_repayment_log.trace_id = trace_id
+		if queued_logs.get(loan):
+			bulk_repayment_log = frappe.get_doc("Bulk Repayment Log", queued_logs[loan])
+		else:
+			bulk_repayment_log = frappe.new_doc("Bulk Repayment Log")
+			bulk_repayment_log.loan = loan
+			bulk_repayment_log.timestamp = frappe.utils.get_datetime()
+			bulk_repayment_log.details = str(rows)
+			bulk_repayment_log.trace_id = trace_id
 
+		payment = None
 		try:
 			# weird way to do things. Please suggest better ways
 			payment, e = loan_wise_submit(loan, rows)
@@ -3075,6 +3590,7 @@ def loan_wise_submit(loan, rows):
 	repost.cancel_future_accruals_and_demands = True
 	repost.clear_demand_allocation_before_repost = True
 	repost.cancel_future_emi_demands = True
+	repost.incremental = True
 	for payment in rows:
 		payment["doctype"] = "Loan Repayment"
 		loan_repayment = frappe.get_doc(payment)
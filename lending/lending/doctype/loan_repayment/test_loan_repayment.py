@@ -4,12 +4,16 @@
 from datetime import timedelta
 
 import frappe
+from frappe.query_builder.functions import Round, Sum
 from frappe.tests import IntegrationTestCase
 from frappe.utils import add_days, add_months, date_diff, flt, get_datetime, getdate
 
+from lending.lending.doctype.loan_repayment.allocation import allocate_amount
 from lending.lending.doctype.loan_repayment.loan_repayment import (
 	calculate_amounts,
 	get_amounts,
+	get_bulk_closure_amounts,
+	get_bulk_payment_status,
 	init_amounts,
 	post_bulk_payments,
 )
@@ -20,6 +24,7 @@ from lending.lending.doctype.process_loan_interest_accrual.process_loan_interest
 	process_loan_interest_accrual_for_loans,
 )
 from lending.tests.test_utils import (
+	create_demand_offset_order,
 	create_loan,
 	create_loan_write_off,
 	create_repayment_entry,
@@ -717,6 +722,122 @@ class TestLoanRepayment(IntegrationTestCase):
 
 		self.assertEqual(interest_accrual_revised, 77.92)
 
+	def test_incremental_repost_matches_full_repost(self):
+		posting_date = get_datetime("2024-04-18")
+		repayment_start_date = get_datetime("2024-05-05")
+		loan = create_loan(
+			self.applicant2,
+			"Term Loan Product 4",
+			1000000,
+			"Repay Over Number of Periods",
+			6,
+			applicant_type="Customer",
+			repayment_start_date=repayment_start_date,
+			posting_date=posting_date,
+			rate_of_interest=23,
+		)
+		loan.submit()
+		disbursement = make_loan_disbursement_entry(
+			loan.name,
+			loan.loan_amount,
+			disbursement_date=posting_date,
+			repayment_start_date=repayment_start_date,
+		)
+		process_loan_interest_accrual_for_loans(
+			loan=loan.name, posting_date=add_months(posting_date, 4), company="_Test Company"
+		)
+		process_daily_loan_demands(loan=loan.name, posting_date=add_months(repayment_start_date, 3))
+
+		for months, paid_amount in ((0, 178025), (1, 150000), (2, 178025), (3, 200000)):
+			create_repayment_entry(
+				loan=loan.name,
+				value_date=add_months(repayment_start_date, months),
+				paid_amount=paid_amount,
+			).submit()
+
+		def repost(incremental):
+			repost = frappe.new_doc("Loan Repayment Repost")
+			repost.loan = loan.name
+			repost.loan_disbursement = disbursement.name
+			repost.repost_date = add_days(repayment_start_date, 10)
+			repost.cancel_future_accruals_and_demands = 1
+			repost.cancel_future_emi_demands = 1
+			repost.incremental = incremental
+			repost.submit()
+
+			return get_repost_state(loan.name)
+
+		frappe.db.savepoint("incremental_repost")
+		incremental = repost(1)
+		frappe.db.rollback(save_point="incremental_repost")
+
+		full = repost(0)
+
+		self.assertEqual(incremental.demands, full.demands)
+		self.assertEqual(incremental.loan, full.loan)
+		self.assertEqual(incremental.gl_balances, full.gl_balances)
+
+	def test_unpaid_demand_condition_matches_rounded_outstanding_amount(self):
+		from lending.lending.doctype.loan_repayment.loan_repayment import (
+			get_unpaid_demand_condition,
+		)
+		from lending.settings import get_lending_settings
+
+		posting_date = get_datetime("2024-04-18")
+		repayment_start_date = get_datetime("2024-05-05")
+		loan = create_loan(
+			self.applicant2,
+			"Term Loan Product 4",
+			1000000,
+			"Repay Over Number of Periods",
+			6,
+			applicant_type="Customer",
+			repayment_start_date=repayment_start_date,
+			posting_date=posting_date,
+			rate_of_interest=23,
+		)
+		loan.submit()
+		make_loan_disbursement_entry(
+			loan.name,
+			loan.loan_amount,
+			disbursement_date=posting_date,
+			repayment_start_date=repayment_start_date,
+		)
+		process_loan_interest_accrual_for_loans(
+			loan=loan.name, posting_date=add_months(posting_date, 6), company="_Test Company"
+		)
+		process_daily_loan_demands(loan=loan.name, posting_date=add_months(repayment_start_date, 5))
+
+		precision = get_lending_settings().precision
+		unit = 1 / 10**precision
+		# around half of the smallest unit, where ROUND flips between zero and one unit
+		outstanding_amounts = [0, 0.1, 0.49, 0.4999, 0.5, 0.5001, 0.51, 1, -0.5, -0.51, -1]
+
+		demands = frappe.get_all("Loan Demand", {"loan": loan.name, "docstatus": 1}, pluck="name")
+		self.assertGreaterEqual(len(demands), len(outstanding_amounts))
+
+		for demand, outstanding_amount in zip(demands, outstanding_amounts):
+			frappe.db.set_value(
+				"Loan Demand",
+				demand,
+				"outstanding_amount",
+				flt(outstanding_amount * unit, 9),
+				update_modified=False,
+			)
+
+		loan_demand = frappe.qb.DocType("Loan Demand")
+		query = (
+			frappe.qb.from_(loan_demand)
+			.select(loan_demand.name)
+			.where(loan_demand.name.isin(demands[: len(outstanding_amounts)]))
+		)
+
+		rounded = query.where(Round(loan_demand.outstanding_amount, precision) > 0).run(pluck=True)
+		unpaid = query.where(get_unpaid_demand_condition(loan_demand, precision)).run(pluck=True)
+
+		self.assertEqual(sorted(unpaid), sorted(rounded))
+		self.assertEqual(len(unpaid), 4)
+
 	def test_bulk_payments(self):
 		posting_date = get_datetime("2024-04-18")
 		repayment_start_date = get_datetime("2024-05-05")
@@ -881,6 +1002,13 @@ class TestLoanRepayment(IntegrationTestCase):
 
 		self.assertEqual(successful_log.status, "Success")
 		self.assertEqual(failed_log.status, "Failure")
+		self.assertEqual(successful_log.trace_id, failed_log.trace_id)
+
+		status = get_bulk_payment_status(successful_log.trace_id)
+		self.assertEqual(
+			(status.total, status.completed, status.failed, status.pending), (2, 1, 1, 0)
+		)
+		self.assertEqual(status.failed_loans, [loan_b.name])
 
 	def test_loan_repayment_cancel_with_amount_overlimit(self):
 		frappe.db.set_value("Loan Product", "Term Loan Product 4", "excess_amount_acceptance_limit", 100)
@@ -1357,3 +1485,173 @@ class TestLoanRepayment(IntegrationTestCase):
 		repayment_entry1.load_from_db()
 
 		self.assertEqual(repayment_entry1.is_backdated, 1)
+
+	def test_allocation_on_plain_demands(self):
+		create_demand_offset_order(
+			"Test Overlapping Loan Demand Offset Order",
+			["EMI (Principal + Interest)", "Principal", "Penalty"],
+		)
+		offset_order = frappe.db.get_value(
+			"Loan Demand Offset Order", {"title": "Test Overlapping Loan Demand Offset Order"}
+		)
+
+		demands = [
+			frappe._dict(
+				name=name,
+				demand_type=demand_type,
+				demand_subtype=demand_subtype,
+				outstanding_amount=outstanding_amount,
+				sales_invoice=None,
+			)
+			for name, demand_type, demand_subtype, outstanding_amount in (
+				("LD-1", "EMI", "Interest", 100),
+				("LD-2", "EMI", "Principal", 400),
+				("LD-3", "Penalty", "Penalty", 50),
+			)
+		]
+
+		result = allocate_amount(1000, demands, offset_order, is_term_loan=1)
+
+		# the principal demand is reached twice but only paid once
+		self.assertEqual(
+			[(d["loan_demand"], d["paid_amount"]) for d in result.allocations],
+			[("LD-1", 100), ("LD-2", 400), ("LD-3", 50)],
+		)
+		self.assertEqual(result.unallocated_amount, 450)
+
+		result = allocate_amount(
+			1000,
+			demands,
+			offset_order,
+			is_term_loan=1,
+			repayment_type="Full Settlement",
+			pending_principal_amount=600,
+		)
+		self.assertEqual(result.principal_amount_paid, 200)
+		self.assertEqual(result.unallocated_amount, 250)
+
+	def test_bulk_closure_amounts(self):
+		set_loan_accrual_frequency(loan_accrual_frequency="Daily")
+		loans = []
+		for _i in range(2):
+			loan = create_loan(
+				self.applicant2,
+				"Term Loan Product 4",
+				1000000,
+				"Repay Over Number of Periods",
+				6,
+				applicant_type="Customer",
+				repayment_start_date="2024-05-05",
+				posting_date="2024-04-05",
+				rate_of_interest=23,
+			)
+			loan.submit()
+			make_loan_disbursement_entry(
+				loan.name,
+				loan.loan_amount,
+				disbursement_date="2024-04-05",
+				repayment_start_date="2024-05-05",
+			)
+			process_daily_loan_demands(posting_date="2024-06-05", loan=loan.name)
+			process_loan_interest_accrual_for_loans(posting_date="2024-06-10", loan=loan.name)
+			loans.append(loan.name)
+
+		quotes = get_bulk_closure_amounts(loans, "2024-06-20")
+		self.assertEqual(len(quotes), 2)
+
+		for quote in quotes:
+			amounts = calculate_amounts(quote["loan"], "2024-06-20", payment_type="Loan Closure")
+			for field in ("payable_principal_amount", "interest_amount", "penalty_amount"):
+				self.assertAlmostEqual(quote[field], amounts[field], places=2)
+
+	def test_regular_emi_payment_fast_path(self):
+		loan = create_loan(
+			self.applicant2,
+			"Term Loan Product 4",
+			1000000,
+			"Repay Over Number of Periods",
+			6,
+			applicant_type="Customer",
+			repayment_start_date="2024-05-05",
+			posting_date="2024-04-05",
+			rate_of_interest=23,
+		)
+		loan.submit()
+		make_loan_disbursement_entry(
+			loan.name,
+			loan.loan_amount,
+			disbursement_date="2024-04-05",
+			repayment_start_date="2024-05-05",
+		)
+		process_daily_loan_demands(posting_date="2024-05-05", loan=loan.name)
+
+		payable_amount = calculate_amounts(loan.name, "2024-05-05")["payable_amount"]
+		repayment = create_repayment_entry(loan.name, "2024-05-05", payable_amount)
+		repayment.submit()
+
+		self.assertTrue(repayment.is_regular_emi_payment())
+		self.assertIn("GL Entries", repayment.flags.stage_timings)
+		self.assertNotIn("Suspense Entries", repayment.flags.stage_timings)
+
+		outstanding_amount = frappe.db.get_value(
+			"Loan Demand",
+			{"loan": loan.name, "docstatus": 1, "demand_type": "EMI"},
+			[{"SUM": "outstanding_amount"}],
+		)
+		self.assertEqual(flt(outstanding_amount), 0)
+
+
+def get_repost_state(loan):
+	"""Demands, loan totals and GL balances per account of a loan, free of document names"""
+	demands = frappe.get_all(
+		"Loan Demand",
+		filters={"loan": loan, "docstatus": 1},
+		fields=[
+			"demand_date",
+			"demand_type",
+			"demand_subtype",
+			"demand_amount",
+			"paid_amount",
+			"waived_amount",
+			"outstanding_amount",
+		],
+		order_by="demand_date, demand_type, demand_subtype, demand_amount",
+	)
+	loan_totals = frappe.db.get_value(
+		"Loan",
+		loan,
+		[
+			"status",
+			"total_amount_paid",
+			"total_principal_paid",
+			"total_interest_payable",
+			"total_payment",
+			"written_off_amount",
+			"days_past_due",
+		],
+		as_dict=1,
+	)
+
+	gl_entry = frappe.qb.DocType("GL Entry")
+	gl_balances = (
+		frappe.qb.from_(gl_entry)
+		.select(
+			gl_entry.account,
+			gl_entry.party_type,
+			gl_entry.party,
+			Sum(gl_entry.debit - gl_entry.credit).as_("balance"),
+		)
+		.where(gl_entry.company == "_Test Company")
+		.where(gl_entry.is_cancelled == 0)
+		.groupby(gl_entry.account, gl_entry.party_type, gl_entry.party)
+		.orderby(gl_entry.account)
+		.orderby(gl_entry.party_type)
+		.orderby(gl_entry.party)
+		.run(as_dict=1)
+	)
+
+	return frappe._dict(
+		demands=[tuple(d.values()) for d in demands],
+		loan=loan_totals,
+		gl_balances=[(d.account, d.party_type, d.party, flt(d.balance, 2)) for d in gl_balances],
+	)
@@ -1,9 +1,13 @@
 import frappe
-from frappe.utils import cint, flt
+from frappe.query_builder import Case
+from frappe.query_builder.functions import Coalesce, Max, Min, Sum
+from frappe.utils import flt
+
+from lending.settings import get_lending_settings
 
 
 def get_pending_principal_amount_for_loans(loans, disbursement_map):
-	precision = cint(frappe.db.get_default("currency_precision")) or 2
+	precision = get_lending_settings().precision
 
 	principal_amount_map = {}
 
@@ -72,15 +76,15 @@ def process_amount_for_bulk_loans(
 	amounts,
 	posting_date,
 	available_security_deposit_map,
+	last_demand_date=None,
 ):
 
-	precision = cint(frappe.db.get_default("currency_precision")) or 2
+	precision = get_lending_settings().precision
 	total_pending_interest = 0
 	charges = 0
 	penalty_amount = 0
 	payable_principal_amount = 0
 
-	last_demand_date = get_last_demand_date(posting_date, loan=loan.name)
 	for demand in demands:
 		if demand.demand_subtype == "Interest":
 			total_pending_interest += demand.outstanding_amount
@@ -152,23 +156,163 @@ def get_unbooked_interest_for_loans(
 	return accrued_interest_map
 
 
-def get_last_demand_date(posting_date, demand_subtype="Interest", loan=None):
-	filters = {
-		"docstatus": 1,
-		"demand_subtype": demand_subtype,
-		"demand_date": ("<=", posting_date),
-	}
+def get_last_demand_date_query(loans, posting_date, demand_subtype="Interest"):
+	loan_demand = frappe.qb.DocType("Loan Demand")
+	return (
+		frappe.qb.from_(loan_demand)
+		.select(loan_demand.loan, Max(loan_demand.demand_date).as_("last_demand_date"))
+		.where(loan_demand.loan.isin(loans))
+		.where(loan_demand.docstatus == 1)
+		.where(loan_demand.demand_subtype == demand_subtype)
+		.where(loan_demand.demand_date <= posting_date)
+		.groupby(loan_demand.loan)
+	)
 
-	if loan:
-		filters["loan"] = loan
 
-	last_demand_date = frappe.db.get_value(
-		"Loan Demand",
-		filters,
-		[{"MAX": "demand_date"}],
+def get_last_demand_date_map(loans, posting_date, demand_subtype="Interest"):
+	"""Latest demand date of each loan up to `posting_date`"""
+	return frappe._dict(
+		get_last_demand_date_query(loans, posting_date, demand_subtype=demand_subtype).run()
+	)
+
+
+def get_unbooked_from_query(loans, posting_date=None, by_disbursement=False):
+	"""Date interest is unbooked from for each loan, or each (loan, disbursement), as
+	`get_last_demand_date` works it out: the last interest demand, else the latest
+	disbursement of a term loan and the first of a line of credit loan"""
+	loan_disbursement = frappe.qb.DocType("Loan Disbursement")
+	loan_demand = frappe.qb.DocType("Loan Demand")
+	loan = frappe.qb.DocType("Loan")
+
+	last_demand = (
+		frappe.qb.from_(loan_demand)
+		.select(loan_demand.loan, Max(loan_demand.demand_date).as_("last_demand_date"))
+		.where(loan_demand.loan.isin(loans))
+		.where(loan_demand.docstatus == 1)
+		.where(loan_demand.demand_subtype == "Interest")
+	)
+
+	disbursements = (
+		frappe.qb.from_(loan_disbursement)
+		.select(loan_disbursement.against_loan.as_("loan"))
+		.where(loan_disbursement.against_loan.isin(loans))
+		.where(loan_disbursement.docstatus == 1)
 	)
 
-	return last_demand_date
+	if posting_date:
+		last_demand = last_demand.where(loan_demand.demand_date <= posting_date)
+		disbursements = disbursements.where(loan_disbursement.disbursement_date <= posting_date)
+
+	if by_disbursement:
+		last_demand = last_demand.select(loan_demand.loan_disbursement).groupby(
+			loan_demand.loan, loan_demand.loan_disbursement
+		)
+		disbursements = disbursements.select(
+			loan_disbursement.name.as_("loan_disbursement"),
+			loan_disbursement.disbursement_date,
+		)
+	else:
+		last_demand = last_demand.groupby(loan_demand.loan)
+		disbursements = (
+			disbursements.inner_join(loan)
+			.on(loan.name == loan_disbursement.against_loan)
+			.select(
+				Case()
+				.when(
+					loan.repayment_schedule_type == "Line of Credit",
+					Min(loan_disbursement.disbursement_date),
+				)
+				.else_(Max(loan_disbursement.disbursement_date))
+				.as_("disbursement_date")
+			)
+			.groupby(loan_disbursement.against_loan, loan.repayment_schedule_type)
+		)
+
+	join_condition = last_demand.loan == disbursements.loan
+	if by_disbursement:
+		join_condition &= last_demand.loan_disbursement == disbursements.loan_disbursement
+
+	query = (
+		frappe.qb.from_(disbursements)
+		.left_join(last_demand)
+		.on(join_condition)
+		.select(
+			disbursements.loan,
+			Coalesce(last_demand.last_demand_date, disbursements.disbursement_date).as_(
+				"unbooked_from"
+			),
+		)
+	)
+
+	if by_disbursement:
+		query = query.select(disbursements.loan_disbursement)
+
+	return query
+
+
+def get_unbooked_interest_map(loans, posting_date, interest_type="Normal Interest"):
+	"""Interest accrued since the last interest demand of each loan, keyed by loan or
+	by (loan, disbursement) for line of credit loans, in one query per kind of loan. A line
+	of credit disbursement counts from its own last interest demand."""
+	precision = get_lending_settings().precision
+
+	loan_map = {loan.name: loan for loan in loans}
+	line_of_credit_loans = [
+		loan.name for loan in loans if loan.repayment_schedule_type == "Line of Credit"
+	]
+	term_loans = [loan.name for loan in loans if loan.name not in line_of_credit_loans]
+
+	accrued_interests = []
+	for loan_list, by_disbursement in ((term_loans, False), (line_of_credit_loans, True)):
+		if loan_list:
+			accrued_interests += get_accrued_interest_since_demand(
+				loan_list, posting_date, interest_type, by_disbursement=by_disbursement
+			)
+
+	unbooked_interest_map = {}
+	for accrued_interest in accrued_interests:
+		loan = loan_map[accrued_interest.loan]
+		if loan.status in ("Closed", "Settled"):
+			continue
+
+		if loan.repayment_schedule_type == "Line of Credit":
+			key = (loan.name, accrued_interest.loan_disbursement)
+		else:
+			key = loan.name
+
+		unbooked_interest_map[key] = flt(
+			unbooked_interest_map.get(key, 0) + flt(accrued_interest.unbooked_interest), precision
+		)
+
+	return unbooked_interest_map
+
+
+def get_accrued_interest_since_demand(loans, posting_date, interest_type, by_disbursement=False):
+	accrual = frappe.qb.DocType("Loan Interest Accrual")
+	unbooked_from = get_unbooked_from_query(loans, posting_date, by_disbursement=by_disbursement)
+
+	join_condition = unbooked_from.loan == accrual.loan
+	if by_disbursement:
+		join_condition &= unbooked_from.loan_disbursement == accrual.loan_disbursement
+
+	return (
+		frappe.qb.from_(accrual)
+		.left_join(unbooked_from)
+		.on(join_condition)
+		.select(
+			accrual.loan,
+			accrual.loan_disbursement,
+			Sum(accrual.interest_amount).as_("unbooked_interest"),
+		)
+		.where(accrual.loan.isin(loans))
+		.where(accrual.docstatus == 1)
+		.where(accrual.posting_date < posting_date)
+		.where(accrual.interest_type == interest_type)
+		.where(
+			unbooked_from.unbooked_from.isnull() | (accrual.posting_date >= unbooked_from.unbooked_from)
+		)
+		.groupby(accrual.loan, accrual.loan_disbursement)
+	).run(as_dict=1)
 
 
 def get_latest_accrual_date(posting_date, interest_type="Interest"):
@@ -3,12 +3,24 @@
 
 import frappe
 from frappe.model.document import Document
+from frappe.query_builder import Case
 from frappe.utils import add_days, cint, flt, getdate
 
 from lending.lending.doctype.loan_repayment.loan_repayment import (
 	calculate_amounts,
 	get_pending_principal_amount,
 )
+from lending.settings import get_lending_settings
+
+# GL entries of an incremental repost are kept only if their balances match on all of these
+GL_BALANCE_KEY_FIELDS = (
+	"account",
+	"party_type",
+	"party",
+	"against_voucher_type",
+	"against_voucher",
+	"cost_center",
+)
 
 
 class LoanRepaymentRepost(Document):
@@ -34,6 +46,7 @@ class LoanRepaymentRepost(Document):
 		delete_gl_entries: DF.Check
 		entries_to_cancel: DF.Table[LoanRepaymentRepostCancelDetail]
 		ignore_on_cancel_amount_update: DF.Check
+		incremental: DF.Check
 		loan: DF.Link
 		loan_disbursement: DF.Link | None
 		repayment_entries: DF.Table[LoanRepaymentRepostDetail]
@@ -96,47 +109,39 @@ class LoanRepaymentRepost(Document):
 			)
 
 	def clear_demand_allocation(self):
-		demands = []
-
-		for repayment in self.get("repayment_entries"):
-			demands.extend(
-				frappe.get_all(
-					"Loan Repayment Detail",
-					{
-						"parent": repayment.loan_repayment,
-					},
-					pluck="loan_demand",
-				)
-			)
-
-		demand_amount_map = frappe._dict(
-			frappe.get_all(
-				"Loan Demand",
-				{
-					"loan": self.loan,
-					"docstatus": 1,
-					"name": ("in", demands),
-				},
-				["name", "demand_amount"],
-				as_list=1,
-			)
+		repayments = [d.loan_repayment for d in self.get("repayment_entries")]
+		if not repayments:
+			return
+
+		loan_demand = frappe.qb.DocType("Loan Demand")
+		repayment_detail = frappe.qb.DocType("Loan Repayment Detail")
+
+		demands = (
+			frappe.qb.from_(repayment_detail)
+			.select(repayment_detail.loan_demand)
+			.distinct()
+			.where(repayment_detail.parent.isin(repayments))
+			.where(repayment_detail.parenttype == "Loan Repayment")
+			.where(repayment_detail.loan_demand.isnotnull())
+			.run(as_list=1)
 		)
+		demands = [d[0] for d in demands]
+
+		if demands:
+			frappe.qb.update(loan_demand).set(loan_demand.paid_amount, 0).set(
+				loan_demand.waived_amount, 0
+			).set(
+				loan_demand.outstanding_amount,
+				Case()
+				.when(
+					(loan_demand.loan == self.loan) & (loan_demand.docstatus == 1), loan_demand.demand_amount
+				)
+				.else_(0),
+			).where(
+				loan_demand.name.isin(demands)
+			).run()
 
-		for demand in demands:
-			frappe.db.set_value(
-				"Loan Demand",
-				demand,
-				{
-					"paid_amount": 0,
-					"waived_amount": 0,
-					"outstanding_amount": demand_amount_map.get(demand, 0),
-				},
-			)
-
-		for entry in self.get("repayment_entries"):
-			repayment_doc = frappe.get_doc("Loan Repayment", entry.loan_repayment)
-			for repayment_detail in repayment_doc.get("repayment_details"):
-				frappe.delete_doc("Loan Repayment Detail", repayment_detail.name, force=1)
+		delete_repayment_details(repayments)
 
 	def trigger_on_cancel_events(self):
 		entries_to_cancel = [d.loan_repayment for d in self.get("entries_to_cancel")]
@@ -158,11 +163,11 @@ class LoanRepaymentRepost(Document):
 				if repayment_doc.repayment_type in ("Advance Payment", "Pre Payment"):
 					repayment_doc.cancel_loan_restructure()
 
-				if self.delete_gl_entries:
-					frappe.db.sql(
-						"DELETE FROM `tabGL Entry` WHERE voucher_type='Loan Repayment' AND voucher_no=%s",
-						repayment_doc.name,
-					)
+				if self.incremental and repayment_doc.repayment_type != "Charges Waiver":
+					# GL entries are compared with the replayed allocation in `repost_gl_entries`
+					pass
+				elif self.delete_gl_entries:
+					delete_gl_entries(repayment_doc.name)
 				else:
 					# cancel GL Entries
 					repayment_doc.make_gl_entries(cancel=1)
@@ -278,8 +283,7 @@ class LoanRepaymentRepost(Document):
 			else:
 				is_security_deposit_adjustment = False
 
-			for _entry in repayment_doc.get("repayment_details"):
-				frappe.delete_doc("Loan Repayment Detail", _entry.name, force=1)
+			delete_repayment_details([repayment_doc.name])
 
 			repayment_doc.docstatus = 1
 			repayment_doc.set("pending_principal_amount", 0)
@@ -344,9 +348,14 @@ class LoanRepaymentRepost(Document):
 			repayment_doc.update_demands()
 			repayment_doc.update_security_deposit_amount()
 			repayment_doc.db_update_all()
-			repayment_doc.make_gl_entries()
+			self.repost_gl_entries(repayment_doc)
 
-			update_installment_counts(self.loan)
+			# An incremental repost recounts once at the end, unless a new schedule copies them
+			if not self.incremental or repayment_doc.repayment_type in (
+				"Advance Payment",
+				"Pre Payment",
+			):
+				update_installment_counts(self.loan)
 
 			if repayment_doc.repayment_type == "Full Settlement":
 				loan_write_off = frappe.db.get_value(
@@ -383,6 +392,9 @@ class LoanRepaymentRepost(Document):
 			repayment_doc.flags.from_repost = False
 			frappe.flags.on_repost = False
 
+		if self.incremental:
+			update_installment_counts(self.loan)
+
 		if is_written_off:
 			frappe.db.set_value("Loan", self.loan, "status", "Written Off")
 
@@ -426,3 +438,58 @@ class LoanRepaymentRepost(Document):
 				loan=self.loan,
 				loan_disbursement=self.loan_disbursement,
 			)
+
+	def repost_gl_entries(self, repayment_doc):
+		"""GL entries of the replayed repayment. An incremental repost keeps the booked
+		entries when the replayed allocation books the same amounts."""
+		if not self.incremental or repayment_doc.repayment_type == "Charges Waiver":
+			repayment_doc.make_gl_entries()
+			return
+
+		precision = get_lending_settings().precision
+		if get_gl_map_balances(repayment_doc.get_gl_map(), precision) == get_voucher_gl_balances(
+			repayment_doc.name, precision
+		):
+			return
+
+		if self.delete_gl_entries:
+			delete_gl_entries(repayment_doc.name)
+		else:
+			repayment_doc.make_gl_entries(cancel=1)
+
+		repayment_doc.make_gl_entries()
+
+
+def delete_repayment_details(repayments):
+	repayment_detail = frappe.qb.DocType("Loan Repayment Detail")
+	frappe.qb.from_(repayment_detail).delete().where(repayment_detail.parent.isin(repayments)).where(
+		repayment_detail.parenttype == "Loan Repayment"
+	).run()
+
+
+def delete_gl_entries(loan_repayment):
+	frappe.db.sql(
+		"DELETE FROM `tabGL Entry` WHERE voucher_type='Loan Repayment' AND voucher_no=%s",
+		loan_repayment,
+	)
+
+
+def get_gl_map_balances(gl_map, precision):
+	"""Net debit of a GL map per account, party, against voucher and cost center, non zero
+	balances only"""
+	balances = {}
+	for entry in gl_map or []:
+		key = tuple(entry.get(field) or None for field in GL_BALANCE_KEY_FIELDS)
+		balances[key] = balances.get(key, 0) + flt(entry.get("debit")) - flt(entry.get("credit"))
+
+	return {key: flt(balance, precision) for key, balance in balances.items() if flt(balance, precision)}
+
+
+def get_voucher_gl_balances(loan_repayment, precision):
+	gl_entries = frappe.get_all(
+		"GL Entry",
+		filters={"voucher_type": "Loan Repayment", "voucher_no": loan_repayment, "is_cancelled": 0},
+		fields=[*GL_BALANCE_KEY_FIELDS, "debit", "credit"],
+	)
+
+	return get_gl_map_balances(gl_entries, precision)
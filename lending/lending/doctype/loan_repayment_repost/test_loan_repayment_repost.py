@@ -4,6 +4,10 @@
 # import frappe
 from frappe.tests import IntegrationTestCase, UnitTestCase
 
+from lending.lending.doctype.loan_repayment_repost.loan_repayment_repost import (
+	get_gl_map_balances,
+)
+
 # On IntegrationTestCase, the doctype test records and all
 # link-field test record depdendencies are recursively loaded
 # Use these module variables to add/remove to/from that list
@@ -26,4 +30,36 @@ class TestLoanRepaymentRepost(IntegrationTestCase):
 	Use this class for testing interactions between multiple components.
 	"""
 
-	pass
+	def test_gl_map_balances(self):
+		booked = [
+			{"account": "Payment Account", "debit": 100, "credit": 0},
+			{"account": "Loan Account", "party_type": "Customer", "party": "A", "debit": 0, "credit": 60},
+			{"account": "Loan Account", "party_type": "Customer", "party": "A", "debit": 0, "credit": 40},
+			{"account": "Interest Account", "debit": 5, "credit": 5},
+		]
+		replayed = [
+			{"account": "Loan Account", "party_type": "Customer", "party": "A", "debit": 0, "credit": 100},
+			{"account": "Payment Account", "party_type": "", "debit": 100.001, "credit": 0},
+		]
+
+		self.assertEqual(get_gl_map_balances(booked, 2), get_gl_map_balances(replayed, 2))
+
+		replayed[0]["credit"] = 90
+		self.assertNotEqual(get_gl_map_balances(booked, 2), get_gl_map_balances(replayed, 2))
+
+		# a charge paid against another invoice does not match
+		replayed[0]["credit"] = 100
+		booked_charge = [
+			{
+				"account": "Receivable Account",
+				"against_voucher_type": "Sales Invoice",
+				"against_voucher": "SINV-1",
+				"debit": 0,
+				"credit": 10,
+			}
+		]
+		replayed_charge = [dict(booked_charge[0], against_voucher="SINV-2")]
+		self.assertNotEqual(
+			get_gl_map_balances(booked + booked_charge, 2),
+			get_gl_map_balances(replayed + replayed_charge, 2),
+		)
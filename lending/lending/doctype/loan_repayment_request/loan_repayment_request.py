@@ -0,0 +1,346 @@
+# Copyright (c) 2026, Frappe Technologies Pvt. Ltd. and contributors
+# For license information, please see license.txt
+
+import json
+import traceback
+
+import frappe
+from frappe import _
+from frappe.model.document import Document
+from frappe.query_builder.functions import Min
+from frappe.utils import add_to_date, cstr, flt, get_datetime, now_datetime
+from rq.timeouts import JobTimeoutException
+
+from lending.settings import with_lending_settings
+from lending.utils import lock_claimed_requests
+
+LOAN_REPAYMENT_REQUEST_WORKERS = 4
+LOAN_REPAYMENT_REQUEST_TIMEOUT = 3600
+# Loans looked at per claim, loans being processed by other workers are skipped
+LOAN_REPAYMENT_REQUEST_CLAIM_CANDIDATES = 20
+# Loan Repayment fields a queued repayment may set
+LOAN_REPAYMENT_REQUEST_FIELDS = (
+	"against_loan",
+	"posting_date",
+	"value_date",
+	"amount_paid",
+	"reference_number",
+	"reference_date",
+	"repayment_type",
+	"loan_disbursement",
+	"mode_of_payment",
+	"payment_account",
+	"bank_account",
+	"cost_center",
+	"manual_remarks",
+)
+
+
+class LoanRepaymentRequest(Document):
+	# begin: auto-generated types
+	# This code is auto-generated. Do not modify anything in this block.
+
+	from typing import TYPE_CHECKING
+
+	if TYPE_CHECKING:
+		from frappe.types import DF
+
+		amount_paid: DF.Currency
+		claimed_at: DF.Datetime | None
+		error: DF.LongText | None
+		loan: DF.Link
+		loan_repayment: DF.Link | None
+		payload: DF.Code | None
+		reference_number: DF.Data
+		requested_by: DF.Link | None
+		status: DF.Literal["Queued", "Processing", "Completed", "Failed"]
+		value_date: DF.Datetime | None
+	# end: auto-generated types
+
+	pass
+
+
+@frappe.whitelist(methods=["POST"])
+def queue_loan_repayments(data):
+	"""Accepts repayments for asynchronous posting.
+
+	Each repayment is validated against the loans and the known reference numbers and
+	staged as a Loan Repayment Request. Workers submit the staged repayments of a loan
+	in the order they were accepted, different loans are posted in parallel, as the user
+	who queued them. A repayment that failed may be queued again under the same reference
+	number. Returns the accepted reference numbers and the rejected ones with the reason."""
+	from lending.utils import bulk_insert_documents
+
+	frappe.has_permission("Loan Repayment", "submit", throw=True)
+
+	data = [get_loan_repayment_fields(row) for row in frappe.parse_json(data)]
+	accepted, rejected = validate_repayment_requests(data)
+
+	requests = []
+	for row in accepted:
+		request = frappe.new_doc("Loan Repayment Request")
+		request.update(
+			{
+				"name": frappe.generate_hash(length=12),
+				"reference_number": row["reference_number"],
+				"loan": row["against_loan"],
+				"value_date": get_datetime(row["value_date"]),
+				"amount_paid": flt(row["amount_paid"]),
+				"status": "Queued",
+				"requested_by": frappe.session.user,
+				"payload": json.dumps(row, default=str),
+			}
+		)
+		requests.append(request)
+
+	# requests of a loan are submitted in creation order, idx keeps the order of the payload
+	for idx, request in enumerate(requests, start=1):
+		request.idx = idx
+
+	delete_failed_repayment_requests([row["reference_number"] for row in accepted])
+	bulk_insert_documents(requests)
+	# staged requests are durable once accepted
+	frappe.db.commit()  # nosemgrep
+
+	if requests:
+		enqueue_loan_repayment_workers(len({row["against_loan"] for row in accepted}))
+
+	return {
+		"accepted": [row["reference_number"] for row in accepted],
+		"rejected": rejected,
+	}
+
+
+def get_loan_repayment_fields(row):
+	return {key: value for key, value in row.items() if key in LOAN_REPAYMENT_REQUEST_FIELDS}
+
+
+def delete_failed_repayment_requests(reference_numbers):
+	"""Drops the failed requests of reference numbers queued again"""
+	if not reference_numbers:
+		return
+
+	request = frappe.qb.DocType("Loan Repayment Request")
+	frappe.qb.from_(request).delete().where(request.reference_number.isin(reference_numbers)).where(
+		request.status == "Failed"
+	).run()
+
+
+def validate_repayment_requests(data):
+	accepted, rejected = [], []
+
+	loans = {row.get("against_loan") for row in data if row.get("against_loan")}
+	loan_status_map = frappe._dict(
+		frappe.db.get_all(
+			"Loan",
+			filters={"name": ("in", list(loans)), "docstatus": 1},
+			fields=["name", "status"],
+			as_list=1,
+		)
+		if loans
+		else []
+	)
+
+	reference_numbers = [row.get("reference_number") for row in data if row.get("reference_number")]
+	known_references = set()
+	if reference_numbers:
+		known_references.update(
+			frappe.db.get_all(
+				"Loan Repayment Request",
+				filters={"reference_number": ("in", reference_numbers), "status": ("!=", "Failed")},
+				pluck="reference_number",
+			)
+		)
+		known_references.update(
+			frappe.db.get_all(
+				"Loan Repayment",
+				filters={"reference_number": ("in", reference_numbers), "docstatus": 1},
+				pluck="reference_number",
+			)
+		)
+
+	for row in data:
+		reference_number = row.get("reference_number")
+		error = None
+
+		if not reference_number:
+			error = _("Reference Number is mandatory")
+		elif reference_number in known_references:
+			error = _("Reference Number {0} has already been received").format(reference_number)
+		elif not row.get("against_loan") or not row.get("value_date"):
+			error = _("Loan and Value Date are mandatory")
+		elif row["against_loan"] not in loan_status_map:
+			error = _("Loan {0} does not exist").format(row["against_loan"])
+		elif loan_status_map[row["against_loan"]] in ("Closed", "Cancelled"):
+			error = _("Loan {0} is {1}").format(row["against_loan"], loan_status_map[row["against_loan"]])
+		elif flt(row.get("amount_paid")) <= 0:
+			error = _("Amount Paid should be greater than zero")
+
+		if error:
+			rejected.append({"reference_number": reference_number, "error": error})
+			continue
+
+		known_references.add(reference_number)
+		row.setdefault("repayment_type", "Normal Repayment")
+		row.setdefault("posting_date", row["value_date"])
+		accepted.append(row)
+
+	return accepted, rejected
+
+
+def enqueue_loan_repayment_workers(loan_count):
+	if frappe.flags.in_test:
+		process_loan_repayment_requests()
+		return
+
+	for _i in range(min(loan_count, LOAN_REPAYMENT_REQUEST_WORKERS)):
+		frappe.enqueue(
+			process_loan_repayment_requests,
+			queue="long",
+			timeout=LOAN_REPAYMENT_REQUEST_TIMEOUT,
+			enqueue_after_commit=True,
+		)
+
+
+@with_lending_settings
+def process_loan_repayment_requests():
+	"""Worker loop, claims the queued requests of one loan at a time and submits them in
+	the order they were accepted till no loan is left"""
+	while requests := claim_loan_repayment_requests():
+		for request in requests:
+			submit_loan_repayment_request(request)
+
+
+def claim_loan_repayment_requests():
+	request = frappe.qb.DocType("Loan Repayment Request")
+	loan = frappe.qb.DocType("Loan")
+	stale_before = add_to_date(now_datetime(), seconds=-LOAN_REPAYMENT_REQUEST_TIMEOUT)
+
+	claimable = (request.status == "Queued") | (
+		(request.status == "Processing") & (request.claimed_at < stale_before)
+	)
+
+	candidates = (
+		frappe.qb.from_(request)
+		.select(request.loan)
+		.where(claimable)
+		.groupby(request.loan)
+		.orderby(Min(request.creation))
+		.limit(LOAN_REPAYMENT_REQUEST_CLAIM_CANDIDATES)
+		.run(as_list=1)
+	)
+
+	for (candidate,) in candidates:
+		# The loan row serialises the claims of a loan, a loan locked by another worker is
+		# being claimed by it and is skipped
+		if (
+			not frappe.qb.from_(loan)
+			.select(loan.name)
+			.where(loan.name == candidate)
+			.for_update(skip_locked=True)
+			.run()
+		):
+			continue
+
+		if frappe.db.exists(
+			"Loan Repayment Request",
+			{"loan": candidate, "status": "Processing", "claimed_at": (">=", stale_before)},
+		):
+			frappe.db.rollback()
+			continue
+
+		claimed = (
+			frappe.qb.from_(request)
+			.select(request.name, request.payload, request.requested_by)
+			.where(request.loan == candidate)
+			.where(claimable)
+			.orderby(request.creation)
+			.orderby(request.idx)
+			.run(as_dict=1)
+		)
+
+		if not claimed:
+			frappe.db.rollback()
+			continue
+
+		# requests settled since they were read are left alone, they fail the check before
+		# their submission
+		claimed_at = now_datetime()
+		frappe.qb.update(request).set(request.status, "Processing").set(
+			request.claimed_at, claimed_at
+		).where(request.name.isin([d.name for d in claimed])).where(claimable).run()
+		frappe.db.commit()  # nosemgrep
+
+		for d in claimed:
+			d.claimed_at = claimed_at
+
+		return claimed
+
+	frappe.db.rollback()
+	return []
+
+
+def submit_loan_repayment_request(request):
+	if not lock_claimed_requests("Loan Repayment Request", [request]):
+		# reclaimed by another worker or settled since this worker claimed it
+		frappe.db.rollback()
+		return
+
+	user = frappe.session.user
+	try:
+		frappe.set_user(request.requested_by or "Administrator")
+
+		loan_repayment = frappe.get_doc(
+			{**get_loan_repayment_fields(json.loads(request.payload)), "doctype": "Loan Repayment"}
+		)
+		loan_repayment.submit()
+
+		frappe.db.set_value(
+			"Loan Repayment Request",
+			request.name,
+			{"status": "Completed", "loan_repayment": loan_repayment.name, "error": None},
+		)
+	except JobTimeoutException:
+		# the request stays Processing and is claimed again once its claim goes stale
+		frappe.db.rollback()
+		raise
+	except Exception:
+		error = traceback.format_exc()
+		frappe.db.rollback()
+
+		if lock_claimed_requests("Loan Repayment Request", [request]):
+			frappe.db.set_value(
+				"Loan Repayment Request", request.name, {"status": "Failed", "error": error}
+			)
+	finally:
+		frappe.set_user(user)
+
+	# a failed repayment does not hold back the ones after it
+	frappe.db.commit()  # nosemgrep
+
+
+@frappe.whitelist()
+def get_loan_repayment_request_status(reference_numbers):
+	"""Status of the repayments queued with `queue_loan_repayments`, by reference number"""
+	frappe.has_permission("Loan Repayment Request", "read", throw=True)
+
+	reference_numbers = frappe.parse_json(reference_numbers)
+	if isinstance(reference_numbers, str):
+		reference_numbers = [reference_numbers]
+
+	requests = frappe.db.get_all(
+		"Loan Repayment Request",
+		filters={"reference_number": ("in", reference_numbers)},
+		fields=["reference_number", "loan", "status", "loan_repayment", "error"],
+	)
+
+	status = {}
+	for request in requests:
+		error = cstr(request.pop("error")).strip().splitlines()
+		request.error = error[-1] if error else None
+		status[request.reference_number] = request
+
+	for reference_number in reference_numbers:
+		status.setdefault(reference_number, {"reference_number": reference_number, "status": "Not Found"})
+
+	return status
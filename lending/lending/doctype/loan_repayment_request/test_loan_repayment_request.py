@@ -0,0 +1,108 @@
+# Copyright (c) 2026, Frappe Technologies Pvt. Ltd. and Contributors
+# See license.txt
+
+import frappe
+from frappe.tests import IntegrationTestCase
+
+from lending.lending.doctype.loan_repayment.loan_repayment import calculate_amounts
+from lending.lending.doctype.loan_repayment_request.loan_repayment_request import (
+	get_loan_repayment_request_status,
+	queue_loan_repayments,
+)
+from lending.lending.doctype.process_loan_demand.process_loan_demand import (
+	process_daily_loan_demands,
+)
+from lending.tests.test_utils import (
+	create_loan,
+	init_customers,
+	init_loan_products,
+	make_loan_disbursement_entry,
+	master_init,
+)
+
+
+class TestLoanRepaymentRequest(IntegrationTestCase):
+	def setUp(self):
+		master_init()
+		init_loan_products()
+		init_customers()
+		self.applicant = frappe.db.get_value("Customer", {"name": "_Test Loan Customer"}, "name")
+
+	def test_queued_repayments(self):
+		loan = create_loan(
+			self.applicant,
+			"Term Loan Product 4",
+			1000000,
+			"Repay Over Number of Periods",
+			6,
+			applicant_type="Customer",
+			repayment_start_date="2024-05-05",
+			posting_date="2024-04-05",
+			rate_of_interest=23,
+		)
+		loan.submit()
+		make_loan_disbursement_entry(
+			loan.name,
+			loan.loan_amount,
+			disbursement_date="2024-04-05",
+			repayment_start_date="2024-05-05",
+		)
+		process_daily_loan_demands(posting_date="2024-06-05", loan=loan.name)
+
+		emi = calculate_amounts(loan.name, "2024-05-05")["payable_amount"] / 2
+		data = [
+			{
+				"against_loan": loan.name,
+				"value_date": value_date,
+				"amount_paid": emi,
+				"reference_number": reference_number,
+			}
+			for value_date, reference_number in (
+				("2024-05-05", "_TEST-LRR-1"),
+				("2024-06-05", "_TEST-LRR-2"),
+			)
+		]
+		data.append({"against_loan": "_Test Missing Loan", "value_date": "2024-06-05", "amount_paid": 1})
+		data.append(dict(data[0]))
+
+		response = queue_loan_repayments(data)
+
+		self.assertEqual(response["accepted"], ["_TEST-LRR-1", "_TEST-LRR-2"])
+		self.assertEqual(len(response["rejected"]), 2)
+
+		status = get_loan_repayment_request_status(["_TEST-LRR-1", "_TEST-LRR-2", "_TEST-LRR-3"])
+		self.assertEqual(status["_TEST-LRR-1"].status, "Completed")
+		self.assertEqual(status["_TEST-LRR-2"].status, "Completed")
+		self.assertEqual(status["_TEST-LRR-3"]["status"], "Not Found")
+
+		repayments = frappe.get_all(
+			"Loan Repayment",
+			filters={"against_loan": loan.name, "docstatus": 1},
+			fields=["reference_number", "value_date"],
+			order_by="creation",
+		)
+		self.assertEqual([d.reference_number for d in repayments], ["_TEST-LRR-1", "_TEST-LRR-2"])
+
+		# a failed repayment may be queued again under its reference number
+		frappe.get_doc(
+			{
+				"doctype": "Loan Repayment Request",
+				"reference_number": "_TEST-LRR-4",
+				"loan": loan.name,
+				"status": "Failed",
+			}
+		).insert()
+		retry = dict(data[1], reference_number="_TEST-LRR-4", amount_paid=1, docstatus=2)
+
+		response = queue_loan_repayments([retry])
+		self.assertEqual(response["accepted"], ["_TEST-LRR-4"])
+
+		request = frappe.db.get_value(
+			"Loan Repayment Request",
+			{"reference_number": "_TEST-LRR-4"},
+			["status", "requested_by", "payload"],
+			as_dict=1,
+		)
+		self.assertEqual(request.status, "Completed")
+		self.assertEqual(request.requested_by, frappe.session.user)
+		self.assertNotIn("docstatus", frappe.parse_json(request.payload))
@@ -0,0 +1,248 @@
+# Copyright (c) 2026, Frappe Technologies Pvt. Ltd. and contributors
+# For license information, please see license.txt
+
+import traceback
+
+import frappe
+from frappe.model.document import Document
+from frappe.query_builder.functions import Min
+from frappe.utils import add_to_date, getdate, now_datetime
+from rq.timeouts import JobTimeoutException
+
+from lending.settings import with_lending_settings
+from lending.utils import lock_claimed_requests
+
+LOAN_REPOST_REQUEST_TIMEOUT = 3600
+# Loans looked at per claim, loans being reposted by other workers are skipped
+LOAN_REPOST_REQUEST_CLAIM_CANDIDATES = 20
+
+
+class LoanRepostRequest(Document):
+	# begin: auto-generated types
+	# This code is auto-generated. Do not modify anything in this block.
+
+	from typing import TYPE_CHECKING
+
+	if TYPE_CHECKING:
+		from frappe.types import DF
+
+		claimed_at: DF.Datetime | None
+		coalesced_requests: DF.Int
+		error: DF.LongText | None
+		loan: DF.Link
+		loan_disbursement: DF.Link | None
+		loan_repayment_repost: DF.Link | None
+		repost_date: DF.Date
+		status: DF.Literal["Queued", "Processing", "Completed", "Failed"]
+	# end: auto-generated types
+
+	pass
+
+
+def queue_loan_repost(loan, repost_date, loan_disbursement=None):
+	"""Queues a repost of `loan` from `repost_date` for the repost workers.
+
+	Backdated repayments of a loan queued before the repost runs are merged into one
+	request, reposted once from the earliest of their dates."""
+	request = add_loan_repost_request(loan, repost_date, loan_disbursement=loan_disbursement)
+
+	if frappe.flags.in_test:
+		# reposted right away, in the transaction of the repayment
+		submit_loan_reposts(loan, [request])
+		return
+
+	frappe.enqueue(
+		process_loan_repost_requests,
+		queue="long",
+		timeout=LOAN_REPOST_REQUEST_TIMEOUT,
+		job_id=f"loan_repost_request::{loan}",
+		deduplicate=True,
+		enqueue_after_commit=True,
+		loan=loan,
+	)
+
+
+def add_loan_repost_request(loan, repost_date, loan_disbursement=None):
+	"""Merges the repost into the queued request of the loan or queues a new one"""
+	loan_doctype = frappe.qb.DocType("Loan")
+
+	# Serialises the requests of a loan, two backdated repayments submitted together end
+	# up in the same request
+	frappe.qb.from_(loan_doctype).select(loan_doctype.name).where(
+		loan_doctype.name == loan
+	).for_update().run()
+
+	request = frappe.db.get_value(
+		"Loan Repost Request",
+		{
+			"loan": loan,
+			"loan_disbursement": loan_disbursement or ("is", "not set"),
+			"status": "Queued",
+		},
+		["name", "loan_disbursement", "repost_date", "coalesced_requests"],
+		as_dict=1,
+	)
+
+	if request:
+		request.repost_date = min(getdate(request.repost_date), getdate(repost_date))
+		request.coalesced_requests += 1
+		frappe.db.set_value(
+			"Loan Repost Request",
+			request.name,
+			{"repost_date": request.repost_date, "coalesced_requests": request.coalesced_requests},
+		)
+		return request
+
+	doc = frappe.get_doc(
+		{
+			"doctype": "Loan Repost Request",
+			"loan": loan,
+			"loan_disbursement": loan_disbursement,
+			"repost_date": getdate(repost_date),
+			"status": "Queued",
+		}
+	).insert(ignore_permissions=True)
+
+	return frappe._dict(
+		name=doc.name,
+		loan_disbursement=doc.loan_disbursement,
+		repost_date=doc.repost_date,
+		coalesced_requests=doc.coalesced_requests,
+	)
+
+
+@with_lending_settings
+def process_loan_repost_requests(loan=None):
+	"""Worker loop, claims the queued requests of one loan at a time and reposts the loan
+	once per disbursement till no loan is left"""
+	while claimed := claim_loan_repost_requests(loan):
+		loan_name, requests = claimed
+
+		try:
+			# requests reclaimed by another worker since this claim are left to it
+			locked = lock_claimed_requests("Loan Repost Request", requests)
+			requests = [d for d in requests if d.name in locked]
+			if not requests:
+				frappe.db.rollback()
+				continue
+
+			submit_loan_reposts(loan_name, requests)
+		except JobTimeoutException:
+			# the requests stay Processing and are claimed again once their claim goes stale
+			frappe.db.rollback()
+			raise
+		except Exception:
+			error = traceback.format_exc()
+			frappe.db.rollback()
+
+			if locked := lock_claimed_requests("Loan Repost Request", requests):
+				frappe.db.set_value(
+					"Loan Repost Request",
+					{"name": ("in", locked)},
+					{"status": "Failed", "error": error},
+				)
+
+		# a failed repost does not hold back the other loans
+		frappe.db.commit()  # nosemgrep
+
+
+def claim_loan_repost_requests(loan=None):
+	request = frappe.qb.DocType("Loan Repost Request")
+	loan_doctype = frappe.qb.DocType("Loan")
+	stale_before = add_to_date(now_datetime(), seconds=-LOAN_REPOST_REQUEST_TIMEOUT)
+
+	claimable = (request.status == "Queued") | (
+		(request.status == "Processing") & (request.claimed_at < stale_before)
+	)
+
+	candidates = (
+		frappe.qb.from_(request)
+		.select(request.loan)
+		.where(claimable)
+		.groupby(request.loan)
+		.orderby(Min(request.creation))
+		.limit(LOAN_REPOST_REQUEST_CLAIM_CANDIDATES)
+	)
+
+	if loan:
+		candidates = candidates.where(request.loan == loan)
+
+	for (candidate,) in candidates.run(as_list=1):
+		# The loan row serialises the reposts of a loan, a loan locked by another worker or
+		# by a repayment being submitted is skipped and picked up later
+		if (
+			not frappe.qb.from_(loan_doctype)
+			.select(loan_doctype.name)
+			.where(loan_doctype.name == candidate)
+			.for_update(skip_locked=True)
+			.run()
+		):
+			continue
+
+		# Locking reads see the claims committed since the candidates were read
+		if (
+			frappe.qb.from_(request)
+			.select(request.name)
+			.where(request.loan == candidate)
+			.where(request.status == "Processing")
+			.where(request.claimed_at >= stale_before)
+			.for_update()
+			.run()
+		):
+			frappe.db.rollback()
+			continue
+
+		claimed = (
+			frappe.qb.from_(request)
+			.select(request.name, request.loan_disbursement, request.repost_date)
+			.where(request.loan == candidate)
+			.where(claimable)
+			.for_update()
+			.run(as_dict=1)
+		)
+
+		if not claimed:
+			frappe.db.rollback()
+			continue
+
+		claimed_at = now_datetime()
+		frappe.qb.update(request).set(request.status, "Processing").set(
+			request.claimed_at, claimed_at
+		).where(request.name.isin([d.name for d in claimed])).where(claimable).run()
+		frappe.db.commit()  # nosemgrep
+
+		for d in claimed:
+			d.claimed_at = claimed_at
+
+		return candidate, claimed
+
+	frappe.db.rollback()
+	return None
+
+
+def submit_loan_reposts(loan, requests):
+	"""Reposts `loan` once per disbursement, from the earliest date of its requests"""
+	repost_dates = {}
+	for request in requests:
+		key = request.loan_disbursement or None
+		repost_date = getdate(request.repost_date)
+		repost_dates[key] = min(repost_dates.get(key, repost_date), repost_date)
+
+	for loan_disbursement, repost_date in repost_dates.items():
+		repost = frappe.new_doc("Loan Repayment Repost")
+		repost.loan = loan
+		repost.loan_disbursement = loan_disbursement
+		repost.repost_date = repost_date
+		repost.cancel_future_accruals_and_demands = True
+		repost.cancel_future_emi_demands = True
+		repost.incremental = True
+		repost.submit()
+
+		frappe.db.set_value(
+			"Loan Repost Request",
+			{
+				"name": ("in", [d.name for d in requests]),
+				"loan_disbursement": loan_disbursement or ("is", "not set"),
+			},
+			{"status": "Completed", "loan_repayment_repost": repost.name, "error": None},
+		)
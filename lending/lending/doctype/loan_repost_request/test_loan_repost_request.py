@@ -0,0 +1,50 @@
+# Copyright (c) 2026, Frappe Technologies Pvt. Ltd. and Contributors
+# See license.txt
+
+import frappe
+from frappe.tests import IntegrationTestCase
+
+from lending.lending.doctype.loan_repost_request.loan_repost_request import (
+	add_loan_repost_request,
+)
+from lending.tests.test_utils import (
+	create_loan,
+	init_customers,
+	init_loan_products,
+	master_init,
+)
+
+
+class TestLoanRepostRequest(IntegrationTestCase):
+	def setUp(self):
+		master_init()
+		init_loan_products()
+		init_customers()
+		self.applicant = frappe.db.get_value("Customer", {"name": "_Test Loan Customer"}, "name")
+
+	def test_queued_reposts_are_coalesced(self):
+		loan = create_loan(
+			self.applicant,
+			"Term Loan Product 4",
+			1000000,
+			"Repay Over Number of Periods",
+			6,
+			applicant_type="Customer",
+			repayment_start_date="2024-05-05",
+			posting_date="2024-04-05",
+			rate_of_interest=23,
+		)
+		loan.submit()
+
+		for repost_date in ("2024-06-10", "2024-05-20", "2024-07-01"):
+			add_loan_repost_request(loan.name, repost_date)
+
+		requests = frappe.get_all(
+			"Loan Repost Request",
+			filters={"loan": loan.name, "status": "Queued"},
+			fields=["repost_date", "coalesced_requests"],
+		)
+
+		self.assertEqual(len(requests), 1)
+		self.assertEqual(str(requests[0].repost_date), "2024-05-20")
+		self.assertEqual(requests[0].coalesced_requests, 3)
@@ -1,6 +1,7 @@
 # Copyright (c) 2019, Frappe Technologies Pvt. Ltd. and contributors
 # For license information, please see license.txt
 
+from itertools import chain
 
 import frappe
 from frappe.model.document import Document
@@ -9,6 +10,7 @@ from frappe.utils import flt, get_datetime
 from lending.lending.doctype.loan_security_release.loan_security_release import (
 	get_pledged_security_qty,
 )
+from lending.utils import iter_loan_batches
 
 
 class LoanSecurityShortfall(Document):
@@ -95,20 +97,25 @@ def check_for_ltv_shortfall(process_loan_security_shortfall):
 		)
 	)
 
-	loans = frappe.get_all(
-		"Loan",
-		fields=[
-			"name",
-			"loan_amount",
-			"total_principal_paid",
-			"total_payment",
-			"total_interest_payable",
-			"disbursed_amount",
-			"status",
-		],
-		filters={"status": ("in", ["Disbursed", "Partially Disbursed"]), "is_secured_loan": 1},
+	loan_doc = frappe.qb.DocType("Loan")
+	query = (
+		frappe.qb.from_(loan_doc)
+		.select(
+			loan_doc.name,
+			loan_doc.loan_amount,
+			loan_doc.total_principal_paid,
+			loan_doc.total_payment,
+			loan_doc.total_interest_payable,
+			loan_doc.disbursed_amount,
+			loan_doc.status,
+		)
+		.where(loan_doc.status.isin(["Disbursed", "Partially Disbursed"]))
+		.where(loan_doc.is_secured_loan == 1)
 	)
 
+	# Streamed a page at a time instead of loading every secured loan upfront
+	loans = chain.from_iterable(iter_loan_batches(query))
+
 	loan_shortfall_map = frappe._dict(
 		frappe.get_all(
 			"Loan Security Shortfall", fields=["loan", "name"], filters={"status": "Pending"}, as_list=1
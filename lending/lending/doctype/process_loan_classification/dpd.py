@@ -0,0 +1,355 @@
+"""Set based days past due for the nightly loan classification.
+
+The oldest unpaid EMI demand of every loan and disbursement in a batch is read with one
+grouped query. Days past due and classification codes are then derived in memory and
+written back with a handful of batched statements instead of a round of reads and
+writes per loan.
+
+Loans crossing their NPA threshold are collected and their applicants marked NPA once
+each, after the days past due of the batch are written and committed. Nightly batches
+keep the loans of an applicant together, so every applicant is evaluated once per run.
+An applicant that cannot be marked leaves its loans to the per loan path.
+
+NPA loans that may come out of NPA are handed back to the caller to be processed one at
+a time by `update_days_past_due_in_loans`, as are settled loans and loans due for an
+auto write off. Those carry side effects (suspense write offs, write offs) the set based
+pass does not replicate."""
+
+import frappe
+from frappe.query_builder import Case
+from frappe.query_builder.functions import Max, Min
+from frappe.utils import add_days, cint, date_diff, getdate
+
+from lending.classification import classify_days_past_due
+from lending.settings import get_lending_settings
+
+DPD_UPDATE_CHUNK_SIZE = 500
+
+
+def process_days_past_due(
+	loans,
+	posting_date,
+	loan_product=None,
+	process_loan_classification=None,
+	loan_disbursement=None,
+	force_update_dpd_in_loan=0,
+):
+	"""Writes the days past due of `loans` as of `posting_date` and returns the loans left
+	for `update_days_past_due_in_loans`"""
+	settings = get_lending_settings()
+	posting_date = getdate(posting_date)
+	update_loans = posting_date == add_days(getdate(), -1) or force_update_dpd_in_loan
+
+	loan_details = get_loan_details_map(loans)
+	disbursement_map = get_disbursement_map(loans, loan_disbursement=loan_disbursement)
+	oldest_demand_map = get_oldest_unpaid_emi_demand_map(
+		loans, posting_date, loan_product=loan_product, loan_disbursement=loan_disbursement
+	)
+
+	fallback = []
+	npa_loans = []
+	dpd_records = []
+	loan_dpd_map = {}
+	line_of_credit_dpd = {}
+
+	for loan in loans:
+		details = loan_details.get(loan)
+		if not details or not disbursement_map.get(loan):
+			continue
+
+		freeze_date = details.freeze_date and getdate(details.freeze_date)
+		if freeze_date and freeze_date < posting_date:
+			continue
+
+		threshold = settings.get_loan_product(details.loan_product).days_past_due_threshold_for_npa
+		write_off_threshold = settings.get_company(
+			details.company
+		).days_past_due_threshold_for_auto_write_off
+
+		disbursement_dpd = {}
+		becomes_npa = False
+		for disbursement in disbursement_map[loan]:
+			demand_date = oldest_demand_map.get((loan, disbursement))
+
+			days_past_due = 0
+			if demand_date and not freeze_date:
+				days_past_due = max(date_diff(posting_date, getdate(demand_date)) + 1, 0)
+
+			disbursement_dpd[disbursement] = days_past_due
+			if threshold and days_past_due > threshold and not cint(details.unmark_npa):
+				becomes_npa = True
+
+		if write_off_threshold and max(disbursement_dpd.values()) > write_off_threshold:
+			fallback.append(loan)
+			continue
+
+		if update_loans:
+			if details.repayment_schedule_type == "Line of Credit":
+				line_of_credit_dpd[loan] = disbursement_dpd
+			else:
+				# the loan takes the days past due of the last disbursement, as it does when
+				# the disbursements are processed one at a time
+				loan_dpd_map[loan] = days_past_due
+
+			if details.status == "Settled":
+				fallback.append(loan)
+				line_of_credit_dpd.pop(loan, None)
+				loan_dpd_map.pop(loan, None)
+				continue
+
+			if becomes_npa and not cint(details.is_npa):
+				npa_loans.append(loan)
+
+		dpd_records.extend(
+			(loan, disbursement, days_past_due) for disbursement, days_past_due in disbursement_dpd.items()
+		)
+
+	if line_of_credit_dpd:
+		update_disbursement_days_past_due(line_of_credit_dpd)
+		loan_dpd_map.update(
+			(loan, cint(days_past_due))
+			for loan, days_past_due in get_line_of_credit_dpd_map(list(line_of_credit_dpd)).items()
+		)
+
+	# loans classified together, by company and written off status
+	classification_groups = {}
+	for loan, days_past_due in loan_dpd_map.items():
+		details = loan_details[loan]
+
+		# an NPA loan without any days past due left may take the customer out of NPA
+		if cint(details.is_npa) and (not days_past_due or details.freeze_date):
+			fallback.append(loan)
+			continue
+
+		key = (details.company, details.status == "Written Off")
+		classification_groups.setdefault(key, []).append(loan)
+
+	loan_updates = {}
+	for (company, is_written_off), group in classification_groups.items():
+		classifications = classify_days_past_due(
+			company, [loan_dpd_map[loan] for loan in group], is_written_off=is_written_off
+		)
+		for loan, classification in zip(group, classifications):
+			loan_updates[loan] = (loan_dpd_map[loan], *classification)
+
+	update_loan_days_past_due(loan_updates)
+
+	skipped = set(fallback)
+	write_dpd_records(
+		[record for record in dpd_records if record[0] not in skipped],
+		posting_date,
+		process_loan_classification,
+	)
+
+	# the days past due of the batch are kept whatever happens to the NPA marking
+	frappe.db.commit()  # nosemgrep
+
+	fallback += mark_applicants_npa(npa_loans, loan_details, posting_date)
+
+	return fallback
+
+
+def mark_applicants_npa(npa_loans, loan_details, posting_date):
+	"""Marks the applicants of the loans that crossed their NPA threshold NPA, each one
+	once however many of their loans crossed it. Returns the loans of the applicants that
+	could not be marked.
+
+	Overdue interest and charges of the applicant's loans that are not NPA yet are moved
+	to suspense first, a Journal Entry per loan under a savepoint per applicant. The loans
+	and customers of the applicants moved to suspense are then marked NPA in bulk."""
+	from lending.lending.doctype.loan.loan import (
+		move_receivable_charges_to_suspense_ledger,
+		move_unpaid_interest_to_suspense_ledger,
+		update_npa_check_for_applicants,
+	)
+
+	applicants = {}
+	for loan in npa_loans:
+		details = loan_details[loan]
+		applicants.setdefault((details.applicant_type, details.applicant), []).append(loan)
+
+	if not applicants:
+		return []
+
+	applicant_loans = {}
+	for loan in frappe.db.get_all(
+		"Loan",
+		filters={
+			"status": ("in", ["Disbursed", "Partially Disbursed", "Active"]),
+			"docstatus": 1,
+			"applicant": ("in", [applicant for _applicant_type, applicant in applicants]),
+			"is_npa": 0,
+		},
+		fields=["name", "company", "applicant_type", "applicant"],
+	):
+		applicant_loans.setdefault((loan.applicant_type, loan.applicant), []).append(loan)
+
+	marked, failed = [], []
+	frappe.db.savepoint("mark_applicants_npa")
+
+	for applicant, loans in applicants.items():
+		frappe.db.savepoint("mark_applicant_npa")
+		try:
+			for loan in applicant_loans.get(applicant, []):
+				move_unpaid_interest_to_suspense_ledger(loan.name, posting_date, value_date=posting_date)
+				move_receivable_charges_to_suspense_ledger(
+					loan.name, loan.company, posting_date, posting_date
+				)
+			marked.append(applicant)
+		except Exception:
+			frappe.db.rollback(save_point="mark_applicant_npa")
+			frappe.log_error(
+				title="Process Loan Classification Error",
+				message=frappe.get_traceback(),
+				reference_doctype="Loan",
+				reference_name=loans[0],
+			)
+			failed += loans
+
+	try:
+		update_npa_check_for_applicants(marked, posting_date, event="Background Job")
+	except Exception:
+		frappe.db.rollback(save_point="mark_applicants_npa")
+		frappe.log_error(title="Process Loan Classification Error", message=frappe.get_traceback())
+		return list(npa_loans)
+
+	return failed
+
+
+def get_loan_details_map(loans):
+	return {
+		loan.name: loan
+		for loan in frappe.db.get_all(
+			"Loan",
+			filters={"name": ("in", loans)},
+			fields=[
+				"name",
+				"company",
+				"loan_product",
+				"status",
+				"repayment_schedule_type",
+				"freeze_date",
+				"is_npa",
+				"unmark_npa",
+				"applicant_type",
+				"applicant",
+			],
+		)
+	}
+
+
+def get_disbursement_map(loans, loan_disbursement=None):
+	"""Disbursements of the active and closed repayment schedules, in the order
+	`update_days_past_due_in_loans` processes them"""
+	filters = {"loan": ("in", loans), "status": ("in", ["Active", "Closed"]), "docstatus": 1}
+	if loan_disbursement:
+		filters["loan_disbursement"] = loan_disbursement
+
+	disbursement_map = {}
+	for schedule in frappe.db.get_all(
+		"Loan Repayment Schedule", filters, ["loan", "loan_disbursement"]
+	):
+		disbursement_map.setdefault(schedule.loan, []).append(schedule.loan_disbursement)
+
+	return disbursement_map
+
+
+def get_oldest_unpaid_emi_demand_map(
+	loans, posting_date, loan_product=None, loan_disbursement=None
+):
+	"""Date of the oldest unpaid EMI demand keyed by (loan, disbursement)"""
+	from lending.lending.doctype.loan_repayment.loan_repayment import get_unpaid_demand_condition
+
+	loan_demand = frappe.qb.DocType("Loan Demand")
+
+	query = (
+		frappe.qb.from_(loan_demand)
+		.select(loan_demand.loan, loan_demand.loan_disbursement, Min(loan_demand.demand_date))
+		.where(loan_demand.loan.isin(loans))
+		.where(loan_demand.docstatus == 1)
+		.where(loan_demand.demand_date <= posting_date)
+		.where(get_unpaid_demand_condition(loan_demand, get_lending_settings().precision))
+		.where(loan_demand.demand_type == "EMI")
+		.groupby(loan_demand.loan, loan_demand.loan_disbursement)
+	)
+
+	if loan_product:
+		query = query.where(loan_demand.loan_product == loan_product)
+
+	if loan_disbursement:
+		query = query.where(loan_demand.loan_disbursement == loan_disbursement)
+
+	return {(loan, disbursement): demand_date for loan, disbursement, demand_date in query.run()}
+
+
+def update_disbursement_days_past_due(line_of_credit_dpd):
+	disbursement_dpd = {
+		disbursement: days_past_due
+		for dpd_map in line_of_credit_dpd.values()
+		for disbursement, days_past_due in dpd_map.items()
+		if disbursement
+	}
+
+	loan_disbursement = frappe.qb.DocType("Loan Disbursement")
+	disbursements = list(disbursement_dpd)
+
+	for i in range(0, len(disbursements), DPD_UPDATE_CHUNK_SIZE):
+		chunk = disbursements[i : i + DPD_UPDATE_CHUNK_SIZE]
+
+		days_past_due = Case()
+		for disbursement in chunk:
+			days_past_due = days_past_due.when(
+				loan_disbursement.name == disbursement, disbursement_dpd[disbursement]
+			)
+
+		frappe.qb.update(loan_disbursement).set(loan_disbursement.days_past_due, days_past_due).where(
+			loan_disbursement.name.isin(chunk)
+		).run()
+
+
+def get_line_of_credit_dpd_map(loans):
+	"""Days past due of a line of credit loan, the highest of its disbursements"""
+	loan_disbursement = frappe.qb.DocType("Loan Disbursement")
+
+	return dict(
+		frappe.qb.from_(loan_disbursement)
+		.select(loan_disbursement.against_loan, Max(loan_disbursement.days_past_due))
+		.where(loan_disbursement.against_loan.isin(loans))
+		.where(loan_disbursement.docstatus == 1)
+		.groupby(loan_disbursement.against_loan)
+		.run()
+	)
+
+
+def update_loan_days_past_due(loan_updates):
+	"""Sets days past due and classification of the loans, keyed by loan, without
+	touching `modified`"""
+	loan = frappe.qb.DocType("Loan")
+	loans = list(loan_updates)
+
+	for i in range(0, len(loans), DPD_UPDATE_CHUNK_SIZE):
+		chunk = loans[i : i + DPD_UPDATE_CHUNK_SIZE]
+
+		days_past_due = Case()
+		classification_code = Case()
+		classification_name = Case()
+		for name in chunk:
+			dpd, code, classification = loan_updates[name]
+			days_past_due = days_past_due.when(loan.name == name, dpd)
+			classification_code = classification_code.when(loan.name == name, code)
+			classification_name = classification_name.when(loan.name == name, classification)
+
+		frappe.qb.update(loan).set(loan.days_past_due, days_past_due).set(
+			loan.classification_code, classification_code
+		).set(loan.classification_name, classification_name).where(loan.name.isin(chunk)).run()
+
+
+def write_dpd_records(dpd_records, posting_date, process_loan_classification=None):
+	"""Upserts the Days Past Due Log of each (loan, disbursement) on `posting_date`"""
+	from lending.lending.doctype.days_past_due_log.days_past_due_log import DaysPastDueLogWriter
+
+	writer = DaysPastDueLogWriter()
+	for loan, disbursement, days_past_due in dpd_records:
+		writer.add(loan, disbursement, posting_date, days_past_due, process_loan_classification)
+
+	writer.flush()
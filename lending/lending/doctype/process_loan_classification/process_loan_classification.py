@@ -6,6 +6,10 @@ from frappe import _
 from frappe.model.document import Document
 from frappe.utils import add_days, getdate
 
+from lending.lending.doctype.process_loan_classification.dpd import process_days_past_due
+from lending.settings import with_lending_settings
+from lending.utils import iter_applicant_loan_batches
+
 
 class ProcessLoanClassification(Document):
 	# begin: auto-generated types
@@ -31,26 +35,22 @@ class ProcessLoanClassification(Document):
 			frappe.throw(_("For backdated process loan classification, a Loan account is mandatory."))
 
 	def on_submit(self):
-		filters = {
-			"docstatus": 1,
-			"status": ("in", ["Disbursed", "Partially Disbursed", "Active", "Written Off", "Settled"]),
-		}
+		loan = frappe.qb.DocType("Loan")
+		statuses = ["Disbursed", "Partially Disbursed", "Active", "Written Off", "Settled"]
+
+		query = frappe.qb.from_(loan).select(loan.name).where(loan.docstatus == 1)
 
 		if self.loan:
-			filters["name"] = self.loan
-			filters["status"] = (
-				"in",
-				["Disbursed", "Partially Disbursed", "Active", "Written Off", "Settled", "Closed"],
-			)
+			query = query.where(loan.name == self.loan).where(loan.status.isin([*statuses, "Closed"]))
+		else:
+			query = query.where(loan.status.isin(statuses))
 
 		if self.loan_product:
-			filters["loan_product"] = self.loan_product
-
-		open_loans = frappe.get_all("Loan", filters=filters, pluck="name", order_by="applicant")
+			query = query.where(loan.loan_product == self.loan_product)
 
 		if self.loan:
 			process_loan_classification_batch(
-				open_loans,
+				[d.name for d in query.run(as_dict=1)],
 				self.posting_date,
 				self.loan_product,
 				self.name,
@@ -61,11 +61,11 @@ class ProcessLoanClassification(Document):
 			)
 		else:
 			BATCH_SIZE = 5000
-			batch_list = list(get_batches(open_loans, BATCH_SIZE))
-			for batch in batch_list:
+			# NPA is decided per applicant, so an applicant's loans are classified together
+			for batch in iter_applicant_loan_batches(query, BATCH_SIZE):
 				frappe.enqueue(
 					process_loan_classification_batch,
-					open_loans=batch,
+					open_loans=[d.name for d in batch],
 					posting_date=self.posting_date,
 					loan_product=self.loan_product,
 					classification_process=self.name,
@@ -78,6 +78,7 @@ class ProcessLoanClassification(Document):
 				)
 
 
+@with_lending_settings
 def process_loan_classification_batch(
 	open_loans,
 	posting_date,
@@ -90,6 +91,31 @@ def process_loan_classification_batch(
 ):
 	from lending.lending.doctype.loan.loan import update_days_past_due_in_loans
 
+	single_loan = len(open_loans) == 1
+
+	if (
+		not single_loan
+		and not payment_reference
+		and not is_backdated
+		and (getdate(posting_date) >= add_days(getdate(), -1) or force_update_dpd_in_loan)
+	):
+		try:
+			open_loans = process_days_past_due(
+				open_loans,
+				posting_date,
+				loan_product=loan_product,
+				process_loan_classification=classification_process,
+				loan_disbursement=loan_disbursement,
+				force_update_dpd_in_loan=force_update_dpd_in_loan,
+			)
+			frappe.db.commit()
+		except Exception:
+			# the loans of the batch are processed one at a time instead
+			frappe.log_error(
+				title="Process Loan Classification Error", message=frappe.get_traceback()
+			)
+			frappe.db.rollback()
+
 	for loan in open_loans:
 		try:
 			update_days_past_due_in_loans(
@@ -103,10 +129,10 @@ def process_loan_classification_batch(
 				force_update_dpd_in_loan=force_update_dpd_in_loan,
 			)
 
-			if len(open_loans) > 1:
+			if not single_loan:
 				frappe.db.commit()
 		except Exception as e:
-			if len(open_loans) == 1:
+			if single_loan:
 				raise e
 			else:
 				frappe.log_error(
@@ -118,11 +144,6 @@ def process_loan_classification_batch(
 				frappe.db.rollback()
 
 
-def get_batches(open_loans, batch_size):
-	for i in range(0, len(open_loans), batch_size):
-		yield open_loans[i : i + batch_size]
-
-
 def create_process_loan_classification(
 	posting_date=None,
 	loan_product=None,
@@ -1,9 +1,50 @@
 # Copyright (c) 2023, Frappe Technologies Pvt. Ltd. and Contributors
 # See license.txt
 
-# import frappe
+import frappe
 from frappe.tests.utils import FrappeTestCase
 
+from lending.classification import ClassificationRanges
+
 
 class TestProcessLoanClassification(FrappeTestCase):
-	pass
+	def test_classification_ranges_lookup(self):
+		ranges = [
+			frappe._dict(
+				min_dpd_range=1,
+				max_dpd_range=30,
+				is_written_off=0,
+				classification_code="SMA-0",
+				classification_name="Special Mention Account - 0",
+			),
+			frappe._dict(
+				min_dpd_range=31,
+				max_dpd_range=90,
+				is_written_off=0,
+				classification_code="SMA-1",
+				classification_name="Special Mention Account - 1",
+			),
+			# overlaps the one above, which is matched first
+			frappe._dict(
+				min_dpd_range=60,
+				max_dpd_range=120,
+				is_written_off=0,
+				classification_code="SUB",
+				classification_name="Substandard",
+			),
+			frappe._dict(
+				min_dpd_range=0,
+				max_dpd_range=1000,
+				is_written_off=1,
+				classification_code="WO",
+				classification_name="Written Off",
+			),
+		]
+
+		classification = ClassificationRanges.compile(ranges)
+
+		self.assertEqual(
+			[code for code, _name in classification.classify_many([0, 1, 30, 31, 90, 91, 120, 121])],
+			["", "SMA-0", "SMA-0", "SMA-1", "SMA-1", "SUB", "SUB", ""],
+		)
+		self.assertEqual(classification.classify(45, is_written_off=1), ("WO", "Written Off"))
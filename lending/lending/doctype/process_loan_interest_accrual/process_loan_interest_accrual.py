@@ -4,13 +4,25 @@
 
 import frappe
 from frappe.model.document import Document
-from frappe.utils import add_days, nowdate
+from frappe.utils import add_days, add_to_date, now_datetime, nowdate
+from rq.timeouts import JobTimeoutException
 
 from lending.lending.doctype.loan_interest_accrual.loan_interest_accrual import (
+	get_accrual_loans_query,
 	get_loan_accrual_frequency,
 	is_posting_date_accrual_day,
 	make_accrual_interest_entry_for_loans,
+	process_interest_accrual_batch,
 )
+from lending.utils import iter_loan_batches
+
+ACCRUAL_SHARD_SIZE = 3000
+# Every shard runs as a job of its own, killed by RQ after this long
+ACCRUAL_SHARD_TIMEOUT = 3600
+# A shard left running for longer than this is taken to belong to a killed job
+ACCRUAL_SHARD_STALE_AFTER = ACCRUAL_SHARD_TIMEOUT + 900
+# A shard killed this many times is marked Failed instead of being run again
+ACCRUAL_SHARD_MAX_ATTEMPTS = 3
 
 
 class ProcessLoanInterestAccrual(Document):
@@ -22,6 +34,10 @@ class ProcessLoanInterestAccrual(Document):
 	if TYPE_CHECKING:
 		from frappe.types import DF
 
+		from lending.lending.doctype.process_loan_interest_accrual_shard.process_loan_interest_accrual_shard import (
+			ProcessLoanInterestAccrualShard,
+		)
+
 		accrual_type: DF.Literal[
 			"Regular", "Repayment", "Disbursement", "Credit Adjustment", "Debit Adjustment", "Refund"
 		]
@@ -31,9 +47,27 @@ class ProcessLoanInterestAccrual(Document):
 		loan_disbursement: DF.Link | None
 		loan_product: DF.Link | None
 		posting_date: DF.Date
+		shards: DF.Table[ProcessLoanInterestAccrualShard]
+		status: DF.Literal["Queued", "In Progress", "Completed", "Partially Failed"]
 	# end: auto-generated types
 
+	def before_submit(self):
+		self.set("shards", [])
+		if self.loan:
+			# Single loan accruals run inline and raise on failure
+			self.status = "Completed"
+			return
+
+		for shard_from, shard_to in get_accrual_shard_ranges(self.loan_product, self.company):
+			self.append("shards", {"shard_from": shard_from, "shard_to": shard_to, "status": "Queued"})
+
+		self.status = "Queued" if self.shards else "Completed"
+
 	def on_submit(self):
+		if not self.loan:
+			enqueue_accrual_shards(self.name, [d.name for d in self.shards])
+			return
+
 		make_accrual_interest_entry_for_loans(
 			self.posting_date,
 			self.name,
@@ -47,6 +81,225 @@ class ProcessLoanInterestAccrual(Document):
 		)
 
 
+def get_accrual_shard_ranges(loan_product=None, company=None, shard_size=ACCRUAL_SHARD_SIZE):
+	"""Splits the open loans into contiguous loan name ranges of `shard_size` loans each.
+
+	Only loan names are read, a page at a time, so the plan stays cheap however many
+	loans are open. Workers load the loans of a range when they pick it up."""
+	query = get_accrual_loans_query(loan_product=loan_product, company=company, fields=["name"])
+
+	return [(loans[0].name, loans[-1].name) for loans in iter_loan_batches(query, shard_size)]
+
+
+def enqueue_accrual_shards(process_loan_interest, shards):
+	"""Enqueues a job per shard, a shard whose job is still waiting is not enqueued twice"""
+	for shard in shards:
+		frappe.enqueue(
+			process_accrual_shard,
+			process_loan_interest=process_loan_interest,
+			shard=shard,
+			queue="long",
+			timeout=ACCRUAL_SHARD_TIMEOUT,
+			job_id=f"process_loan_interest_accrual::{process_loan_interest}::{shard}",
+			deduplicate=True,
+			enqueue_after_commit=True,
+		)
+
+
+def process_accrual_shard(process_loan_interest, shard):
+	"""Job of a single shard, marks the process done when it is the last shard to finish"""
+	if claimed := claim_accrual_shard(process_loan_interest, shard=shard):
+		run_accrual_shard(get_accrual_process(process_loan_interest), claimed)
+
+	update_accrual_process_status(process_loan_interest)
+
+
+def process_accrual_shards(process_loan_interest):
+	"""Runs the unfinished shards of the process inline, one after the other"""
+	process = get_accrual_process(process_loan_interest)
+
+	while shard := claim_accrual_shard(process_loan_interest):
+		run_accrual_shard(process, shard)
+
+	update_accrual_process_status(process_loan_interest)
+
+
+def get_accrual_process(process_loan_interest):
+	return frappe.db.get_value(
+		"Process Loan Interest Accrual",
+		process_loan_interest,
+		["name", "posting_date", "loan_product", "company", "accrual_type", "loan_disbursement"],
+		as_dict=1,
+	)
+
+
+def claim_accrual_shard(process_loan_interest, shard=None):
+	"""Claims `shard`, or the first unfinished shard of the process when none is given"""
+	shard_doc = frappe.qb.DocType("Process Loan Interest Accrual Shard")
+	stale_before = add_to_date(now_datetime(), seconds=-ACCRUAL_SHARD_STALE_AFTER)
+
+	# Locked rows are being claimed by another worker and are skipped
+	query = (
+		frappe.qb.from_(shard_doc)
+		.select(shard_doc.name, shard_doc.shard_from, shard_doc.shard_to)
+		.where(shard_doc.parent == process_loan_interest)
+		.where(shard_doc.parenttype == "Process Loan Interest Accrual")
+		.where(
+			(shard_doc.status == "Queued")
+			| (
+				(shard_doc.status == "Running")
+				& (shard_doc.started_at < stale_before)
+				& (shard_doc.attempts < ACCRUAL_SHARD_MAX_ATTEMPTS)
+			)
+		)
+		.orderby(shard_doc.idx)
+		.limit(1)
+		.for_update(skip_locked=True)
+	)
+
+	if shard:
+		query = query.where(shard_doc.name == shard)
+
+	claimed = query.run(as_dict=1)
+
+	if not claimed:
+		frappe.db.rollback()
+		return
+
+	frappe.qb.update(shard_doc).set(shard_doc.status, "Running").set(
+		shard_doc.started_at, now_datetime()
+	).set(shard_doc.attempts, shard_doc.attempts + 1).where(shard_doc.name == claimed[0].name).run()
+
+	process = frappe.qb.DocType("Process Loan Interest Accrual")
+	frappe.qb.update(process).set(process.status, "In Progress").where(
+		process.name == process_loan_interest
+	).where(process.status == "Queued").run()
+
+	frappe.db.commit()
+
+	return claimed[0]
+
+
+def run_accrual_shard(process, shard):
+	loan = frappe.qb.DocType("Loan")
+	status = "Completed"
+	loans = []
+	failed_loans = []
+
+	try:
+		loans = (
+			get_accrual_loans_query(loan_product=process.loan_product, company=process.company)
+			.where(loan.name >= shard.shard_from)
+			.where(loan.name <= shard.shard_to)
+			.run(as_dict=1)
+		)
+
+		failed_loans = process_interest_accrual_batch(
+			loans,
+			process.posting_date,
+			process.name,
+			process.accrual_type,
+			process.posting_date,
+			loan_disbursement=process.loan_disbursement,
+		)
+	except JobTimeoutException:
+		# the shard stays Running and is run afresh by the hourly sweep
+		frappe.db.rollback()
+		raise
+	except Exception:
+		frappe.db.rollback()
+		frappe.log_error(
+			title="Loan Interest Accrual Shard Error",
+			message=frappe.get_traceback(),
+			reference_doctype="Process Loan Interest Accrual",
+			reference_name=process.name,
+		)
+		status = "Failed"
+		# A single loan shard raises instead of logging the loan
+		failed_loans = [d.name for d in loans] if len(loans) == 1 else failed_loans
+
+	shard_doc = frappe.qb.DocType("Process Loan Interest Accrual Shard")
+	frappe.qb.update(shard_doc).set(shard_doc.status, status).set(
+		shard_doc.loans_processed, len(loans) - len(failed_loans)
+	).set(shard_doc.loans_failed, len(failed_loans)).set(
+		shard_doc.completed_at, now_datetime()
+	).where(shard_doc.name == shard.name).run()
+
+	frappe.db.commit()
+
+
+def update_accrual_process_status(process_loan_interest):
+	"""Marks the process completed once every shard has reported"""
+	shards = frappe.db.get_all(
+		"Process Loan Interest Accrual Shard",
+		filters={"parent": process_loan_interest, "parenttype": "Process Loan Interest Accrual"},
+		fields=["status", "loans_failed"],
+	)
+
+	if any(d.status in ("Queued", "Running") for d in shards):
+		return
+
+	if any(d.status == "Failed" or d.loans_failed for d in shards):
+		status = "Partially Failed"
+	else:
+		status = "Completed"
+
+	frappe.db.set_value(
+		"Process Loan Interest Accrual",
+		process_loan_interest,
+		"status",
+		status,
+		update_modified=False,
+	)
+	frappe.db.commit()
+
+
+def requeue_stale_accrual_shards():
+	"""Hourly sweep of the sharded accrual runs left unfinished.
+
+	Shards still queued are enqueued again, unless their job is still waiting, and shards
+	whose job was killed mid run are enqueued to be run afresh. Shards killed
+	`ACCRUAL_SHARD_MAX_ATTEMPTS` times are marked Failed. Runs whose shards have all
+	reported are marked done."""
+	shard = frappe.qb.DocType("Process Loan Interest Accrual Shard")
+	stale_before = add_to_date(now_datetime(), seconds=-ACCRUAL_SHARD_STALE_AFTER)
+
+	processes = frappe.get_all(
+		"Process Loan Interest Accrual",
+		filters={"docstatus": 1, "status": ("in", ["Queued", "In Progress"])},
+		pluck="name",
+	)
+
+	for process_loan_interest in processes:
+		frappe.qb.update(shard).set(shard.status, "Failed").set(
+			shard.completed_at, now_datetime()
+		).where(shard.parent == process_loan_interest).where(
+			shard.parenttype == "Process Loan Interest Accrual"
+		).where(shard.status == "Running").where(shard.started_at < stale_before).where(
+			shard.attempts >= ACCRUAL_SHARD_MAX_ATTEMPTS
+		).run()
+
+		shards = (
+			frappe.qb.from_(shard)
+			.select(shard.name)
+			.where(shard.parent == process_loan_interest)
+			.where(shard.parenttype == "Process Loan Interest Accrual")
+			.where(
+				(shard.status == "Queued")
+				| ((shard.status == "Running") & (shard.started_at < stale_before))
+			)
+			.orderby(shard.idx)
+			.run(pluck=True)
+		)
+
+		if shards:
+			enqueue_accrual_shards(process_loan_interest, shards)
+		else:
+			update_accrual_process_status(process_loan_interest)
+
+	frappe.db.commit()
+
+
 def schedule_accrual():
 	for company in frappe.get_all("Company", {"is_group": 0}, pluck="name"):
 		posting_date = add_days(nowdate(), -1)
@@ -1,9 +1,160 @@
 # Copyright (c) 2019, Frappe Technologies Pvt. Ltd. and Contributors
 # See license.txt
 
-# import frappe
-import unittest
+import frappe
+from frappe.tests import IntegrationTestCase
+from frappe.utils import add_to_date, now_datetime
 
+from lending.lending.doctype.process_loan_interest_accrual.process_loan_interest_accrual import (
+	get_accrual_shard_ranges,
+	process_accrual_shard,
+	process_accrual_shards,
+	process_loan_interest_accrual_for_loans,
+	requeue_stale_accrual_shards,
+)
+from lending.tests.test_utils import (
+	create_loan,
+	init_customers,
+	init_loan_products,
+	make_loan_disbursement_entry,
+	master_init,
+	set_loan_accrual_frequency,
+)
 
-class TestProcessLoanInterestAccrual(unittest.TestCase):
-	pass
+
+class TestProcessLoanInterestAccrual(IntegrationTestCase):
+	def setUp(self):
+		master_init()
+		init_loan_products()
+		init_customers()
+		self.applicant = frappe.db.get_value("Customer", {"name": "_Test Loan Customer"}, "name")
+
+	def test_sharded_accrual(self):
+		set_loan_accrual_frequency("Daily")
+
+		loans = []
+		for _i in range(3):
+			loan = create_loan(
+				self.applicant,
+				"Term Loan Product 4",
+				1000000,
+				"Repay Over Number of Periods",
+				6,
+				applicant_type="Customer",
+				repayment_start_date="2024-05-05",
+				posting_date="2024-04-05",
+				rate_of_interest=23,
+			)
+			loan.submit()
+			make_loan_disbursement_entry(
+				loan.name,
+				loan.loan_amount,
+				disbursement_date="2024-04-05",
+				repayment_start_date="2024-05-05",
+			)
+			loans.append(loan.name)
+
+		ranges = get_accrual_shard_ranges(loan_product="Term Loan Product 4", shard_size=2)
+		for shard_from, shard_to in ranges:
+			self.assertLessEqual(shard_from, shard_to)
+		for previous, current in zip(ranges, ranges[1:]):
+			self.assertLess(previous[1], current[0])
+
+		process = process_loan_interest_accrual_for_loans(
+			posting_date="2024-04-10", loan_product="Term Loan Product 4"
+		)
+		self.assertEqual(frappe.db.get_value("Process Loan Interest Accrual", process, "status"), "Queued")
+
+		process_accrual_shards(process)
+
+		shards = frappe.get_all(
+			"Process Loan Interest Accrual Shard",
+			filters={"parent": process},
+			fields=["status", "loans_processed", "loans_failed"],
+		)
+		self.assertTrue(shards)
+		self.assertTrue(all(d.status == "Completed" for d in shards))
+		self.assertEqual(sum(d.loans_failed for d in shards), 0)
+		self.assertEqual(
+			frappe.db.get_value("Process Loan Interest Accrual", process, "status"), "Completed"
+		)
+
+		for loan in loans:
+			self.assertTrue(
+				frappe.db.exists(
+					"Loan Interest Accrual",
+					{"loan": loan, "process_loan_interest_accrual": process, "docstatus": 1},
+				)
+			)
+
+	def test_stale_accrual_shard_is_run_again(self):
+		set_loan_accrual_frequency("Daily")
+
+		loan = create_loan(
+			self.applicant,
+			"Term Loan Product 4",
+			1000000,
+			"Repay Over Number of Periods",
+			6,
+			applicant_type="Customer",
+			repayment_start_date="2024-05-05",
+			posting_date="2024-04-05",
+			rate_of_interest=23,
+		)
+		loan.submit()
+		make_loan_disbursement_entry(
+			loan.name, loan.loan_amount, disbursement_date="2024-04-05", repayment_start_date="2024-05-05"
+		)
+
+		process = process_loan_interest_accrual_for_loans(
+			posting_date="2024-04-10", loan_product="Term Loan Product 4"
+		)
+		shards = frappe.get_all(
+			"Process Loan Interest Accrual Shard", filters={"parent": process}, pluck="name"
+		)
+
+		# a shard whose job was killed mid run
+		frappe.db.set_value(
+			"Process Loan Interest Accrual Shard",
+			shards[0],
+			{"status": "Running", "started_at": add_to_date(now_datetime(), hours=-3)},
+		)
+
+		for shard in shards:
+			process_accrual_shard(process, shard)
+
+		self.assertFalse(
+			frappe.db.exists(
+				"Process Loan Interest Accrual Shard",
+				{"parent": process, "status": ("!=", "Completed")},
+			)
+		)
+		self.assertEqual(
+			frappe.db.get_value("Process Loan Interest Accrual", process, "status"), "Completed"
+		)
+
+		# shards killed on every attempt end the run instead of being run again
+		frappe.db.set_value(
+			"Process Loan Interest Accrual", process, "status", "In Progress", update_modified=False
+		)
+		for shard in shards:
+			frappe.db.set_value(
+				"Process Loan Interest Accrual Shard",
+				shard,
+				{
+					"status": "Running",
+					"started_at": add_to_date(now_datetime(), hours=-3),
+					"attempts": 3,
+				},
+			)
+
+		requeue_stale_accrual_shards()
+
+		self.assertFalse(
+			frappe.db.exists(
+				"Process Loan Interest Accrual Shard", {"parent": process, "status": ("!=", "Failed")}
+			)
+		)
+		self.assertEqual(
+			frappe.db.get_value("Process Loan Interest Accrual", process, "status"), "Partially Failed"
+		)
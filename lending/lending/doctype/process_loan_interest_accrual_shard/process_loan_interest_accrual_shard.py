@@ -0,0 +1,30 @@
+# Copyright (c) 2026, Frappe Technologies Pvt. Ltd. and contributors
+# For license information, please see license.txt
+
+# import frappe
+from frappe.model.document import Document
+
+
+class ProcessLoanInterestAccrualShard(Document):
+	# begin: auto-generated types
+	# This code is auto-generated. Do not modify anything in this block.
+
+	from typing import TYPE_CHECKING
+
+	if TYPE_CHECKING:
+		from frappe.types import DF
+
+		attempts: DF.Int
+		completed_at: DF.Datetime | None
+		loans_failed: DF.Int
+		loans_processed: DF.Int
+		parent: DF.Data
+		parentfield: DF.Data
+		parenttype: DF.Data
+		shard_from: DF.Link | None
+		shard_to: DF.Link | None
+		started_at: DF.Datetime | None
+		status: DF.Literal["Queued", "Running", "Completed", "Failed"]
+	# end: auto-generated types
+
+	pass
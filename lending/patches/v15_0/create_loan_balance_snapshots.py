@@ -0,0 +1,7 @@
+from lending.lending.doctype.loan_balance_snapshot.loan_balance_snapshot import (
+	rebuild_loan_balance_snapshots,
+)
+
+
+def execute():
+	rebuild_loan_balance_snapshots()
@@ -0,0 +1,54 @@
+import frappe
+from frappe.query_builder import Order
+from frappe.query_builder.functions import Count
+
+from lending.install import create_lending_indexes
+
+DELETE_CHUNK_SIZE = 1000
+
+
+def execute():
+	# Only the latest log of a loan disbursement on a date is kept, so that the unique key
+	# on (loan, loan_disbursement, posting_date) can be added
+	days_past_due_log = frappe.qb.DocType("Days Past Due Log")
+
+	duplicates = (
+		frappe.qb.from_(days_past_due_log)
+		.select(
+			days_past_due_log.loan,
+			days_past_due_log.loan_disbursement,
+			days_past_due_log.posting_date,
+		)
+		.groupby(
+			days_past_due_log.loan,
+			days_past_due_log.loan_disbursement,
+			days_past_due_log.posting_date,
+		)
+		.having(Count("*") > 1)
+		.run(as_dict=1)
+	)
+
+	stale_logs = []
+	for duplicate in duplicates:
+		query = (
+			frappe.qb.from_(days_past_due_log)
+			.select(days_past_due_log.name)
+			.where(days_past_due_log.loan == duplicate.loan)
+			.where(days_past_due_log.posting_date == duplicate.posting_date)
+			.orderby(days_past_due_log.modified, order=Order.desc)
+			.orderby(days_past_due_log.name, order=Order.desc)
+		)
+
+		if duplicate.loan_disbursement:
+			query = query.where(days_past_due_log.loan_disbursement == duplicate.loan_disbursement)
+		else:
+			query = query.where(days_past_due_log.loan_disbursement.isnull())
+
+		stale_logs.extend(query.run(pluck=True)[1:])
+
+	for i in range(0, len(stale_logs), DELETE_CHUNK_SIZE):
+		frappe.qb.from_(days_past_due_log).delete().where(
+			days_past_due_log.name.isin(stale_logs[i : i + DELETE_CHUNK_SIZE])
+		).run()
+
+	create_lending_indexes()
@@ -0,0 +1,216 @@
+"""Snapshot of the Company and Loan Product settings read by the lending jobs.
+
+Accrual, demand, classification and repayment batches read the same handful of
+settings for every loan they process. A snapshot is activated for the duration
+of a batch with `lending_settings_scope` and loads each company or loan product
+once. Callers outside of a batch get a transient snapshot that is not kept, it reads
+the documents from the document cache like single document code paths always did."""
+
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from functools import wraps
+
+import frappe
+from frappe import _
+from frappe.utils import cint, flt
+
+from lending.classification import ClassificationRanges, get_classification_ranges
+
+OFFSET_SEQUENCE_FIELDS = (
+	"collection_offset_sequence_for_standard_asset",
+	"collection_offset_sequence_for_sub_standard_asset",
+	"collection_offset_sequence_for_written_off_asset",
+	"collection_offset_sequence_for_settlement_collection",
+)
+
+
+@dataclass
+class CompanyLoanSettings:
+	name: str
+	interest_day_count_convention: str | None = None
+	loan_accrual_frequency: str | None = None
+	collection_offset_logic_based_on: str | None = None
+	days_past_due_threshold: int = 0
+	days_past_due_threshold_for_auto_write_off: int = 0
+	store_days_past_due_as_intervals: int = 0
+	offset_sequences: dict = field(default_factory=dict)
+	classification: ClassificationRanges | None = None
+
+	def get_loan_accrual_frequency(self):
+		if not self.loan_accrual_frequency:
+			frappe.throw(
+				_("Loan Accrual Frequency not set for company {0}").format(frappe.bold(self.name))
+			)
+
+		return self.loan_accrual_frequency
+
+
+@dataclass
+class LoanProductSettings:
+	name: str
+	company: str | None = None
+	penalty_interest_rate: float = 0.0
+	grace_period_in_days: int = 0
+	consolidate_penal_interest: int = 0
+	days_past_due_threshold_for_npa: int = 0
+	offset_sequences: dict = field(default_factory=dict)
+
+
+@dataclass
+class LendingSettings:
+	precision: int = 2
+	cached: bool = False
+	companies: dict = field(default_factory=dict)
+	loan_products: dict = field(default_factory=dict)
+	offset_orders: dict = field(default_factory=dict)
+
+	@classmethod
+	def load(cls, cached=False):
+		return cls(precision=cint(frappe.db.get_default("currency_precision")) or 2, cached=cached)
+
+	def get_company(self, company) -> CompanyLoanSettings:
+		if company not in self.companies:
+			self.companies[company] = load_company_settings(company, cached=self.cached)
+
+		return self.companies[company]
+
+	def get_loan_product(self, loan_product) -> LoanProductSettings:
+		if loan_product not in self.loan_products:
+			self.loan_products[loan_product] = load_loan_product_settings(
+				loan_product, cached=self.cached
+			)
+
+		return self.loan_products[loan_product]
+
+	def get_offset_sequence(self, loan_product, company, offset_field):
+		"""Offset order set on the loan product, falling back to the one set on the company"""
+		return self.get_loan_product(loan_product).offset_sequences.get(
+			offset_field
+		) or self.get_company(company).offset_sequences.get(offset_field)
+
+	def get_offset_order(self, offset_order):
+		"""Compiled steps of the `Loan Demand Offset Order`"""
+		from lending.lending.doctype.loan_repayment.allocation import compile_offset_order
+
+		if offset_order not in self.offset_orders:
+			self.offset_orders[offset_order] = compile_offset_order(offset_order)
+
+		return self.offset_orders[offset_order]
+
+	def invalidate(self, doctype, name):
+		if doctype == "Company":
+			self.companies.pop(name, None)
+		elif doctype == "Loan Product":
+			self.loan_products.pop(name, None)
+		elif doctype == "Loan Demand Offset Order":
+			self.offset_orders.pop(name, None)
+
+
+def get_values(doctype, name, fields, cached=False):
+	if cached:
+		return frappe.get_cached_value(doctype, name, fields, as_dict=1)
+
+	return frappe.db.get_value(doctype, name, fields, as_dict=1)
+
+
+def load_company_settings(company, cached=False):
+	details = (
+		get_values(
+			"Company",
+			company,
+			[
+				"interest_day_count_convention",
+				"loan_accrual_frequency",
+				"collection_offset_logic_based_on",
+				"days_past_due_threshold",
+				"days_past_due_threshold_for_auto_write_off",
+				"store_days_past_due_as_intervals",
+				*OFFSET_SEQUENCE_FIELDS,
+			],
+			cached=cached,
+		)
+		or frappe._dict()
+	)
+
+	return CompanyLoanSettings(
+		name=company,
+		interest_day_count_convention=details.interest_day_count_convention,
+		loan_accrual_frequency=details.loan_accrual_frequency,
+		collection_offset_logic_based_on=details.collection_offset_logic_based_on,
+		days_past_due_threshold=cint(details.days_past_due_threshold),
+		days_past_due_threshold_for_auto_write_off=cint(
+			details.days_past_due_threshold_for_auto_write_off
+		),
+		store_days_past_due_as_intervals=cint(details.store_days_past_due_as_intervals),
+		offset_sequences={field: details.get(field) for field in OFFSET_SEQUENCE_FIELDS},
+		classification=get_classification_ranges(company),
+	)
+
+
+def load_loan_product_settings(loan_product, cached=False):
+	details = (
+		get_values(
+			"Loan Product",
+			loan_product,
+			[
+				"company",
+				"penalty_interest_rate",
+				"grace_period_in_days",
+				"consolidate_penal_interest",
+				"days_past_due_threshold_for_npa",
+				*OFFSET_SEQUENCE_FIELDS,
+			],
+			cached=cached,
+		)
+		or frappe._dict()
+	)
+
+	return LoanProductSettings(
+		name=loan_product,
+		company=details.company,
+		penalty_interest_rate=flt(details.penalty_interest_rate),
+		grace_period_in_days=cint(details.grace_period_in_days),
+		consolidate_penal_interest=cint(details.consolidate_penal_interest),
+		days_past_due_threshold_for_npa=cint(details.days_past_due_threshold_for_npa),
+		offset_sequences={field: details.get(field) for field in OFFSET_SEQUENCE_FIELDS},
+	)
+
+
+def get_lending_settings() -> LendingSettings:
+	"""Settings snapshot of the running batch, or a transient one read from the document
+	cache outside of a batch"""
+	return getattr(frappe.local, "lending_settings", None) or LendingSettings.load(cached=True)
+
+
+@contextmanager
+def lending_settings_scope():
+	"""Keeps one settings snapshot for everything processed inside the block. Nested
+	scopes reuse the outer snapshot."""
+	if getattr(frappe.local, "lending_settings", None):
+		yield frappe.local.lending_settings
+		return
+
+	frappe.local.lending_settings = LendingSettings.load()
+	try:
+		yield frappe.local.lending_settings
+	finally:
+		frappe.local.lending_settings = None
+
+
+def with_lending_settings(fn):
+	"""Runs `fn` inside `lending_settings_scope`, meant for batch and single document entry
+	points"""
+
+	@wraps(fn)
+	def wrapper(*args, **kwargs):
+		with lending_settings_scope():
+			return fn(*args, **kwargs)
+
+	return wrapper
+
+
+def invalidate_lending_settings(doc, method=None):
+	"""Drops the saved Company, Loan Product or offset order from the active snapshot"""
+	settings = getattr(frappe.local, "lending_settings", None)
+	if settings:
+		settings.invalidate(doc.doctype, doc.name)
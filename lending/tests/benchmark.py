@@ -0,0 +1,340 @@
+"""Benchmarks for the nightly lending jobs.
+
+Builds a synthetic portfolio of term, demand and line of credit loans on a test site and
+runs each scheduler entry point against it, reporting wall time, query count, rows written
+and peak Python memory, also normalised per 1000 loans::
+
+	bench --site test_site execute lending.tests.benchmark.run_benchmarks --kwargs "{'loans': 1000}"
+
+Jobs enqueued by the schedulers run inline so that their cost is part of the measurement.
+Everything generated is committed, never run this against a production site."""
+
+import random
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import frappe
+from frappe.utils import add_days, add_months, add_to_date, flt, get_datetime, getdate, nowdate
+
+from lending.lending.doctype.loan_application.loan_application import (
+	create_loan_security_assignment,
+)
+from lending.lending.doctype.loan_repayment.loan_repayment import calculate_amounts
+from lending.lending.doctype.process_loan_demand.process_loan_demand import (
+	process_daily_loan_demands,
+)
+from lending.tests.test_utils import (
+	create_demand_loan,
+	create_loan,
+	create_loan_application,
+	create_loan_security,
+	create_loan_security_price,
+	create_loan_security_type,
+	create_repayment_entry,
+	init_customers,
+	init_loan_products,
+	make_loan_disbursement_entry,
+	master_init,
+	set_loan_accrual_frequency,
+)
+
+NIGHTLY_JOBS = {
+	"Interest Accrual": "lending.lending.doctype.process_loan_interest_accrual.process_loan_interest_accrual.schedule_accrual",
+	"Loan Demand": "lending.lending.doctype.process_loan_demand.process_loan_demand.process_daily_loan_demands",
+	"Loan Classification": "lending.lending.doctype.process_loan_classification.process_loan_classification.create_process_loan_classification",
+	"Security Shortfall": "lending.lending.doctype.process_loan_security_shortfall.process_loan_security_shortfall.create_process_loan_security_shortfall",
+}
+
+# Tables the nightly jobs write to, rows written is the growth of these during a job
+WRITTEN_DOCTYPES = (
+	"Loan Interest Accrual",
+	"Loan Demand",
+	"GL Entry",
+	"Journal Entry",
+	"Days Past Due Log",
+	"Loan NPA Log",
+	"Loan Security Shortfall",
+	"Process Loan Interest Accrual",
+	"Process Loan Interest Accrual Shard",
+	"Process Loan Demand",
+	"Process Loan Classification",
+	"Process Loan Security Shortfall",
+)
+
+# Arguments of `frappe.enqueue` that are not passed on to the job
+ENQUEUE_ARGS = (
+	"queue",
+	"timeout",
+	"event",
+	"is_async",
+	"job_name",
+	"now",
+	"enqueue_after_commit",
+	"on_success",
+	"on_failure",
+	"at_front",
+	"job_id",
+	"deduplicate",
+)
+
+
+def run_benchmarks(loans=1000, seed=0, skip_portfolio=False, jobs=None):
+	"""Builds a portfolio of `loans` loans, runs the nightly jobs and prints their cost"""
+	loans = int(loans)
+
+	if not skip_portfolio:
+		make_synthetic_portfolio(loans, seed=seed)
+
+	open_loans = frappe.db.count("Loan", {"docstatus": 1, "status": ("!=", "Closed")})
+	results = []
+
+	for job in jobs or NIGHTLY_JOBS:
+		with run_enqueued_jobs_inline(), measure(job, open_loans) as stats:
+			frappe.get_attr(NIGHTLY_JOBS[job])()
+			frappe.db.commit()  # nosemgrep
+
+		results.append(stats)
+
+	print_results(results)
+	return results
+
+
+def make_synthetic_portfolio(
+	loans=1000,
+	as_on=None,
+	term_loan_share=0.7,
+	demand_loan_share=0.15,
+	repayment_ratio=0.8,
+	seed=0,
+):
+	"""Creates `loans` disbursed loans with their schedule history till `as_on`.
+
+	Term loans are disbursed up to a year back, EMI demands are raised for every
+	installment due by `as_on` and `repayment_ratio` of them are paid. The rest of the
+	portfolio is split between secured demand loans and line of credit loans."""
+	rng = random.Random(seed)
+	as_on = getdate(as_on or add_days(nowdate(), -1))
+
+	setup_masters()
+
+	term_loans = int(loans * term_loan_share)
+	demand_loans = int(loans * demand_loan_share)
+	loc_loans = loans - term_loans - demand_loans
+
+	for i in range(term_loans):
+		make_term_loan(rng, as_on, repayment_ratio)
+		commit_every(i)
+
+	for i in range(demand_loans):
+		make_secured_demand_loan(rng, as_on)
+		commit_every(i)
+
+	for i in range(loc_loans):
+		make_line_of_credit_loan(rng, as_on)
+		commit_every(i)
+
+	frappe.db.commit()  # nosemgrep
+
+
+def setup_masters():
+	master_init()
+	init_loan_products()
+	init_customers()
+	create_loan_security_type()
+	create_loan_security()
+	set_loan_accrual_frequency("Daily")
+
+	for loan_security, price in (("Test Security 1", 500), ("Test Security 2", 250)):
+		create_loan_security_price(
+			loan_security,
+			price,
+			"Nos",
+			get_datetime(),
+			get_datetime(add_to_date(nowdate(), hours=24)),
+		)
+
+
+def make_term_loan(rng, as_on, repayment_ratio):
+	disbursement_date = add_days(as_on, -rng.randint(30, 365))
+	repayment_start_date = add_months(disbursement_date, 1)
+
+	loan = create_loan(
+		rng.choice(["_Test Loan Customer", "_Test Loan Customer 1"]),
+		"Term Loan Product 4",
+		rng.randrange(100000, 2000000, 1000),
+		"Repay Over Number of Periods",
+		rng.choice([6, 12, 24, 36]),
+		applicant_type="Customer",
+		repayment_start_date=repayment_start_date,
+		posting_date=disbursement_date,
+		rate_of_interest=rng.choice([12, 16, 18, 23]),
+	)
+	loan.submit()
+	make_loan_disbursement_entry(
+		loan.name,
+		loan.loan_amount,
+		disbursement_date=disbursement_date,
+		repayment_start_date=repayment_start_date,
+	)
+
+	schedule = frappe.db.get_value(
+		"Loan Repayment Schedule", {"loan": loan.name, "docstatus": 1, "status": "Active"}
+	)
+	payment_dates = frappe.get_all(
+		"Repayment Schedule",
+		filters={"parent": schedule, "payment_date": ("<=", as_on)},
+		pluck="payment_date",
+		order_by="payment_date",
+	)
+
+	for payment_date in payment_dates:
+		process_daily_loan_demands(posting_date=payment_date, loan=loan.name)
+
+		if rng.random() < repayment_ratio:
+			value_date = add_days(payment_date, rng.randint(0, 10))
+			if getdate(value_date) > as_on:
+				continue
+
+			payable_amount = calculate_amounts(loan.name, value_date)["payable_amount"]
+			if flt(payable_amount) > 0:
+				create_repayment_entry(loan.name, value_date, payable_amount).submit()
+
+	return loan.name
+
+
+def make_secured_demand_loan(rng, as_on):
+	applicant = rng.choice(["_Test Loan Customer", "_Test Loan Customer 1"])
+	disbursement_date = add_days(as_on, -rng.randint(30, 365))
+	pledge = [{"loan_security": "Test Security 1", "qty": 4000.00}]
+
+	loan_application = create_loan_application(
+		"Moo Coding", applicant, "Demand Loan", pledge, posting_date=disbursement_date
+	)
+	create_loan_security_assignment(loan_application)
+
+	loan = create_demand_loan(
+		applicant, "Demand Loan", loan_application, posting_date=disbursement_date
+	)
+	loan.submit()
+	make_loan_disbursement_entry(loan.name, loan.loan_amount, disbursement_date=disbursement_date)
+
+	return loan.name
+
+
+def make_line_of_credit_loan(rng, as_on):
+	start_date = add_days(as_on, -rng.randint(60, 365))
+
+	loan = create_loan(
+		rng.choice(["_Test Loan Customer", "_Test Loan Customer 1"]),
+		"Term Loan Product 5",
+		rng.randrange(500000, 3000000, 1000),
+		"Repay Over Number of Periods",
+		1,
+		posting_date=start_date,
+		rate_of_interest=rng.choice([14, 17, 21]),
+		applicant_type="Customer",
+		limit_applicable_start=start_date,
+		limit_applicable_end=add_months(start_date, 24),
+	)
+	loan.submit()
+
+	disbursement_date = start_date
+	for _i in range(rng.randint(1, 3)):
+		disbursement_date = add_days(disbursement_date, rng.randint(1, 30))
+		if getdate(disbursement_date) > as_on:
+			break
+
+		make_loan_disbursement_entry(
+			loan.name,
+			rng.randrange(10000, 100000, 1000),
+			disbursement_date=disbursement_date,
+			repayment_start_date=add_months(disbursement_date, 3),
+			repayment_frequency="One Time",
+		)
+
+	return loan.name
+
+
+def commit_every(i, batch_size=100):
+	if (i + 1) % batch_size == 0:
+		frappe.db.commit()  # nosemgrep
+
+
+@contextmanager
+def run_enqueued_jobs_inline():
+	"""Runs whatever the job enqueues right away instead of handing it to a worker"""
+	enqueue = frappe.enqueue
+
+	def enqueue_inline(method, **kwargs):
+		if isinstance(method, str):
+			method = frappe.get_attr(method)
+
+		for arg in ENQUEUE_ARGS:
+			kwargs.pop(arg, None)
+
+		return method(**kwargs)
+
+	frappe.enqueue = enqueue_inline
+	try:
+		yield
+	finally:
+		frappe.enqueue = enqueue
+
+
+@contextmanager
+def measure(job, loans):
+	"""Collects wall time, query count, rows written and peak memory of the block"""
+	stats = frappe._dict(job=job, loans=loans)
+	sql = frappe.db.sql
+	query_count = 0
+
+	def counting_sql(*args, **kwargs):
+		nonlocal query_count
+		query_count += 1
+		return sql(*args, **kwargs)
+
+	row_counts = get_row_counts()
+
+	frappe.db.sql = counting_sql
+	tracemalloc.start()
+	start = time.perf_counter()
+
+	try:
+		yield stats
+	finally:
+		stats.wall_time = time.perf_counter() - start
+		stats.peak_memory = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+		tracemalloc.stop()
+		frappe.db.sql = sql
+
+		stats.queries = query_count
+		stats.rows_written = sum(
+			count - row_counts[doctype] for doctype, count in get_row_counts().items()
+		)
+
+		per_1k = 1000 / loans if loans else 0
+		stats.wall_time_per_1k = stats.wall_time * per_1k
+		stats.queries_per_1k = stats.queries * per_1k
+		stats.rows_written_per_1k = stats.rows_written * per_1k
+		stats.peak_memory_per_1k = stats.peak_memory * per_1k
+
+
+def get_row_counts():
+	return {doctype: frappe.db.count(doctype) for doctype in WRITTEN_DOCTYPES}
+
+
+def print_results(results):
+	header = (
+		f"{'Job':<22}{'Loans':>8}{'Time (s)':>12}{'Queries':>12}{'Rows':>10}{'Peak MB':>10}"
+		f"{'s/1k':>10}{'Queries/1k':>12}{'Rows/1k':>10}{'MB/1k':>8}"
+	)
+	print(header)
+	print("-" * len(header))
+
+	for stats in results:
+		print(
+			f"{stats.job:<22}{stats.loans:>8}{stats.wall_time:>12.2f}{stats.queries:>12}"
+			f"{stats.rows_written:>10}{stats.peak_memory:>10.1f}{stats.wall_time_per_1k:>10.2f}"
+			f"{stats.queries_per_1k:>12.0f}{stats.rows_written_per_1k:>10.0f}{stats.peak_memory_per_1k:>8.1f}"
+		)
@@ -1,6 +1,7 @@
 from datetime import date, timedelta
 
 import frappe
+from frappe.utils import cint, now_datetime
 from frappe.utils.user import is_website_user
 
 
@@ -18,3 +19,168 @@ def daterange(start_date: date, end_date: date):
 	days = int((end_date - start_date).days)
 	for n in range(days + 1):
 		yield start_date + timedelta(n)
+
+
+def get_series_names(autoname, count):
+	"""Reserve `count` consecutive names for an old style naming expression like `LM-LIA-.#####`"""
+	from frappe.model.naming import parse_naming_series
+
+	if not count:
+		return []
+
+	parts = autoname.split(".")
+	key = parse_naming_series(parts[:-1])
+	digits = len(parts[-1])
+
+	series = frappe.qb.DocType("Series")
+	current = (
+		frappe.qb.from_(series).select(series.current).where(series.name == key).for_update().run()
+	)
+
+	if current and current[0][0] is not None:
+		start = cint(current[0][0])
+		frappe.qb.update(series).set(series.current, series.current + count).where(
+			series.name == key
+		).run()
+	else:
+		start = 0
+		frappe.db.sql("INSERT INTO `tabSeries` (`name`, `current`) VALUES (%s, %s)", (key, count))
+
+	return [key + ("%0" + str(digits) + "d") % (start + i) for i in range(1, count + 1)]
+
+
+def bulk_insert_documents(docs, chunk_size=1000):
+	"""Insert in-memory documents of a single doctype with multi row INSERTs.
+
+	Controller hooks are not run, so callers are responsible for setting every
+	value (including fetched fields and docstatus) the regular save would set."""
+	if not docs:
+		return
+
+	doctype = docs[0].doctype
+	now = now_datetime()
+
+	unnamed_docs = [doc for doc in docs if not doc.name]
+	names = get_series_names(frappe.get_meta(doctype).autoname, len(unnamed_docs))
+	for doc, name in zip(unnamed_docs, names):
+		doc.name = name
+
+	rows = []
+	for doc in docs:
+		doc.creation = doc.modified = now
+		doc.owner = doc.modified_by = frappe.session.user
+		rows.append(doc.get_valid_dict(convert_dates_to_str=True))
+
+	fields = list(rows[0].keys())
+	frappe.db.bulk_insert(
+		doctype, fields, [[row.get(field) for field in fields] for row in rows], chunk_size=chunk_size
+	)
+
+
+def iter_loan_batches(query, batch_size=1000, limit=0):
+	"""Yields the loans matched by `query` in batches of `batch_size`, stopping after
+	`limit` loans when a limit is given.
+
+	`query` is a query builder select on the Loan table that includes the loan name.
+	Pages are fetched by keyset pagination on the name, so only one page is held in
+	memory and each page is an index range scan however far into the book it is."""
+	loan = frappe.qb.DocType("Loan")
+	last_loan = None
+	fetched = 0
+
+	while True:
+		page_size = min(batch_size, limit - fetched) if limit else batch_size
+		if page_size <= 0:
+			return
+
+		page_query = query.orderby(loan.name).limit(page_size)
+		if last_loan:
+			page_query = page_query.where(loan.name > last_loan)
+
+		loans = page_query.run(as_dict=1)
+		if not loans:
+			return
+
+		yield loans
+
+		if len(loans) < page_size:
+			return
+
+		fetched += len(loans)
+		last_loan = loans[-1].name
+
+
+def iter_applicant_loan_batches(query, batch_size=1000):
+	"""Yields the loans matched by `query` in batches of about `batch_size`, ordered by
+	applicant with all the loans of an applicant in the same batch.
+
+	`query` is a query builder select on the Loan table that includes the loan name. Pages
+	are fetched by keyset pagination on (applicant_type, applicant, name). An applicant
+	with more loans than fit in a batch is split across batches."""
+	loan = frappe.qb.DocType("Loan")
+	last_loan = None
+
+	while True:
+		page_query = (
+			query.select(loan.applicant_type, loan.applicant)
+			.orderby(loan.applicant_type)
+			.orderby(loan.applicant)
+			.orderby(loan.name)
+			.limit(batch_size)
+		)
+
+		if last_loan:
+			page_query = page_query.where(
+				(loan.applicant_type > last_loan.applicant_type)
+				| (
+					(loan.applicant_type == last_loan.applicant_type)
+					& (loan.applicant > last_loan.applicant)
+				)
+				| (
+					(loan.applicant_type == last_loan.applicant_type)
+					& (loan.applicant == last_loan.applicant)
+					& (loan.name > last_loan.name)
+				)
+			)
+
+		loans = page_query.run(as_dict=1)
+		if not loans:
+			return
+
+		if len(loans) < batch_size:
+			yield loans
+			return
+
+		# the last applicant may have more loans on the next page, they go with them
+		last_applicant = (loans[-1].applicant_type, loans[-1].applicant)
+		complete = [d for d in loans if (d.applicant_type, d.applicant) != last_applicant]
+		if complete:
+			loans = complete
+
+		yield loans
+		last_loan = loans[-1]
+
+
+def lock_claimed_requests(doctype, requests):
+	"""Locks the requests still held by the claim they were read with till the end of the
+	transaction and returns their names. Requests reclaimed by another worker or settled
+	since are left out."""
+	table = frappe.qb.DocType(doctype)
+
+	claims = {}
+	for request in requests:
+		claims.setdefault(request.claimed_at, []).append(request.name)
+
+	locked = []
+	for claimed_at, names in claims.items():
+		locked += (
+			frappe.qb.from_(table)
+			.select(table.name)
+			.where(table.name.isin(names))
+			.where(table.status == "Processing")
+			.where(table.claimed_at == claimed_at)
+			.for_update()
+			.run(pluck=True)
+		)
+
+	return locked